@@ -1,6 +1,14 @@
 import optparse
+import io
+import gzip
 import json
+import pickle
+import tempfile
+import contextlib
+import collections
+import multiprocessing
 import datetime
+import fnmatch
 import drned
 from drned import schema
 import pytest
@@ -16,6 +24,13 @@ import common.test_common as common
 VERBOSE = False
 XVERBOSE = False
 
+NCS_NAME = "{http://tail-f.com/ns/ncs}name"
+NCS_CONFIG = "{http://tail-f.com/ns/ncs}config"
+
+COVERAGE_CACHE = "drned-work/coverage/covanalysis.pickle"
+COVERAGE_CACHE_VERSION = 3
+COVERAGE_RESULT = "drned-work/coverage/coverage.json"
+
 
 def compress_path(path):
     while re.match(".*?{([^}]+)}.*?({\\1}).*", path):
@@ -25,10 +40,17 @@ def compress_path(path):
 
 class _Coverage(object):
     set_map = {}
+    lap = None
     schema = None
+    paths = []
+    node_ids = {}
+    # Schema nodes of the subtrees read, see _index_schema()
+    index = {}
+    index_key = None
 
-    def __init__(self, name):
+    def __init__(self, name, spath):
         self.name = name
+        self.spath = spath
         self.value = None
         self.is_set = False
         self.was_read = False
@@ -46,6 +68,7 @@ class _Coverage(object):
         self.was_read = True
         self.value = value
         self.update_set_map()
+        self.mark("was_read")
 
     # Set node
     def set_node(self, value):
@@ -55,21 +78,26 @@ class _Coverage(object):
                 print("ADD %s: %s: was_modified" % (self.name, value))
             self.was_set = True
             self.was_modified = True
+            self.mark("was_set")
+            self.mark("was_modified")
         elif not self.is_set:
             if VERBOSE:
                 v = value.strip() if value else None
                 print("ADD %s: %swas_set" % (self.name, (value + ": ") if value else ""))
             self.was_set = True
+            self.mark("was_set")
         self.is_set = True
         self.was_read = True
         self.value = value
         self.update_set_map()
+        self.mark("was_read")
 
     # Delete node
     def delete_node(self):
         if self.is_set and self.name not in _Coverage.set_map:
             self.was_deleted = True
             self.is_set = False
+            self.mark("was_deleted")
             if VERBOSE:
                 print("DEL %s: was_deleted" % (self.name))
             if "]/" in self.name:
@@ -77,7 +105,7 @@ class _Coverage(object):
                 self.was_deleted_separately = (lpath in _Coverage.set_map)
                 if not self.was_deleted_separately:
                     sname = re.sub(r"\[[^\]]*\]", "", lpath)
-                    node = _Coverage.schema.get_node(sname)
+                    node = _Coverage.index.get(sname)
                     if (not node) or (not node.stmt):
                         print("NOTE: skipping delete of unknown element: '%s'" % compress_path(sname))
                     elif node.stmt.search_one(("tailf-common", "cli-recursive-delete")):
@@ -90,42 +118,51 @@ class _Coverage(object):
                             self.was_deleted_separately = True
             else:
                 self.was_deleted_separately = True
+            if self.was_deleted_separately:
+                self.mark("was_deleted_separately")
             # Parent still present, so node deleted separately
             if VERBOSE:
                 print("DEL %s: was_deleted_separately" % (self.name))
 
-    # Update node with values from another node
-    def union_node(self, node):
-        if node.was_read:
-            self.was_read = True
-        if node.was_set:
-            self.was_set = True
-        if node.was_deleted:
-            self.was_deleted = True
-        if node.was_modified:
-            self.was_modified = True
-        if node.was_deleted_separately:
-            self.was_deleted_separately = True
-
     # Update set map
     def update_set_map(self):
         _Coverage.set_map[self.name] = True
 
+    # Record a flag as changed by the snapshot being read
+    def mark(self, flag):
+        if _Coverage.lap is not None:
+            _Coverage.lap[flag].add(self.spath)
 
-def test_coverage(fname, argv, all, devname, yangpath=""):
+
+def test_coverage(fname, argv, all, devname, yangpath="", jobs=None,
+                  states=None):
     """Show test coverage since the last "make covstart" command.
 
     The coverage data is calculated by comparing the YANG model
-    specified in the --fname argument with all .xml files in the
-    drned-work/coverage directory. The "make covstart" command creates
-    this directory, and all subsequent commits will automatically
-    create a new .xml representation of the configuration data.
+    specified in the --fname argument with all configuration snapshots
+    in the drned-work/coverage directory. The "make covstart" command
+    creates this directory, and all subsequent commits will
+    automatically create a new .xml representation of the
+    configuration data. Snapshots are kept compressed in
+    drned-work/coverage/objects, identical snapshots are stored once;
+    each session lists its snapshots in order in its snapshot index.
 
     After a "make covstart", you have to run all tests in sequence to
     be able to calculate the total coverage. Note that "make restart"
     removes the coverage directory, so do not restart while
     accumulating coverage files.
 
+    The analysis of each session is cached, for each device name and
+    paths to include/exclude, in drned-work/coverage; only sessions that
+    have been added or changed since are read again.  With paths to
+    include/exclude, only the subtrees of the model and of the snapshots
+    that may contain included nodes are read.
+
+    Each snapshot is also attributed to the states loaded before it was
+    taken (as recorded by the device in the session snapshot index), so
+    that the nodes set or deleted by a state, and by the transitions
+    to it, can be shown with the states argument.
+
     A sample output is:
 
     Found a total of 1554 nodes (554 of type empty) and 172 lists,
@@ -203,10 +240,41 @@ def test_coverage(fname, argv, all, devname, yangpath=""):
                  run through py.test the value of argument --device is used for
                  devname)
 
+        jobs: number of coverage sessions analyzed in parallel (by default
+              the number of CPUs)
+
+        states: list of state name patterns; show the nodes and lists
+                set or deleted by each matching state, with the number
+                of them not set or deleted by any other state (listed
+                with all)
+
     Returns:
         nothing
 
     """
+    _coverage(fname, argv, all, devname, yangpath, jobs, states)
+
+
+def coverage_data(fname, argv, devname, yangpath="", jobs=None):
+    """Calculate the coverage like test_coverage, without pytest.
+
+    This is meant for a process that calculates the coverage
+    repeatedly: the schema loaded from the YANG files is kept in memory
+    and used again as long as the files do not change.
+
+    Returns:
+        a tuple (result, output): the result as stored in
+        drned-work/coverage/coverage.json, and the report text
+
+    """
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        result = _coverage(fname, argv, False, devname, yangpath, jobs)
+    return (result, output.getvalue())
+
+
+def _coverage(fname, argv, all, devname, yangpath="", jobs=None,
+              states=None):
     # Heuristics to load YANG files in correct order
     def yangprio(str):
         prio = [
@@ -237,7 +305,7 @@ def test_coverage(fname, argv, all, devname, yangpath=""):
 
     print("\nUse YANG file(s):\n%s\n" % "\n".join(fname))
 
-    _Coverage.schema = schema.Schema(fname, [], yangpath)
+    _Coverage.schema = _load_schema(fname, yangpath)
 
     skip_lists = []
     skip_leaves = []
@@ -251,210 +319,49 @@ def test_coverage(fname, argv, all, devname, yangpath=""):
         else:
             include_prefixes.append(p)
 
-    lists_to_count = [n for n in _gen_nodes(skip_lists, include_prefixes, exclude_prefixes, ["list"]) if n.is_config()]
-    leafs_to_count = [n for n in _gen_nodes(skip_leaves, include_prefixes, exclude_prefixes, ["leaf-list", "leaf"]) if n.is_config()]
-
-    # Get all collected coverage data
-    all_coverage = {}
-    list_multiple = set()
-    cached_dirs = []
-    save_cache = False
-
-    use_cache = (common.check_output("whoami").strip() != "jenkins") \
-        and (devname is None or devname == "none")
-
-    if use_cache and os.path.exists("drned-work/coverage/covanalysis.json"):
-        with open("drned-work/coverage/covanalysis.json", "rb") as covf:
-            covcache = json.load(covf)
-            cached_dirs = covcache["cached_dirs"]
-            list_multiple = set(covcache["list_multiple"])
-            for (p, d) in covcache["coverage"].items():
-                c = _Coverage("dummy")
-                c.__dict__ = d
-                all_coverage[p] = c
-
-    # Read one session at a time in ascending order
-    for dir in sorted(os.listdir("drned-work/coverage")):
-        # Read one file at a time in ascending order
-        in_sync = False
-        coverage = {}
-        if dir in cached_dirs or dir == "covanalysis.json":
-            continue
-        save_cache = use_cache
-        cached_dirs.append(dir)
-        if VERBOSE:
-            sys.stdout.write("\nREAD_DIR: " + dir)
-        for fn in sorted(os.listdir("drned-work/coverage/%s" % dir)):
-            leaf_lists = dict()
-            current_list_prefix = list()
-            current_key_vals = None
-            current_key_names = None
-            list_keys = dict()
-            if VERBOSE:
-                sys.stdout.write('.')
-                sys.stdout.flush()
-            _Coverage.set_map = {}
-            fp = "drned-work/coverage/%s/%s" % (dir, fn)
-            if fp.endswith(".xml") \
-               and os.path.isfile(fp) \
-               and os.path.getsize(fp) > 0:
-                if VERBOSE:
-                    print("LOAD FILE: %s" % fp)
-                try:
-                    root = etree.parse(fp)
-                except:
-                    # Remove non-ascii chars and try again
-                    print(("Error when scanning %s, " % fp) +
-                          "remove non-ascii chars and retry")
-                    with open(fp) as r:
-                        lines = r.read()
-                    lines = filter(lambda x: x in string.printable, lines)
-                    with open(fp + ".tmp", "w") as w:
-                        w.write(lines)
-                    root = etree.parse(fp + ".tmp")
-                device = root.find("//{http://tail-f.com/ns/ncs}name")
-                if devname and devname != "none":
-                    if devname == "real" and "netsim" in device.text:
-                        continue
-                    if devname != "real" and devname not in device.text:
-                        continue
-                cfg = root.find("//{http://tail-f.com/ns/ncs}config")
-                if cfg is not None:
-                    ddc = root.getelementpath(cfg)
-                    cfgnodes = cfg.iter()
-                    next(cfgnodes)  # skip cfg itself
-                else:
-                    # Empty DB -> noting set initially or all deleted in the
-                    # end
-                    cfgnodes = []
-
-                for e in cfgnodes:
-                    if (e.text and e.text.strip() != "") or not e.getchildren():
-                        path = root.getelementpath(e)[len(ddc):]
-                        orig_path = path
-                        if XVERBOSE:
-                            print("PATH %s" % path)
-                        while current_list_prefix:
-                            if path.startswith(current_list_prefix[-1][0]):
-                                pn = len(current_list_prefix[-1][0])
-                                path = current_list_prefix[-1][1] + "/" + path[pn:]
-                                break
-                            else:
-                                if XVERBOSE:
-                                    print("POP: " + current_list_prefix[-1][0])
-                                current_list_prefix.pop()
-                        if XVERBOSE and path != orig_path:
-                            print("EXPANDED PATH %s" % path)
-                        sname = re.sub(r"\[[^\]]*\]", "", path)
-                        node = _Coverage.schema.get_node(sname)
-                        if not node:
-                            print("NOTE: skipping unknown element: '%s' (%s)" % (compress_path(path), sname))
-                            continue
-                        if node.is_key():
-                            if not current_key_names:
-                                current_key_names = node.get_parent().stmt.search_one("key").arg.split(" ")
-                                current_key_vals = list()
-                            key_tag = re.sub("{[^}]+}", "", e.tag)
-                            if not key_tag in current_key_names:
-                                raise Exception("Expected key (%s) here : %s" % (str(current_key_names), path))
-                            current_key_vals.append(e.text.strip() if e.text else "")
-                            if len(current_key_vals) == len(current_key_names):
-                                path = path[:path.rindex(e.tag)-1]
-                                orig_path = orig_path[:orig_path.rindex(e.tag)-1]
-                                if path[-1] == "]":
-                                    path = path[:path.rindex("[")]
-                                current_key_vals = ",".join(current_key_vals)
-                                path = ("%s[%s]" %
-                                        (path,
-                                         current_key_vals))
-                                orig_path += "/"
-                                if XVERBOSE:
-                                    print("ADD LIST PREFIX: %s - %s" % (path + "/", orig_path))
-                                current_list_prefix.append((orig_path, path))
-                                nokeys_path = re.sub(r"\[[^\]]*\]", "", path)
-                                if nokeys_path not in list_keys:
-                                    list_keys[nokeys_path] = set()
-                                list_keys[nokeys_path].add(current_key_vals)
-                                current_key_names = None
-                                current_key_vals = None
-                                # Fall through and count full list instance
-                            else:
-                                # Skip keys in count
-                                continue
-                        elif node.is_leaflist():
-                            # Collect leaf-lists into single value
-                            if VERBOSE:
-                                print("FOUND LEAFLIST: " + path)
-                            if path[-1] == "]":
-                                path = path[:path.rfind("[")]
-                            if path not in leaf_lists:
-                                leaf_lists[path] = list()
-                            leaf_lists[path].append(e.text)
-                            continue
-                        # Ignore all but config
-                        # Enter data
-                        if path not in coverage:
-                            coverage[path] = _Coverage(path)
-                        # First file only provides init values,
-                        # and does no transitions
-                        if in_sync:
-                            coverage[path].set_node(e.text)
-                        else:
-                            coverage[path].init_node(e.text)
-                for (p, v) in leaf_lists.items():
-                    if p not in coverage:
-                        coverage[p] = _Coverage(p)
-                    v = ",".join(v)
-                    if in_sync:
-                        coverage[p].set_node(v)
-                    else:
-                        coverage[p].init_node(v)
-                in_sync = True
-
-            for (p, keys) in list_keys.items():
-                if len(keys) > 1:
-                    list_multiple.add(p)
-                    if VERBOSE:
-                        print("LIST with multiple instances " + p)
-
-            # Handle nodes deleted in this lap
-            for p in coverage:
-                coverage[p].delete_node()
-
-        # We now have one coverage map per dir, unionize after each dir to
-        # avoid excessive calls to delete_node above
-        for (p, cov) in coverage.items():
-            if p in all_coverage:
-                all_coverage[p].union_node(cov)
-            else:
-                all_coverage[p] = cov
-
-    coverage = all_coverage
-
-    if save_cache:
-        with open("drned-work/coverage/covanalysis.json", "wb") as covf:
-            def dumpcov(o):
-                if isinstance(o, _Coverage):
-                    return o.__dict__
-                else:
-                    return o
-            covcache = {}
-            covcache["coverage"] = coverage
-            covcache["cached_dirs"] = cached_dirs
-            covcache["list_multiple"] = list(list_multiple)
-            json.dump(covcache, covf, default=dumpcov)
-
-    # Consolidate lists into single entries
-    for p in list(coverage):
-        nolist = re.sub(r"\[[^\]]*\]", "", p)
-        if nolist != p:
-            # Ok, this path has at least one list, so move to common entry
-            if not nolist in coverage:
-                coverage[nolist] = _Coverage(nolist)
-            coverage[nolist].union_node(coverage[p])
-            if XVERBOSE and (p[-1] == "]"):
-                print("CONSOLIDATE LIST: " + nolist)
-            coverage.pop(p)
+    prefixes = _Prefixes(include_prefixes, exclude_prefixes)
+
+    lists_to_count = [n for n in _gen_nodes(skip_lists, prefixes, ["list"]) if n.is_config()]
+    leafs_to_count = [n for n in _gen_nodes(skip_leaves, prefixes, ["leaf-list", "leaf"]) if n.is_config()]
+
+    # Number the schema nodes, coverage is kept as bitsets of node ids
+    _index_schema(prefixes)
+
+    # Get all collected coverage data; results are cached per session,
+    # device name and prefixes (only the included subtrees are read),
+    # sessions not in the cache or changed since are read again
+    coverage = _CoverageBits()
+    transitions = {}
+    devkey = devname if devname and devname != "none" else ""
+    covcache = _load_cache()
+    sessions = {}
+    dirs = []
+    stamps = _session_stamps()
+    for dir in sorted(stamps):
+        # The coverage of all nodes can be used with any prefixes
+        for key in [(dir, devkey, prefixes.key()), (dir, devkey, _Prefixes.ALL)]:
+            cached = covcache.get(key)
+            if cached is not None and cached[0] == stamps[dir]:
+                sessions[key] = cached
+                break
+        else:
+            dirs.append(dir)
+
+    # Read sessions in parallel, but merge them in ascending order
+    for (dir, output, session, trans) in _read_sessions(dirs, devname, prefixes, jobs):
+        sys.stdout.write(output)
+        sessions[(dir, devkey, prefixes.key())] = (stamps[dir], session, trans)
+    for (key, (stamp, session, trans)) in sorted(sessions.items()):
+        coverage.union(session)
+        for (transition, bits) in trans.items():
+            transitions.setdefault(transition, _CoverageBits()).union(bits)
+
+    # Keep other results still valid, drop removed sessions
+    for (key, cached) in covcache.items():
+        if key not in sessions and key[0] in stamps and cached[0] == stamps[key[0]]:
+            sessions[key] = cached
+    if sessions != covcache:
+        _save_cache(sessions)
 
     # Init stats
     stats_name = [
@@ -472,99 +379,63 @@ def test_coverage(fname, argv, all, devname, yangpath=""):
         "grouping nodes %s set when already set",
         "grouping nodes %s deleted separately"
     ]
-    stats = {}
-    stats["all"] = []
-    stats["all_lists"] = []
-    for n in stats_name:
-        stats[n] = []
-
-    # Add list stats
-    list_nodes = 0
-    for node in lists_to_count:
-        path = node.get_path()
-        stats["all_lists"].append(path)
-        list_nodes += 1
-        if path in list_multiple:
-            stats["lists %s with multiple entries read or set"].append(path)
-        if path in coverage:
-            cov = coverage[path]
-            cov.found = True
-            if path not in stats["lists %s read or set"]:
-                # Only count for one key (if list has multiple keys)
-                stats["lists %s read or set"].append(path)
-            if cov.was_deleted:
-                stats["lists %s deleted"].append(path)
-
-    # Accumulate grouping data
-    grouping = {}
-    for node in leafs_to_count:
-        path = node.get_path()
-        if path in coverage:
-            file,line = node.get_pos()
-            name = node.get_arg()
-            fln = (file,line,name)
-            if fln not in grouping:
-                if VERBOSE:
-                    print("GROUP (%s,%s,%s): %s" % (fln + tuple([path])))
-                grouping[fln] = _Coverage(path)
-            grouping[fln].union_node(coverage[path])
-
-    # Compare to YANG
-    schema_nodes = 0
-    empty_nodes = 0
-    non_sepdel_nodes = 0
+    stats_flag = [
+        "was_read", "was_read", "was_deleted", "list_multiple",
+        "was_set", "was_deleted", "was_modified", "was_deleted_separately",
+        "was_read", "was_set", "was_deleted", "was_modified",
+        "was_deleted_separately"
+    ]
+    # Names of the stats in the stored result
+    stats_key = [
+        ("nodes", "read-or-set"), ("lists", "read-or-set"),
+        ("lists", "deleted"), ("lists", "multi-read-or-set"),
+        ("nodes", "set"), ("nodes", "deleted"), ("nodes", "set-set"),
+        ("nodes", "deleted-separately"),
+        ("grouping-nodes", "read-or-set"), ("grouping-nodes", "set"),
+        ("grouping-nodes", "deleted"), ("grouping-nodes", "set-set"),
+        ("grouping-nodes", "deleted-separately")
+    ]
+
+    # Masks of counted nodes; all coverage data of a node are found
+    # in the coverage (was_read is set for all nodes ever seen)
+    list_mask = _node_mask(lists_to_count)
+    leaf_mask = _node_mask(n for n in leafs_to_count if not n.is_key())
+    empty_mask = _node_mask(n for n in leafs_to_count
+                            if not n.is_key() and n.is_leaf()
+                            and n.get_type() == "empty")
+    non_sepdel_mask = _node_mask(n for n in leafs_to_count
+                                 if not n.is_key()
+                                 and _not_separately_deletable(n))
+    found = coverage.bits["was_read"] & (list_mask | leaf_mask)
+    list_nodes = _bit_count(list_mask)
+    schema_nodes = _bit_count(leaf_mask)
+    empty_nodes = _bit_count(empty_mask)
+    non_sepdel_nodes = _bit_count(non_sepdel_mask)
+
+    # Accumulate grouping data, all nodes of a grouping get the union
+    # of the grouping nodes coverage
+    groups = {}
     for node in leafs_to_count:
-        if node.is_key():
-            # skip keys, we count list-instances above
-            continue
-        path = node.get_path()
-        stats["all"].append(path)
-        schema_nodes += 1
-        if node.is_leaf() and node.get_type() == "empty":
-            empty_nodes += 1
-        non_sepdel = _not_separately_deletable(node)
-        if non_sepdel:
-            non_sepdel_nodes += 1
         file,line = node.get_pos()
         name = node.get_arg()
-        grp = None
-        if (file,line,name) in grouping:
-            grp = grouping[(file,line,name)]
-        if path in coverage:
-            cov = coverage[path]
-            cov.found = True
-            if cov.was_read:
-                stats["nodes %s read or set"].append(path)
-            if cov.was_set:
-                stats["nodes %s set"].append(path)
-            if cov.was_deleted:
-                stats["nodes %s deleted"].append(path)
-            if not non_sepdel and cov.was_deleted_separately:
-                stats["nodes %s deleted separately"].append(path)
-            if cov.was_modified:
-                stats["nodes %s set when already set"].append(path)
-        # Add grouping stats
-        if grp:
-            if grp.was_read:
-                stats["grouping nodes %s read or set"].append(path)
-                if VERBOSE:
-                    print("ADD %s: group_was_read" % path)
-            if grp.was_set:
-                stats["grouping nodes %s set"].append(path)
-                if VERBOSE:
-                    print("ADD %s: group_was_set" % path)
-            if grp.was_deleted:
-                stats["grouping nodes %s deleted"].append(path)
-                if VERBOSE:
-                    print("DEL %s: group_was_deleted" % path)
-            if not non_sepdel and grp.was_deleted_separately:
-                stats["grouping nodes %s deleted separately"].append(path)
-                if VERBOSE:
-                    print("DEL %s: group_was_deleted_separately" % path)
-            if grp.was_modified:
-                stats["grouping nodes %s set when already set"].append(path)
-                if VERBOSE:
-                    print("ADD %s: group_was_modified" % path)
+        fln = (file,line,name)
+        groups[fln] = groups.get(fln, 0) | _node_mask([node])
+    grouping = _CoverageBits()
+    for group in groups.values():
+        for (flag, bits) in coverage.bits.items():
+            if bits & group:
+                grouping.bits[flag] |= group
+
+    stats = {}
+    for (n, flag) in zip(stats_name, stats_flag):
+        if n.startswith("lists"):
+            stats[n] = coverage.bits[flag] & list_mask
+        elif n.startswith("grouping"):
+            stats[n] = grouping.bits[flag] & leaf_mask
+        else:
+            stats[n] = coverage.bits[flag] & leaf_mask
+        if "deleted separately" in n:
+            stats[n] &= ~non_sepdel_mask
 
     def print_paths(paths):
         nsmap = dict()
@@ -582,32 +453,33 @@ def test_coverage(fname, argv, all, devname, yangpath=""):
                 print("  namespace: " + ns + "\n  " +
                         "\n  ".join(sorted(pl)))
         else:
-            print("  " + "\n  ".join(sorted(nsmap.values()[0])))
+            print("  " + "\n  ".join(sorted(list(nsmap.values())[0])))
+
+    # Nodes never counted in each category
+    never = {}
+    for name in stats_name:
+        if "grouping nodes " in name:
+            continue
+        if "lists %s " in name:
+            never[name] = list_mask & ~stats[name]
+        else:
+            never[name] = leaf_mask & ~stats[name]
+            if "when already set" in name:
+                never[name] &= ~empty_mask
+            elif "deleted separately" in name:
+                never[name] &= ~non_sepdel_mask
 
     # Print result
     if all:
         for name in stats_name:
-            f = []
-            if "grouping nodes " in name:
-                continue
-            if "with multiple entries" in name:
-                f = list(set(stats["all_lists"]) - list_multiple)
-            elif "lists %s " in name:
-                f = list(set(stats["all_lists"]) - set(stats[name]))
-            else:
-                s = list(set(stats["all"]) - set(stats[name]))
-                for p in s:
-                    n = _Coverage.schema.get_node(p)
-                    if not ("when already set" in name and n.get_type() == "empty") and \
-                       not ("deleted separately" in name and _not_separately_deletable(n)):
-                        f.append(p)
-            if f:
+            if never.get(name):
                 print(("\n### %s:" % name.replace("%s", "never")))
-                print_paths(f)
+                print_paths(_bit_paths(never[name]))
 
     print("\nFound a total of %d nodes (%d of type empty) and %s lists," %
           (schema_nodes, empty_nodes, list_nodes))
-    for n in stats_name:
+    percents = {}
+    for (n, (group, key)) in zip(stats_name, stats_key):
         nodes = list_nodes if n.startswith("lists") else schema_nodes
         not_count = ""
         if "when already" in n and empty_nodes:
@@ -618,22 +490,66 @@ def test_coverage(fname, argv, all, devname, yangpath=""):
             not_count = " (disregarding %d bool-no|prefix-key|mandatory)" % non_sepdel_nodes
         perc = 100
         if nodes > 0:
-            perc = (100 * len(stats[n]) / nodes)
+            perc = (100 * _bit_count(stats[n]) / nodes)
         print("%6d (%3d%%) %s%s" %
-              (len(stats[n]),
+              (_bit_count(stats[n]),
                perc,
                n.replace("%s ", ""), not_count))
+        percents.setdefault(group, {})[key] = {"total": _bit_count(stats[n]),
+                                               "percent": int(perc)}
+
+    # Store the result, with the paths never counted in each category
+    uncovered = {}
+    for (n, (group, key)) in zip(stats_name, stats_key):
+        if n in never:
+            uncovered["%s-%s" % (group, key)] = sorted(
+                compress_path(p) for p in _bit_paths(never[n]))
+    result = {"nodes-total": schema_nodes,
+              "lists-total": list_nodes,
+              "percents": percents,
+              "uncovered": uncovered}
+    _save_result(result)
+
+    # Print coverage attributed to states, and transitions to them
+    if states:
+        state_coverage = {}
+        for ((_, state), bits) in transitions.items():
+            state_coverage.setdefault(state, _CoverageBits()).union(bits)
+        counted = list_mask | leaf_mask
+        # Nodes touched by more than one state
+        seen = 0
+        shared = 0
+        for cov in state_coverage.values():
+            touched = (cov.bits["was_set"] | cov.bits["was_deleted"]) & counted
+            shared |= seen & touched
+            seen |= touched
+        print("\nNodes and lists set or deleted per state:")
+        for (state, cov) in sorted(state_coverage.items()):
+            if not any(fnmatch.fnmatchcase(state, p) for p in states):
+                continue
+            only = (cov.bits["was_set"] | cov.bits["was_deleted"]) & counted & ~shared
+            print("%6d set, %6d deleted, %6d by this state only: %s" %
+                  (_bit_count(cov.bits["was_set"] & counted),
+                   _bit_count(cov.bits["was_deleted"] & counted),
+                   _bit_count(only), state))
+            for ((start, to), bits) in sorted(transitions.items(),
+                                              key=lambda t: (t[0][1], t[0][0] or "")):
+                if to == state:
+                    print("%6d set, %6d deleted,        from %s" %
+                          (_bit_count(bits.bits["was_set"] & counted),
+                           _bit_count(bits.bits["was_deleted"] & counted),
+                           start or "(start)"))
+            if all and only:
+                print_paths(_bit_paths(only))
 
     # Check for nodes that are set but not found in model
     not_found = []
     empty_containers = []
     all_skip = skip_leaves + skip_lists
-    for c in coverage:
-        if (not coverage[c].found and
-            not c in all_skip and
-            not common.path_in_prefixes(c, exclude_prefixes) and
-                (not include_prefixes or common.path_in_prefixes(c, include_prefixes))):
-            n = _Coverage.schema.get_node(c)
+    for c in _bit_paths(coverage.bits["was_read"] & ~found):
+        if (not c in all_skip and
+                prefixes.includes(c)):
+            n = _Coverage.index.get(c)
             if not n:
                 not_found.append(c)
             elif not n.is_presence_container():
@@ -651,11 +567,588 @@ def test_coverage(fname, argv, all, devname, yangpath=""):
         print("\nNOTE: the following containers " +
               "were found empty (though not marked as presence):")
         print_paths(empty_containers)
+    return result
 
 
-# Loop for all nodes of a certain type
-def _gen_nodes(skip_nodes, include_prefixes, exclude_prefixes, ntype):
-    return common.gen_nodes(_Coverage.schema, skip_nodes, include_prefixes, exclude_prefixes, ntype)
+# Schemas loaded in this process, by YANG files and search path
+_schemas = {}
+
+# Session readers of this process, by session and device name; the
+# most recently used ones are kept
+MAX_READERS = 4
+_readers = collections.OrderedDict()
+
+
+def _load_schema(fname, yangpath):
+    key = (tuple(os.path.abspath(f) for f in fname), str(yangpath))
+    stamp = [(os.stat(f).st_mtime_ns, os.stat(f).st_size) for f in fname]
+    cached = _schemas.get(key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    s = schema.Schema(fname, [], yangpath)
+    _schemas[key] = (stamp, s)
+    return s
+
+
+class _CoverageBits(object):
+    """Coverage of schema nodes, one bitset per coverage flag.
+
+    Bit i of each bitset belongs to the schema node _Coverage.paths[i];
+    list_multiple is set for lists with multiple entries.
+    """
+    flags = ["was_read", "was_set", "was_deleted", "was_modified",
+             "was_deleted_separately", "list_multiple"]
+
+    def __init__(self):
+        self.bits = dict((flag, 0) for flag in self.flags)
+
+    def __eq__(self, other):
+        return self.bits == other.bits
+
+    def __ne__(self, other):
+        return self.bits != other.bits
+
+    # Add the coverage of one node instance
+    def add(self, spath, cov):
+        bit = 1 << _Coverage.node_ids[spath]
+        for flag in self.flags:
+            if getattr(cov, flag, False):
+                self.bits[flag] |= bit
+
+    def union(self, other):
+        for flag in self.flags:
+            self.bits[flag] |= other.bits[flag]
+
+    # Create from schema paths per flag
+    @classmethod
+    def from_paths(cls, paths):
+        coverage = cls()
+        for (flag, flag_paths) in paths.items():
+            coverage.bits[flag] = _paths_mask(flag_paths)
+        return coverage
+
+    # Create from bitsets numbered by a possibly different schema
+    @classmethod
+    def restore(cls, paths, bits):
+        coverage = cls()
+        if _Coverage.paths[:len(paths)] == paths:
+            coverage.bits.update(bits)
+            return coverage
+        for (flag, flag_bits) in bits.items():
+            for i in _bit_ids(flag_bits):
+                # Nodes outside the subtrees read now are kept too, the
+                # bitsets may be stored again
+                _number_paths([paths[i]])
+                coverage.bits[flag] |= 1 << _Coverage.node_ids[paths[i]]
+        return coverage
+
+
+# Index the schema nodes of the subtrees that may contain nodes
+# included by prefixes, the rest of the schema is not expanded.  Node
+# ids are only added while the schema is the same, so that bitsets
+# created with other prefixes stay valid
+def _index_schema(prefixes):
+    key = (_Coverage.schema, prefixes.key())
+    if _Coverage.index_key == key:
+        return
+    if _Coverage.index_key is None or _Coverage.index_key[0] is not _Coverage.schema:
+        _Coverage.paths = []
+        _Coverage.node_ids = {}
+    _Coverage.index = _Coverage.schema.build_index(prune=prefixes.pruned)
+    _Coverage.index_key = key
+    # Numbered before the session readers are forked
+    _number_paths(sorted(_Coverage.index))
+
+
+def _number_paths(paths):
+    for p in paths:
+        if p not in _Coverage.node_ids:
+            _Coverage.node_ids[p] = len(_Coverage.paths)
+            _Coverage.paths.append(p)
+
+
+def _node_mask(nodes):
+    return _paths_mask(node.get_path() for node in nodes)
+
+
+def _paths_mask(paths):
+    ids = [_Coverage.node_ids[p] for p in paths]
+    if not ids:
+        return 0
+    # Set the bits in a byte array, or-ing each bit to an integer
+    # copies the whole bitset
+    mask = bytearray(max(ids) // 8 + 1)
+    for i in ids:
+        mask[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(bytes(mask), "little")
+
+
+def _bit_count(bits):
+    return bin(bits).count("1")
+
+
+def _bit_ids(bits):
+    return [i for (i, b) in enumerate(reversed(bin(bits))) if b == "1"]
+
+
+def _bit_paths(bits):
+    return sorted(_Coverage.paths[i] for i in _bit_ids(bits))
+
+
+# Load cached session results as {(dir, devname, prefixes): (stamp,
+# _CoverageBits, {transition: _CoverageBits})}
+def _load_cache():
+    try:
+        with open(COVERAGE_CACHE, "rb") as covf:
+            covcache = pickle.load(covf)
+        if covcache.get("version") != COVERAGE_CACHE_VERSION:
+            return {}
+    except Exception:
+        return {}
+    paths = covcache["paths"]
+    return dict((key, (stamp, _CoverageBits.restore(paths, bits),
+                       dict((transition, _CoverageBits.restore(paths, tbits))
+                            for (transition, tbits) in trans.items())))
+                for (key, (stamp, bits, trans)) in covcache["sessions"].items())
+
+
+def _save_cache(sessions):
+    covcache = {}
+    covcache["version"] = COVERAGE_CACHE_VERSION
+    covcache["paths"] = _Coverage.paths
+    covcache["sessions"] = dict((key, (stamp, session.bits,
+                                       dict((transition, bits.bits)
+                                            for (transition, bits) in trans.items())))
+                                for (key, (stamp, session, trans)) in sessions.items())
+    fd, tmpname = tempfile.mkstemp(dir="drned-work/coverage")
+    with os.fdopen(fd, "wb") as covf:
+        pickle.dump(covcache, covf, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmpname, COVERAGE_CACHE)
+
+
+def _save_result(result):
+    fd, tmpname = tempfile.mkstemp(dir="drned-work/coverage")
+    with os.fdopen(fd, "w") as resf:
+        json.dump(result, resf)
+    os.rename(tmpname, COVERAGE_RESULT)
+
+
+def coverage_stamp():
+    """Return a value that changes whenever coverage snapshots are
+    added or removed, so that the coverage needs to be calculated
+    again."""
+    return sorted(_session_stamps().items())
+
+
+def _session_stamps():
+    stamps = {}
+    for dir in os.listdir("drned-work/coverage"):
+        path = os.path.join("drned-work/coverage", dir)
+        if os.path.isdir(path) and path != drned.device.COVERAGE_OBJECTS:
+            stamps[dir] = _session_stamp(dir)
+    return stamps
+
+
+# A session changes when snapshots are added to it or to its index
+def _session_stamp(dir):
+    path = os.path.join("drned-work/coverage", dir)
+    stamp = (os.stat(path).st_mtime_ns, len(os.listdir(path)))
+    try:
+        index = os.stat(os.path.join(path, drned.device.COVERAGE_INDEX))
+    except OSError:
+        return stamp
+    return stamp + (index.st_mtime_ns, index.st_size)
+
+
+# Read all sessions, running up to jobs sessions in parallel; sessions
+# that can be continued by a reader of this process are read here
+def _read_sessions(dirs, devname, prefixes, jobs=None):
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    resumed = [_read_session_job((dir, devname, prefixes)) for dir in dirs
+               if _resumable(dir, devname, prefixes)]
+    dirs = [dir for dir in dirs if dir not in [r[0] for r in resumed]]
+    jobs = min(jobs, len(dirs))
+    if jobs <= 1:
+        return sorted(resumed + [_read_session_job((dir, devname, prefixes))
+                                 for dir in dirs],
+                      key=lambda r: r[0])
+    # Workers are forked, so they share the schema with this process
+    pool = multiprocessing.get_context("fork").Pool(jobs)
+    try:
+        return sorted(resumed + pool.map(_read_session_job,
+                                         [(dir, devname, prefixes) for dir in dirs],
+                                         chunksize=1),
+                      key=lambda r: r[0])
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _read_session_job(args):
+    (dir, devname, prefixes) = args
+    # Output is passed to the parent so that it is not interleaved
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        (session, transitions) = _read_session(dir, devname, prefixes)
+    return (dir, output.getvalue(), session, transitions)
+
+
+# List the snapshots of a session in order as (path, states) pairs,
+# with the states loaded before each snapshot; sessions without an
+# index keep their snapshots as plain files, not attributed to states
+def _session_snapshots(dir):
+    covdir = os.path.join("drned-work/coverage", dir)
+    try:
+        with open(os.path.join(covdir, drned.device.COVERAGE_INDEX)) as f:
+            # The last line may not be complete yet
+            lines = [line.rstrip("\n").partition("\t") for line in f
+                     if line.endswith("\n")]
+    except IOError:
+        return [(os.path.join(covdir, fn), None)
+                for fn in sorted(os.listdir(covdir)) if fn.endswith(".xml")]
+    return [(os.path.join(covdir, name) if name.endswith(".xml")
+             else drned.device.snapshot_path(name), states)
+            for (name, _, states) in lines]
+
+
+# Read one session directory, return its coverage as _CoverageBits,
+# and the coverage of each transition between states in the session
+# as {(from-states, to-states): _CoverageBits}; only subtrees that
+# may contain nodes included by prefixes are read.  A session read
+# before by this process is read only from the first snapshot added
+# since
+def _read_session(dir, devname, prefixes):
+    key = (dir, devname, prefixes.key())
+    reader = _readers.pop(key, None)
+    if reader is None or not reader.resumable():
+        reader = _SessionReader(dir, devname, prefixes)
+    reader.read()
+    _readers[key] = reader
+    while len(_readers) > MAX_READERS:
+        _readers.popitem(last=False)
+    return reader.result()
+
+
+def _resumable(dir, devname, prefixes):
+    reader = _readers.get((dir, devname, prefixes.key()))
+    return reader is not None and reader.resumable()
+
+
+class _SessionReader(object):
+    """Reads the snapshots of one session directory in order.
+
+    The reader keeps the state of all node instances of the session,
+    so that when snapshots are added to the session, reading can
+    continue with them.
+    """
+    def __init__(self, dir, devname, prefixes):
+        self.dir = dir
+        self.devname = devname
+        self.prefixes = prefixes if prefixes.key() != _Prefixes.ALL else None
+        self.schema = _Coverage.schema
+        self.snapshots = []
+        self.in_sync = False
+        self.coverage = {}
+        self.session = _CoverageBits()
+        self.transitions = {}
+        self.state = None
+        self.previous = None
+        self.previous_lap = None
+
+    # The snapshots read so far are still the first ones of the session
+    def resumable(self):
+        if self.schema is not _Coverage.schema:
+            return False
+        snapshots = _session_snapshots(self.dir)
+        return snapshots[:len(self.snapshots)] == self.snapshots
+
+    # Read one snapshot at a time in ascending order
+    def read(self):
+        if VERBOSE:
+            sys.stdout.write("\nREAD_DIR: " + self.dir)
+        snapshots = _session_snapshots(self.dir)
+        for (path, states) in snapshots[len(self.snapshots):]:
+            if VERBOSE:
+                sys.stdout.write('.')
+                sys.stdout.flush()
+            self.snapshots.append((path, states))
+            self.read_snapshot(path, states)
+        _Coverage.lap = None
+
+    def read_snapshot(self, path, states):
+        if path == self.previous:
+            # The same content as the previous snapshot, so nothing is
+            # set or deleted, the same nodes are only read again
+            _Coverage.lap = dict((flag, set()) for flag in _CoverageBits.flags)
+            for flag in ("was_read", "list_multiple"):
+                _Coverage.lap[flag] = self.previous_lap[flag]
+        else:
+            list_keys = dict()
+            _Coverage.set_map = {}
+            _Coverage.lap = dict((flag, set()) for flag in _CoverageBits.flags)
+            read = _read_snapshot_file(path, self.devname, self.in_sync,
+                                       self.coverage, list_keys, self.prefixes)
+            if read is False:
+                return
+            if read:
+                self.in_sync = True
+
+            for (p, keys) in list_keys.items():
+                if len(keys) > 1:
+                    self.session.bits["list_multiple"] |= 1 << _Coverage.node_ids[p]
+                    _Coverage.lap["list_multiple"].add(p)
+                    if VERBOSE:
+                        print("LIST with multiple instances " + p)
+
+            # Handle nodes deleted in this lap
+            for p in self.coverage:
+                self.coverage[p].delete_node()
+            self.previous = path
+            self.previous_lap = _Coverage.lap
+
+        # Attribute the changes in this lap to the transition from the
+        # states of the previous snapshot
+        if states is not None:
+            transition = (self.state, states)
+            if transition not in self.transitions:
+                self.transitions[transition] = _CoverageBits()
+            self.transitions[transition].union(_CoverageBits.from_paths(_Coverage.lap))
+            self.state = states
+
+    # Coverage of the snapshots read so far
+    def result(self):
+        # Node instances are kept only during the session, the coverage
+        # of all instances of a node is merged
+        session = _CoverageBits()
+        session.union(self.session)
+        for cov in self.coverage.values():
+            session.add(cov.spath, cov)
+        transitions = {}
+        for (transition, bits) in self.transitions.items():
+            transitions[transition] = _CoverageBits()
+            transitions[transition].union(bits)
+        return (session, transitions)
+
+
+# Read one snapshot file, plain or compressed; return None if it is
+# missing or empty (an empty configuration), otherwise as _read_snapshot
+def _read_snapshot_file(path, devname, in_sync, coverage, list_keys,
+                        prefixes=None):
+    if not os.path.isfile(path):
+        return None
+    with (gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")) as f:
+        if not f.peek(1):
+            return None
+        if VERBOSE:
+            print("LOAD FILE: %s" % path)
+        try:
+            return _read_snapshot(f, devname, in_sync, coverage, list_keys,
+                                  prefixes)
+        except etree.XMLSyntaxError:
+            # Remove non-ascii chars and try again; elements read
+            # before the error are read again with no effect
+            print(("Error when scanning %s, " % path) +
+                  "remove non-ascii chars and retry")
+            f.seek(0)
+            data = f.read()
+    printable = string.printable.encode()
+    data = bytes(c for c in data if c in printable)
+    return _read_snapshot(io.BytesIO(data), devname, in_sync,
+                          coverage, list_keys, prefixes)
+
+
+class _Frame(object):
+    """An open element of a snapshot.
+
+    The path includes list keys, the schema path does not; key names
+    and values are collected in list entry frames.
+    """
+    __slots__ = ("path", "spath", "has_children", "key_names", "key_vals")
+
+    def __init__(self, path, spath):
+        self.path = path
+        self.spath = spath
+        self.has_children = False
+        self.key_names = None
+        self.key_vals = None
+
+
+# Read one coverage snapshot, return False if it is not for the device;
+# with prefixes, subtrees not included by them are skipped
+def _read_snapshot(source, devname, in_sync, coverage, list_keys,
+                   prefixes=None):
+    leaf_lists = dict()
+    # Stays None if the snapshot has no configuration (empty DB ->
+    # nothing set initially or all deleted in the end)
+    stack = None
+    device = None
+    # Depth in a skipped subtree
+    skip = 0
+    for (event, e) in etree.iterparse(source, events=("start", "end")):
+        if stack is None:
+            # Not in the device configuration yet
+            if event == "end" and e.tag == NCS_NAME and device is None:
+                device = e.text
+                if devname and devname != "none":
+                    if devname == "real" and "netsim" in device:
+                        return False
+                    if devname != "real" and devname not in device:
+                        return False
+            elif event == "start" and e.tag == NCS_CONFIG:
+                stack = [_Frame("", "")]
+            continue
+        if event == "start":
+            if skip:
+                skip += 1
+                continue
+            parent = stack[-1]
+            parent.has_children = True
+            spath = parent.spath + "/" + e.tag
+            if (prefixes is not None and not prefixes.subtree(spath) and
+                    not _is_key(parent, e.tag)):
+                # List keys are needed for the entry paths
+                skip = 1
+                continue
+            stack.append(_Frame(parent.path + "/" + e.tag, spath))
+            continue
+        if skip:
+            skip -= 1
+            e.clear()
+            while e.getprevious() is not None:
+                del e.getparent()[0]
+            continue
+        frame = stack.pop()
+        if not stack:
+            # The device configuration is complete
+            break
+        if (e.text and e.text.strip() != "") or not frame.has_children:
+            _read_element(e, frame, stack[-1], in_sync, coverage,
+                          list_keys, leaf_lists)
+        # Free what has been read
+        e.clear()
+        while e.getprevious() is not None:
+            del e.getparent()[0]
+    for (p, (spath, v)) in leaf_lists.items():
+        if p not in coverage:
+            coverage[p] = _Coverage(p, spath)
+        v = ",".join(v)
+        if in_sync:
+            coverage[p].set_node(v)
+        else:
+            coverage[p].init_node(v)
+    return True
+
+
+# Whether the element is a key of the list entry parent; only the
+# nodes of subtrees being read are looked up
+def _is_key(parent, tag):
+    node = _Coverage.index.get(parent.spath)
+    if node is None or not node.is_list():
+        return False
+    return re.sub("{[^}]+}", "", tag) in node.stmt.search_one("key").arg.split(" ")
+
+
+def _read_element(e, frame, parent, in_sync, coverage, list_keys, leaf_lists):
+    path = frame.path
+    spath = frame.spath
+    if XVERBOSE:
+        print("PATH %s" % path)
+    node = _Coverage.index.get(frame.spath)
+    if not node:
+        print("NOTE: skipping unknown element: '%s' (%s)" % (compress_path(path), frame.spath))
+        return
+    if node.is_key():
+        # The parent is a list entry, expand its path with the keys
+        if not parent.key_names:
+            parent.key_names = node.get_parent().stmt.search_one("key").arg.split(" ")
+            parent.key_vals = list()
+        key_tag = re.sub("{[^}]+}", "", e.tag)
+        if not key_tag in parent.key_names:
+            raise Exception("Expected key (%s) here : %s" % (str(parent.key_names), path))
+        parent.key_vals.append(e.text.strip() if e.text else "")
+        if len(parent.key_vals) < len(parent.key_names):
+            # Skip keys in count
+            return
+        key_vals = ",".join(parent.key_vals)
+        parent.path = path = "%s[%s]" % (parent.path, key_vals)
+        spath = parent.spath
+        if XVERBOSE:
+            print("EXPANDED PATH %s" % path)
+        if parent.spath not in list_keys:
+            list_keys[parent.spath] = set()
+        list_keys[parent.spath].add(key_vals)
+        parent.key_names = None
+        parent.key_vals = None
+        # Fall through and count full list instance
+    elif node.is_leaflist():
+        # Collect leaf-lists into single value
+        if VERBOSE:
+            print("FOUND LEAFLIST: " + path)
+        if path not in leaf_lists:
+            leaf_lists[path] = (frame.spath, list())
+        leaf_lists[path][1].append(e.text)
+        return
+    # Ignore all but config
+    # Enter data
+    if path not in coverage:
+        coverage[path] = _Coverage(path, spath)
+    # First file only provides init values,
+    # and does no transitions
+    if in_sync:
+        coverage[path].set_node(e.text)
+    else:
+        coverage[path].init_node(e.text)
+
+
+# Loop for all nodes of a certain type, expanding only subtrees that
+# may contain nodes included by prefixes
+def _gen_nodes(skip_nodes, prefixes, ntype):
+    for node in _Coverage.schema.gen_nodes(ntype=ntype, prune=prefixes.pruned):
+        p = node.get_path()
+        if p not in skip_nodes and prefixes.includes(p):
+            yield node
+
+
+class _Prefixes(object):
+    """Paths and path prefixes to include and exclude.
+
+    As with common.path_in_prefixes, a path matches a prefix if it
+    starts with it, with or without namespaces.
+    """
+    ALL = ((), ())
+
+    def __init__(self, include, exclude):
+        self.include = include
+        self.exclude = exclude
+        self.subtrees = {}
+
+    # Cache key of the coverage read with these prefixes
+    def key(self):
+        return (tuple(sorted(set(self.include))), tuple(sorted(set(self.exclude))))
+
+    def includes(self, path):
+        return (not common.path_in_prefixes(path, self.exclude) and
+                (not self.include or common.path_in_prefixes(path, self.include)))
+
+    # Whether any path in the subtree of path may be included
+    def subtree(self, path):
+        try:
+            return self.subtrees[path]
+        except KeyError:
+            pass
+        result = not common.path_in_prefixes(path, self.exclude)
+        if result and self.include:
+            pathnons = path
+            if path.startswith("/{"):
+                pathnons = re.sub("{[^}]+?}", "", path)
+            result = any(p.startswith(q + "/") or q.startswith(p)
+                         for p in self.include for q in (path, pathnons))
+        self.subtrees[path] = result
+        return result
+
+    def pruned(self, path):
+        return not self.subtree(path)
 
 
 def _not_separately_deletable(node):
@@ -677,9 +1170,13 @@ Calculate coverage of test-runs"""
         optparse.make_option("-a", "--all",
                              help="output all untested paths in each category",
                              action="store_true"),
+        optparse.make_option("-j", "--jobs", type="int",
+                             help="number of sessions to analyze in parallel"),
+        optparse.make_option("-s", "--state", action="append", dest="states",
+                             help="show the nodes set or deleted by states matching the pattern ('*' for all states)"),
         ]
     optparser = optparse.OptionParser(usage, add_help_option = True)
     optparser.add_options(optlist)
     (o, args) = optparser.parse_args()
 
-    test_coverage(None, args, o.all, o.devname)
+    test_coverage(None, args, o.all, o.devname, jobs=o.jobs, states=o.states)
@@ -1,5 +1,8 @@
 import datetime
+import difflib
 import filecmp
+import gzip
+import hashlib
 import inspect
 import os
 import sys
@@ -8,7 +11,6 @@ import pytest
 import re
 import shutil
 import common.test_common as common
-import subprocess
 import tempfile
 import time
 from lxml import etree
@@ -22,6 +24,12 @@ Commit performed by .* via .* using .*
 
 pxargs = {"encoding": "utf-8"} if sys.version_info >= (3, 0) else {}
 
+# Index of the snapshots in a coverage session, one line per snapshot
+# in order, with the snapshot hash and the states loaded before it
+COVERAGE_INDEX = "snapshots.txt"
+# Compressed snapshots of all sessions, stored once by content hash
+COVERAGE_OBJECTS = "drned-work/coverage/objects"
+
 
 class Device(object):
     """The abstraction of a NCS/NED device.
@@ -41,6 +49,7 @@ class Device(object):
         self.failed_states = []
         self.rollback_id = None
         self.rollback_xml = {}
+        self.covstates = []
         self.log = []
         self.name = name
         self.ned_name = None
@@ -57,6 +66,7 @@ class Device(object):
         self.use_raw_trace = True
         self.use_java_log = True
         self.use_commit_queue_retries = 2
+        self.use_maapi = False
         self.java_log_level = "level-all"
         self.extra_ned_settings = None
         # Check if NCS is started
@@ -85,7 +95,7 @@ class Device(object):
                     val = False
                 elif val == "None":
                     val = None
-            setattr(self, var, val)
+                setattr(self, var, val)
 
         # Check commit queue support
         with open("../../package-meta-data.xml") as f:
@@ -276,7 +286,7 @@ class Device(object):
         except OSError:
             pass
         p = path if path else ("devices device %s config" % self.name)
-        self.cmd("save %s %s %s" % (name, fmt, p))
+        self._save(name, fmt, p)
         return self
 
     def load(self, name, mode="merge", fail_on_errors=True, rename_device=False,
@@ -303,6 +313,7 @@ class Device(object):
             self
         """
         self.trace(INDENT + inspect.stack()[0][3] + "(" + name + ")")
+        self.covstates.append(_state_name(name))
         rm = None
         if rename_device or ancient:
             suffix = "." + name.split(".")[-1]
@@ -326,14 +337,12 @@ class Device(object):
                 mode = lmode.group(1)
 
         if xload and mode == 'override':  # broken in 5.3.2 and later - ENG-24198
-            self.cmd('no devices device {} config'.format(self.name))
+            self._delete_config()
             mode = 'merge'
         expect_not = None
         if not fail_on_errors:
             expect_not = "(ERROR|[Ee]rror|Failed|Aborted):(?! incomplete| on line| bad value)"
-        self.cmd("load %s %s%s" % (mode, name,
-                 " | best-effort" if not name.endswith(".xml")
-                                  else ""), expect_not=expect_not)
+        self._load(mode, name, expect_not=expect_not)
         if rm:
             os.remove(rm)
         return self
@@ -364,6 +373,7 @@ class Device(object):
         """
         if banner:
             self.trace(INDENT + inspect.stack()[0][3] + "(" + name + ")")
+        self.covstates.append(_state_name(name))
         rm = None
         # Get possible load options from file
         path = self.rload_path
@@ -398,19 +408,13 @@ class Device(object):
                 name = self._new_device_name(name, temp, remove=True)
                 rm = None if name == temp.name else temp.name
         if xload and mode == 'override':  # broken in 5.3.2 and later - ENG-24198
-            self.cmd('no devices device {} config'.format(self.name))
+            self._delete_config()
             mode = 'merge'
-        if set_path and path:
-            self.cmd(path)
         expect_not = None
         if not fail_on_errors:
             expect_not = "(ERROR|[Ee]rror|Failed|Aborted):(?! incomplete| on line| bad value)"
-        self.cmd("rload %s %s%s" % (mode, name,
-                 " | best-effort" if not name.endswith(".xml")
-                                  else ""), expect_not=expect_not)
-        # To top
-        if set_path:
-            self.cmd("top")
+        self._rload(mode, name, path if set_path else None,
+                    expect_not=expect_not)
         if rm:
             os.remove(rm)
         return self
@@ -455,8 +459,8 @@ class Device(object):
             self
         """
         self.trace(INDENT + inspect.stack()[0][3] + "()")
-        self.cmd("devices device %s sync-from" %
-                 self.name, expect="result true")
+        self._sync_from()
+        self.covstates.append("(sync-from)")
         xml = self._coverage()
         self._set_rollback_xml(xml)
         return self
@@ -521,8 +525,12 @@ class Device(object):
         # Compare data if there has been a rollback
         id = self.rollback_id
         self.rollback_id = None
-        if xml and id and id in self.rollback_xml and self.rollback_xml[id]:
-            with open(self.rollback_xml[id]) as before, open(xml) as after:
+        if xml and id and id in self.rollback_xml and self.rollback_xml[id] \
+           and self.rollback_xml[id] != xml:
+            # Identical snapshots are the same object, so only differing
+            # ones need to be compared
+            with gzip.open(self.rollback_xml[id], "rt") as before, \
+                 gzip.open(xml, "rt") as after:
                 # Strip annotations and empty containers
                 def content(f):
                     s = re.sub(r"<(\S+) (annotation|xmlns)=[^>]*>", r"<\1>", f.read())
@@ -535,12 +543,11 @@ class Device(object):
                     return sorted(s.split("\n"))
                 # Do a poor man's comparison of xml, sort and compare
                 if content(before) != content(after):
-                    try:
-                        out = common.check_output("diff %s %s" %
-                                                      (self.rollback_xml[id], xml))
-                    except subprocess.CalledProcessError as e:
-                        out = e.output
-                    print(out)
+                    before.seek(0)
+                    after.seek(0)
+                    print("".join(difflib.unified_diff(before.readlines(),
+                                                       after.readlines(),
+                                                       self.rollback_xml[id], xml)))
                     print("NOTE: The rollback did not restore CDB to the previous state:" +
                           " %s %s" % (self.rollback_xml[id], xml))
         # Create dry-run files
@@ -563,13 +570,13 @@ class Device(object):
 
         # The actual commit
         if no_overwrite or self.use_commit_no_overwrite:
-            self.cmd("commit no-overwrite")
+            self._commit("no-overwrite")
         elif no_networking or self.use_no_networking:
-            self.cmd("commit no-networking")
+            self._commit("no-networking")
         elif self.use_commit_queues:
-            self.cmd("commit commit-queue sync")
+            self._commit("commit-queue sync")
         else:
-            self.cmd("commit")
+            self._commit()
 
         # Check for out-of-sync in all commit incarnations
         self.saw_not("out of sync")
@@ -621,19 +628,15 @@ class Device(object):
         """
         if banner:
             self.trace(INDENT + inspect.stack()[0][3] + "()")
-        fmt = ("" if outformat is None else " outformat " + outformat)
         if fname == None:
             # Use file also when printing to console, the dry-run data
             # may contain prompt patterns
-            save = " | save overwrite drned-work/tmp-dry-run.txt"
-        else:
-            save = " | exclude \"device %s\" | save overwrite %s" % \
-                   (self.name, fname)
-        self.cmd("commit dry-run %s %s" % (fmt, save))
-        if fname == None:
+            self._dry_run(outformat, "drned-work/tmp-dry-run.txt")
             with open("drned-work/tmp-dry-run.txt", "r") as f:
                 print(f.read())
             os.remove("drned-work/tmp-dry-run.txt")
+        else:
+            self._dry_run(outformat, fname, exclude="device %s" % self.name)
         return self
 
     def rollback(self, id=-1, banner=True):
@@ -651,10 +654,12 @@ class Device(object):
         if id == -1:
             self.rollback_id = self._get_latest_rollback()
             print("NOTE: Rollback id (latest): %s" % id)
-            self.cmd("rollback configuration")
+            self._rollback()
+            self.covstates.append("(rollback)")
         elif id:
             self.rollback_id = id
-            self.cmd("rollback configuration %s" % id)
+            self._rollback(id)
+            self.covstates.append("(rollback)")
         else:
             self.rollback_id = None
             print("NOTE: No rollback since commit was empty")
@@ -689,7 +694,7 @@ class Device(object):
             return self
         if banner:
             self.trace(INDENT + inspect.stack()[0][3] + "()")
-        self.cmd("devices device %s compare-config" % self.name)
+        self._compare_config()
         self.saw_not("\ndiff")
         self.saw_compare_after_commit = True
         return self
@@ -808,6 +813,11 @@ class Device(object):
                             "for more input: '%s'\nPROMPT" % ncs_buf_raw)
         if echo:
             print(self.ncs_buf)
+        self._check_buf(expect, expect_not)
+        return self
+
+    def _check_buf(self, expect=None, expect_not=None):
+        """Check the output of the last command for errors."""
         if expect_not is not None:
             self.saw_not(expect_not)
         else:
@@ -816,7 +826,6 @@ class Device(object):
             self.saw_not("info {}: transport timeout; closing session".format(self.name))
         if expect is not None:
             self.saw(expect)
-        return self
 
     def saw(self, regex):
         """Check that expected output from the last command actually was there.
@@ -869,8 +878,7 @@ class Device(object):
     def restore(self):
         print("\n### TEARDOWN, RESTORE DEVICE ###")
         self.reset_cli()
-        self.cmd("no devices device %s config" % self.name)
-        self.cmd("top")
+        self._delete_config()
         self.load("drned-work/before-session.xml")
         self.cmd("show config")
         self.commit(no_networking=True)
@@ -904,6 +912,51 @@ class Device(object):
         #     pytest.fail("Could not restore device to state before session. " +
         #                 "Please check before-session.cfg and after-session.cfg")
 
+    # The operations on the NCS configuration; the MAAPI backend
+    # (maapi_device.MaapiDevice) performs them without the CLI
+
+    def _save(self, name, fmt, path):
+        self.cmd("save %s %s %s" % (name, fmt, path))
+
+    def _load(self, mode, name, expect_not=None):
+        self.cmd("load %s %s%s" % (mode, name,
+                 " | best-effort" if not name.endswith(".xml")
+                                  else ""), expect_not=expect_not)
+
+    def _rload(self, mode, name, path, expect_not=None):
+        if path:
+            self.cmd(path)
+        self.cmd("rload %s %s%s" % (mode, name,
+                 " | best-effort" if not name.endswith(".xml")
+                                  else ""), expect_not=expect_not)
+        # To top
+        if path is not None:
+            self.cmd("top")
+
+    def _delete_config(self):
+        self.cmd("no devices device %s config" % self.name)
+        self.cmd("top")
+
+    def _commit(self, args=""):
+        self.cmd(("commit " + args).strip())
+
+    def _dry_run(self, outformat, fname, exclude=None):
+        fmt = ("" if outformat is None else " outformat " + outformat)
+        save = " | save overwrite %s" % fname
+        if exclude is not None:
+            save = " | exclude \"%s\"%s" % (exclude, save)
+        self.cmd("commit dry-run %s %s" % (fmt, save))
+
+    def _rollback(self, id=None):
+        self.cmd("rollback configuration" + ("" if id is None else " %s" % id))
+
+    def _sync_from(self):
+        self.cmd("devices device %s sync-from" %
+                 self.name, expect="result true")
+
+    def _compare_config(self):
+        self.cmd("devices device %s compare-config" % self.name)
+
     def _set_rollback_xml(self, xml):
         rb_no = self._get_latest_rollback()
         if rb_no is not None:
@@ -922,15 +975,28 @@ class Device(object):
     def _coverage(self):
         xml = None
         if not hasattr(self, "covsession"):
+            self.covstates = []
             return xml
-        with tempfile.NamedTemporaryFile(dir="drned-work/coverage/%s" %
-                                         self.covsession,
+        covdir = "drned-work/coverage/%s" % self.covsession
+        with tempfile.NamedTemporaryFile(dir=covdir,
                                          mode="w+t",
                                          prefix=str(int(time.time() * 1000)),
                                          suffix=".xml",
                                          delete=False) as temp:
-            xml = temp.name
-            self.save(xml, fmt="xml", banner=False)
+            self.save(temp.name, fmt="xml", banner=False)
+        digest = _store_snapshot(temp.name)
+        xml = snapshot_path(digest)
+        # Record what produced the snapshot, so that the coverage can
+        # be attributed to states
+        if self.covstates:
+            states = "+".join(self.covstates)
+        elif not os.path.exists(os.path.join(covdir, COVERAGE_INDEX)):
+            states = "(init)"
+        else:
+            states = "(other)"
+        self.covstates = []
+        with open(os.path.join(covdir, COVERAGE_INDEX), "a") as index:
+            index.write("%s\t%s\n" % (digest, states))
 
         return xml
 
@@ -1004,3 +1070,42 @@ class Device(object):
             return temp.name
         # No change, use original file
         return name
+
+
+def _state_name(name):
+    """Name of the state in a state file, as used by XMNR."""
+    return re.sub(r"(\.state)?\.[^.]*$", "", os.path.basename(name))
+
+
+def snapshot_path(digest):
+    """Path of the compressed coverage snapshot with the given hash."""
+    return os.path.join(COVERAGE_OBJECTS, digest + ".xml.gz")
+
+
+def _store_snapshot(name):
+    """Move a saved coverage snapshot to the snapshot objects.
+
+    The snapshot is compressed and stored only if there is no identical
+    one yet; a missing file (nothing saved) is an empty snapshot.
+    Returns the content hash.
+    """
+    sha = hashlib.sha256()
+    if os.path.isfile(name):
+        with open(name, "rb") as f:
+            for block in iter(lambda: f.read(1 << 16), b""):
+                sha.update(block)
+    digest = sha.hexdigest()
+    path = snapshot_path(digest)
+    if not os.path.exists(path):
+        if not os.path.isdir(COVERAGE_OBJECTS):
+            os.makedirs(COVERAGE_OBJECTS)
+        with tempfile.NamedTemporaryFile(dir=COVERAGE_OBJECTS,
+                                         delete=False) as temp:
+            with gzip.GzipFile(fileobj=temp, mode="wb") as target:
+                if os.path.isfile(name):
+                    with open(name, "rb") as f:
+                        shutil.copyfileobj(f, target)
+        os.rename(temp.name, path)
+    if os.path.isfile(name):
+        os.remove(name)
+    return digest
@@ -98,6 +98,14 @@ def touch(p):
         pass
 
 
+def device_class(use):
+    # The MAAPI backend needs the NSO Python API, import it only if used
+    if use and "use_maapi=True" in use:
+        from drned.maapi_device import MaapiDevice
+        return MaapiDevice
+    return drned.Device
+
+
 dual_mode = {
     "reread":    ["", "-reread", ""],
 }
@@ -111,7 +119,7 @@ def device(request):
                     "command-line parameter")
     # Time to create device
     use = request.config.getoption("--use")
-    device = drned.Device(devname, use=use, request=request)
+    device = device_class(use)(devname, use=use, request=request)
     device.trace("\n%s\n" % request._pyfuncitem.name)
     # Save state in XML to be able to restore reliably
     device.save("drned-work/before-session.xml", fmt="xml")
@@ -133,7 +141,7 @@ def device_raw(request):
         pytest.fail("Please enter a device name using the --device " +
                     "command-line parameter")
     use = request.config.getoption("--use")
-    device = drned.Device(devname, use=use)
+    device = device_class(use)(devname, use=use)
     device.trace("\n%s\n" % request._pyfuncitem.name)
     yield device
 
@@ -0,0 +1,293 @@
+import os
+import socket
+
+import _ncs
+import ncs
+import pytest
+
+from .device import Device
+
+# MAAPI flags for the CLI load modes
+LOAD_MODES = {
+    "merge": _ncs.maapi.CONFIG_MERGE,
+    "override": _ncs.maapi.CONFIG_REPLACE,
+}
+
+# MAAPI flags for the CLI save formats
+SAVE_FORMATS = {
+    "": _ncs.maapi.CONFIG_C,
+    "xml": _ncs.maapi.CONFIG_XML_PRETTY,
+    "json": _ncs.maapi.CONFIG_JSON,
+}
+
+
+class MaapiDevice(Device):
+    """The NCS/NED device driven through MAAPI.
+
+    The device is set up through the CLI like with Device, but then
+    the configuration is saved, loaded, committed, rolled back and
+    compared in a MAAPI transaction, without the CLI round trips and
+    prompt parsing.  The output of these operations is printed in the
+    form of the corresponding CLI command output, so that tools
+    reading the DrNED output see no difference.
+
+    Use with --use use_maapi=True.  Note that configuration changes
+    done with cmd() or source() go to the CLI transaction, not to the
+    MAAPI one; tests doing that need the CLI backend.
+
+    """
+    def __init__(self, name, cli="ncs_cli -C -u admin", use=[], request=None):
+        # Until the MAAPI transaction is started, all operations go
+        # through the CLI
+        self.trans = None
+        self.keypaths = {}
+        Device.__init__(self, name, cli=cli, use=use, request=request)
+        self.use_maapi = True
+        self.maapi = ncs.maapi.Maapi()
+        self.maapi.start_user_session("admin", "drned")
+        self._new_trans()
+
+    def restore(self):
+        if self.trans is not None:
+            # Drop possible changes from a failed test
+            self._new_trans()
+        Device.restore(self)
+
+    def _new_trans(self):
+        if self.trans is not None:
+            self.trans.finish()
+        self.trans = self.maapi.start_write_trans()
+
+    def _output(self, cmdstr, lines, expect=None, expect_not=None):
+        """Record an operation as if it were a CLI command.
+
+        Args:
+            cmdstr: the equivalent CLI command
+            lines: the equivalent CLI output
+            expect: require this string to be in the output
+            expect_not: require this string to not be in the output
+        Returns:
+            nothing
+        """
+        with open("drned-work/stdin.txt", "a") as f:
+            f.write(cmdstr + "\n")
+        self.ncs_buf = "\n".join([cmdstr] + lines)
+        with open("drned-work/stdout.txt", "a") as f:
+            f.write(self.ncs_buf + "\n")
+        print(self.ncs_buf)
+        self._check_buf(expect, expect_not)
+
+    def _keypath(self, path):
+        """Get the MAAPI keypath for a CLI path.
+
+        Args:
+            path: CLI path, like "devices device <name> config"
+        Returns:
+            the keypath
+        """
+        if path not in self.keypaths:
+            _, keypath = _ncs.maapi.cli_cmd_to_path2(self.maapi.msock,
+                                                     self.trans.th, path,
+                                                     1024, 8192)
+            self.keypaths[path] = keypath
+        return self.keypaths[path]
+
+    def _device(self):
+        return ncs.maagic.get_root(self.maapi).devices.device[self.name]
+
+    def _save(self, name, fmt, path):
+        if self.trans is None:
+            return Device._save(self, name, fmt, path)
+        if fmt not in SAVE_FORMATS:
+            pytest.fail("Format \"%s\" not supported with MAAPI" % fmt)
+        cmdstr = "save %s %s %s" % (name, fmt, path)
+        try:
+            save_id = self.trans.save_config(SAVE_FORMATS[fmt],
+                                             self._keypath(path))
+            stream = socket.socket()
+            try:
+                _ncs.stream_connect(sock=stream, id=save_id, flags=0,
+                                    ip="127.0.0.1", port=_ncs.PORT)
+                with open(name, "wb") as f:
+                    for data in iter(lambda: stream.recv(1 << 16), b""):
+                        f.write(data)
+            finally:
+                stream.close()
+            _ncs.maapi.save_config_result(self.maapi.msock, save_id)
+        except _ncs.error.Error as e:
+            self._output(cmdstr, ["Error: %s" % e])
+        else:
+            self._output(cmdstr, [])
+
+    def _load(self, mode, name, expect_not=None):
+        if self.trans is None:
+            return Device._load(self, mode, name, expect_not=expect_not)
+        cmdstr = "load %s %s%s" % (mode, name,
+                                   " | best-effort" if not name.endswith(".xml")
+                                   else "")
+        self._load_config(cmdstr, mode, name, None, expect_not)
+
+    def _rload(self, mode, name, path, expect_not=None):
+        if self.trans is None:
+            return Device._rload(self, mode, name, path, expect_not=expect_not)
+        cmdstr = "rload %s %s%s" % (mode, name,
+                                    " | best-effort" if not name.endswith(".xml")
+                                    else "")
+        # Without a path, rload works at the device configuration
+        keypath = self._keypath(path if path else self.rload_path)
+        self._load_config(cmdstr, mode, name, keypath, expect_not)
+
+    def _load_config(self, cmdstr, mode, name, keypath, expect_not):
+        if mode not in LOAD_MODES:
+            pytest.fail("Load mode \"%s\" not supported with MAAPI" % mode)
+        flags = LOAD_MODES[mode]
+        if name.endswith(".xml"):
+            flags |= _ncs.maapi.CONFIG_XML
+        else:
+            flags |= _ncs.maapi.CONFIG_C | _ncs.maapi.CONFIG_CONTINUE_ON_ERROR
+        try:
+            if keypath is None:
+                # NSO opens the file, a relative name would be resolved in its directory
+                self.trans.load_config(flags, os.path.abspath(name))
+            else:
+                with open(name) as f:
+                    self.trans.load_config_cmds(flags, f.read(), keypath)
+        except _ncs.error.Error as e:
+            self._output(cmdstr, ["Error: %s" % e], expect_not=expect_not)
+        else:
+            self._output(cmdstr, [], expect_not=expect_not)
+
+    def _delete_config(self):
+        if self.trans is None:
+            return Device._delete_config(self)
+        path = "devices device %s config" % self.name
+        try:
+            self.trans.delete(self._keypath(path))
+        except _ncs.error.Error as e:
+            self._output("no " + path, ["Error: %s" % e])
+        else:
+            self._output("no " + path, [])
+
+    def _commit(self, args=""):
+        if self.trans is None:
+            return Device._commit(self, args)
+        cmdstr = ("commit " + args).strip()
+        params = self.trans.get_params()
+        if args == "no-overwrite":
+            params.no_overwrite()
+        elif args == "no-networking":
+            params.no_networking()
+        elif args == "commit-queue sync":
+            params.commit_queue_sync()
+        latest_rollback = self._get_latest_rollback()
+        try:
+            result = self.trans.apply_params(True, params)
+        except _ncs.error.Error as e:
+            # Keep the transaction like the CLI does, restore() drops it
+            self._output(cmdstr, ["Aborted: %s" % e])
+            return
+        self._new_trans()
+        if self._get_latest_rollback() == latest_rollback:
+            lines = ["% No modifications to commit."]
+        elif result and "status" in result:
+            lines = ["commit-queue {",
+                     "    id %s" % result.get("id"),
+                     "    status %s" % result["status"],
+                     "}",
+                     "Commit complete."]
+        else:
+            lines = ["Commit complete."]
+        self._output(cmdstr, lines)
+
+    def _dry_run(self, outformat, fname, exclude=None):
+        if self.trans is None:
+            return Device._dry_run(self, outformat, fname, exclude=exclude)
+        outformat = "cli" if outformat is None else outformat
+        params = self.trans.get_params()
+        if outformat == "native":
+            params.dry_run_native()
+        elif outformat == "xml":
+            params.dry_run_xml()
+        else:
+            params.dry_run_cli()
+        cmdstr = "commit dry-run outformat %s" % outformat
+        try:
+            result = self.trans.apply_params(True, params)
+        except _ncs.error.Error as e:
+            self._output(cmdstr, ["Aborted: %s" % e])
+            return
+        lines = _dry_run_lines(outformat, result)
+        with open(fname, "w") as f:
+            for line in lines:
+                if exclude is None or exclude not in line:
+                    f.write(line + "\n")
+        self._output(cmdstr, [] if lines else ["% No modifications to commit."])
+
+    def _rollback(self, id=None):
+        if self.trans is None:
+            return Device._rollback(self, id)
+        cmdstr = "rollback configuration" + ("" if id is None else " %s" % id)
+        try:
+            if id is None:
+                _ncs.maapi.load_rollback(self.maapi.msock, self.trans.th, 0)
+            else:
+                _ncs.maapi.load_rollback_fixed(self.maapi.msock, self.trans.th,
+                                               int(id))
+        except _ncs.error.Error as e:
+            self._output(cmdstr, ["Error: %s" % e])
+        else:
+            self._output(cmdstr, [])
+
+    def _sync_from(self):
+        if self.trans is None:
+            return Device._sync_from(self)
+        result = self._device().sync_from()
+        lines = ["result %s" % ("true" if result.result else "false")]
+        if result.info:
+            lines.append("info %s" % result.info)
+        # Read the new configuration in a new transaction
+        self._new_trans()
+        self._output("devices device %s sync-from" % self.name, lines,
+                     expect="result true")
+
+    def _compare_config(self):
+        if self.trans is None:
+            return Device._compare_config(self)
+        result = self._device().compare_config()
+        lines = []
+        if getattr(result, "info", None):
+            lines.append("info %s" % result.info)
+        if result.diff:
+            lines.extend(("diff \n" + result.diff).splitlines())
+        self._output("devices device %s compare-config" % self.name, lines)
+
+
+def _dry_run_lines(outformat, result):
+    """Format a dry-run result the way the CLI does.
+
+    Args:
+        outformat: the dry-run format
+        result: the dry-run result from apply_params()
+    Returns:
+        list of output lines, empty if there are no changes
+    """
+    lines = []
+    if outformat == "native":
+        for name, data in sorted(result.get("device", {}).items()):
+            lines.append("    device {")
+            lines.append("        name %s" % name)
+            lines.extend(_data_lines(data))
+            lines.append("    }")
+    elif result.get("local-node"):
+        lines.append("    local-node {")
+        lines.extend(_data_lines(result["local-node"]))
+        lines.append("    }")
+    if not lines:
+        return []
+    return ["%s {" % outformat] + lines + ["}"]
+
+
+def _data_lines(data):
+    lines = data.rstrip("\n").split("\n")
+    return (["        data %s" % lines[0]] +
+            ["             %s" % line for line in lines[1:]])
@@ -2,10 +2,14 @@ import os
 import re
 import sys
 import pyang
+import pickle
+import hashlib
+import tempfile
 import itertools
-from pyang import statements, repository, context
+import threading
+from pyang import statements, repository, context, types
 
-from .node import drned_node
+from .node import drned_node, _stmt_get_path
 
 
 class Match(object):
@@ -17,6 +21,19 @@ class Match(object):
         return None is self.ntype or ntype in self.ntype
 
 
+_XSDPattern = getattr(types, "XSDPattern", ())
+
+# Validated schemas are cached here, if the DrNED work directory exists
+SCHEMA_CACHE_DIR = "drned-work/schema-cache"
+SCHEMA_CACHE_VERSION = 3
+# Schema statements are deeply nested and refer to each other, so
+# (un)pickling them needs a higher recursion limit; it is done in a
+# thread with a stack big enough for that limit, a schema nested even
+# deeper is just not cached
+SCHEMA_CACHE_RECURSION_LIMIT = 50000
+SCHEMA_CACHE_STACK_SIZE = 256 * 1024 * 1024
+
+
 class Schema(object):
     def __init__(self, name, map_list=[], yangpath=""):
         self.defined_maps = ["avoid_map", "leaf_map", "pattern_map",
@@ -25,7 +42,8 @@ class Schema(object):
         for map_name,map_def in map_list:
             self.replace_map(map_name, map_def)
         self.node_map = {}
-        self.missing_map = {}
+        # Built on the first get_node() miss
+        self.path_index = None
 
         path = os.getenv("NCS_DIR") + "/src/confd/yang"
         if not os.path.exists(path):
@@ -34,13 +52,19 @@ class Schema(object):
             if type(yangpath) is list:
                 yangpath = ':'.join(yangpath)
             path = yangpath + ":" + path
-        repos = repository.FileRepository(path)
-        ctx = context.Context(repos)
         # String or list?
         if hasattr(name, "lower"):
             filenames = [name]
         else:
             filenames = name
+        cache = None
+        if len(filenames) > 0 and os.path.isdir(os.path.dirname(SCHEMA_CACHE_DIR)):
+            cache = _cache_filename(filenames, path)
+            if self.load_cache(cache):
+                return
+
+        repos = repository.FileRepository(path)
+        ctx = context.Context(repos)
         modules = []
 
         if len(filenames) == 0:
@@ -51,8 +75,8 @@ class Schema(object):
 
         r = re.compile(r"^(.*?)(\@(\d{4}-\d{2}-\d{2}))?\.(yang|yin)$")
         for filename in filenames:
-            fd = open(filename)
-            text = fd.read()
+            with open(filename) as fd:
+                text = fd.read()
             # Submodules should be ignored
             if "belongs-to" in text:
                 continue
@@ -76,6 +100,106 @@ class Schema(object):
         for module in self.modules:
             self.groupings.update(module.i_groupings)
 
+        if cache is not None:
+            self.store_cache(cache, ctx)
+
+    def build_index(self, prune=None):
+        """Index schema nodes by path.
+
+        Nodes are registered with their paths both with and without
+        choice and case names; if more nodes share a path, the first
+        one in schema order wins, as node_map entries do.  With prune
+        (see gen_nodes), only the nodes that are not pruned and the
+        keys of their lists are indexed, the rest of the schema is not
+        expanded.
+
+        Returns:
+            the index as {path: node}
+        """
+        index = {}
+        for node in self.gen_nodes(prune=prune):
+            index.setdefault(node.path, node)
+            index.setdefault(_stmt_get_path(node.stmt, raw=True), node)
+            if prune is not None and node.is_list():
+                for key in getattr(node.stmt, "i_key", None) or []:
+                    key = drned_node(self, key)
+                    index.setdefault(key.path, key)
+        if prune is None:
+            index.update(self.node_map)
+        else:
+            for path in index:
+                if path in self.node_map:
+                    index[path] = self.node_map[path]
+        return index
+
+    def load_cache(self, cache):
+        """Load a schema stored by store_cache(), if it is still valid.
+
+        The cache is keyed by the YANG files and the pyang version; it
+        also records all imported modules, which must not have changed
+        either.
+        """
+        try:
+            with open(cache, "rb") as fd:
+                unpickler = pickle.Unpickler(fd)
+                unpickler.persistent_load = self._persistent_load
+                state = _deep_call(unpickler.load)
+        except Exception:
+            return False
+        for filename, digest in state["dependencies"].items():
+            try:
+                if _file_digest(filename) != digest:
+                    return False
+            except IOError:
+                return False
+        if state.get("version") != SCHEMA_CACHE_VERSION:
+            return False
+        self.namespace = state["namespace"]
+        self.modules = state["modules"]
+        self.groupings = state["groupings"]
+        self.node_map = state["node_map"]
+        return True
+
+    def store_cache(self, cache, ctx):
+        dependencies = {}
+        for module in ctx.modules.values():
+            filename = module.pos.ref
+            if os.path.isfile(filename):
+                dependencies[filename] = _file_digest(filename)
+        state = {"version": SCHEMA_CACHE_VERSION,
+                 "dependencies": dependencies,
+                 "namespace": getattr(self, "namespace", None),
+                 "modules": self.modules,
+                 "groupings": self.groupings,
+                 "node_map": self.node_map}
+        if not os.path.isdir(SCHEMA_CACHE_DIR):
+            os.makedirs(SCHEMA_CACHE_DIR)
+        fd = tempfile.NamedTemporaryFile(dir=SCHEMA_CACHE_DIR, delete=False)
+        try:
+            with fd:
+                pickler = pickle.Pickler(fd, pickle.HIGHEST_PROTOCOL)
+                pickler.persistent_id = self._persistent_id
+                _deep_call(pickler.dump, state)
+            os.rename(fd.name, cache)
+        except Exception:
+            # The cache is only an optimization
+            os.remove(fd.name)
+
+    # Nodes refer to their schema, which must not be pickled with them;
+    # compiled patterns cannot be pickled at all and are recompiled
+    def _persistent_id(self, obj):
+        if obj is self:
+            return "schema"
+        if isinstance(obj, _XSDPattern):
+            return ("pattern", obj.spec, obj.pos, obj.invert_match)
+        return None
+
+    def _persistent_load(self, pid):
+        if pid == "schema":
+            return self
+        _kind, spec, pos, invert_match = pid
+        return _XSDPattern(spec, pos, invert_match)
+
     def append_map(self, map_name, map_def):
         assert map_name in self.defined_maps
         self.maps[map_name].update(map_def)
@@ -103,17 +227,19 @@ class Schema(object):
 
     def get_node(self, path):
         try:
-            if path in self.missing_map:
-                return None
             return self.node_map[path]
         except KeyError:
-            for leaf in self.gen_nodes():
-                if path == leaf.path:
-                    return leaf
-            self.missing_map[path] = True
-            return None
+            if self.path_index is None:
+                self.path_index = self.build_index()
+            return self.path_index.get(path)
 
-    def gen_nodes(self, root=None, ntype=None):
+    def gen_nodes(self, root=None, ntype=None, prune=None):
+        """Generate schema nodes in schema order.
+
+        If prune is given, it is called with the data path of each
+        schema statement; the subtrees of statements for which it
+        returns true are skipped.
+        """
         match = Match(root=root, ntype=ntype)
         if match.root == None:
             path = None
@@ -129,16 +255,16 @@ class Schema(object):
                 chs = [ch for ch in chs if ch.arg == path[0]]
                 path = path[1:]
             if len(chs) > 0:
-                for y in _gen_children(chs, path):
+                for y in _gen_children(chs, path, prune):
                     if match.equals(ntype=y.keyword):
                         yield drned_node(self, y)
 
-        for augment in module.search("augment"):
-            if (hasattr(augment.i_target_node, "i_module") and
-               augment.i_target_node.i_module not in self.modules):
-                for y in _gen_children(augment.i_children, path):
-                    if match.equals(ntype=y.keyword):
-                        yield drned_node(self, y)
+            for augment in module.search("augment"):
+                if (hasattr(augment.i_target_node, "i_module") and
+                   augment.i_target_node.i_module not in self.modules):
+                    for y in _gen_children(augment.i_children, path, prune):
+                        if match.equals(ntype=y.keyword):
+                            yield drned_node(self, y)
 
     def list_nodes(self, root=None, ntype=None):
         return [node for node in itertools
@@ -154,13 +280,67 @@ class Schema(object):
         return prev
 
 
-def _gen_children(i_children, path):
+def _file_digest(filename):
+    with open(filename, "rb") as fd:
+        return hashlib.sha256(fd.read()).hexdigest()
+
+
+def _cache_filename(filenames, path):
+    key = hashlib.sha256()
+    key.update(("%s\0%s\0%s\0" % (pyang.__version__, sys.version, path))
+               .encode())
+    for filename in filenames:
+        key.update(("%s\0%s\0" % (os.path.abspath(filename),
+                                    _file_digest(filename))).encode())
+    return os.path.join(SCHEMA_CACHE_DIR, key.hexdigest() + ".pickle")
+
+
+class _recursion_limit(object):
+    def __enter__(self):
+        self.limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(self.limit, SCHEMA_CACHE_RECURSION_LIMIT))
+
+    def __exit__(self, *args):
+        sys.setrecursionlimit(self.limit)
+
+
+def _deep_call(fun, *args):
+    """Call fun in a thread with a big stack and a raised recursion limit.
+
+    Too deep recursion raises RecursionError instead of overflowing the
+    C stack of the main thread.
+    """
+    result = {}
+
+    def run():
+        try:
+            with _recursion_limit():
+                result["value"] = fun(*args)
+        except BaseException as e:
+            result["error"] = e
+    # Fails if the platform does not allow that size, the caller then
+    # does without the cache
+    size = threading.stack_size(SCHEMA_CACHE_STACK_SIZE)
+    try:
+        thread = threading.Thread(target=run)
+        thread.start()
+    finally:
+        threading.stack_size(size)
+    thread.join()
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
+
+
+def _gen_children(i_children, path, prune=None):
     for ch in i_children:
-        for y in _gen_node(ch, path):
+        for y in _gen_node(ch, path, prune):
             yield y
 
 
-def _gen_node(s, path):
+def _gen_node(s, path, prune=None):
+    if prune is not None and prune(_stmt_get_path(s)):
+        return
     yield s
     if hasattr(s, "i_children"):
         chs = s.i_children
@@ -168,5 +348,5 @@ def _gen_node(s, path):
             chs = [ch for ch in chs
                    if ch.arg == path[0]]
             path = path[1:]
-        for y in _gen_children(chs, path):
+        for y in _gen_children(chs, path, prune):
             yield y
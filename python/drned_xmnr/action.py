@@ -39,6 +39,8 @@ class ActionHandler(dp.Action):
         ns.ns.drned_xmnr_import_state_files_: config_op.ImportStateFiles,
         ns.ns.drned_xmnr_import_convert_cli_files_: config_op.ImportConvertCliFiles,
         ns.ns.drned_xmnr_check_states_: config_op.CheckStates,
+        ns.ns.drned_xmnr_select_states_: config_op.SelectStatesOp,
+        ns.ns.drned_xmnr_index_states_: config_op.IndexStatesOp,
         ns.ns.drned_xmnr_transition_to_state_: transitions_op.TransitionToStateOp,
         ns.ns.drned_xmnr_explore_transitions_: transitions_op.ExploreTransitionsOp,
         ns.ns.drned_xmnr_walk_states_: transitions_op.WalkTransitionsOp,
@@ -101,6 +103,8 @@ class ActionHandler(dp.Action):
             output.success = result['success']
         if 'failure' in result:
             output.failure = result['failure']
+        if 'state-name' in result:
+            output.state_name = result['state-name']
 
 
 class CompletionHandler(dp.Action):
@@ -154,9 +158,16 @@ class XmnrDataHandler(application.Service):
         ctx = self._state['ctx']
         self.log = log or self._state['log']
         dcb = experimental.DataCallbacks(self.log)
+        coverage_data = '/ncs:devices/ncs:device/drned-xmnr:drned-xmnr/drned-xmnr:coverage/drned-xmnr:data'
+        dcb.register(coverage_data + '/drned-xmnr:uncovered/drned-xmnr:node',
+                     coverage_op.UncoveredNodesProvider(self.log))
+        dcb.register(coverage_data + '/drned-xmnr:uncovered',
+                     coverage_op.UncoveredProvider(self.log))
         dcb.register('/ncs:devices/ncs:device', coverage_op.DataHandler(self.log))
         _ncs.dp.register_data_cb(ctx, ns.ns.callpoint_coverage_data, dcb)
         scb = experimental.DataCallbacks(self.log)
+        scb.register('/ncs:devices/ncs:device/drned-xmnr:drned-xmnr/drned-xmnr:state/drned-xmnr:states',
+                     config_op.StatesListProvider(self.log))
         scb.register('/ncs:devices/ncs:device/drned-xmnr:drned-xmnr/drned-xmnr:state',
                      config_op.StatesProvider(self.log))
         _ncs.dp.register_data_cb(ctx, ns.ns.callpoint_xmnr_states, scb)
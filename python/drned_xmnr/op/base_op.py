@@ -3,10 +3,12 @@ import os
 import sys
 import select
 import glob
+import fnmatch
 import socket
 import subprocess
 import threading
 import signal
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
 from contextlib import closing, contextmanager
 
@@ -19,8 +21,9 @@ from ncs import maapi, maagic
 from drned_xmnr.namespaces.drned_xmnr_ns import ns
 
 from .ex import ActionError
+from .state_store import StateStore
 
-from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple, Type, TypeVar, TextIO
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Type, TypeVar, TextIO
 from drned_xmnr.typing_xmnr import ActionResult, Tctx
 from ncs.log import Log
 from ncs.maagic import Node
@@ -29,6 +32,9 @@ from ncs.maapi import Transaction
 ReturnCode = int
 ProcessResult = Tuple[ReturnCode, str]
 
+SAVE_CONFIG_BUFSIZE = 1 << 18
+'''Receive buffer size used when streaming configuration from NSO.'''
+
 
 def maapi_keyless_create(node: Node, i: int) -> Node:
     if _ncs.LIB_VSN < 0x07060000:
@@ -106,8 +112,6 @@ class CliLogger(object):
 class XmnrBase(object):
     xml_statefile_extension = '.state.xml'
     cfg_statefile_extension = '.state.cfg'
-    metadata_extension = '.load'
-    flag_file_extension = '.disabled'
     xml_extensions = [xml_statefile_extension, '.xml']
     cfg_extensions = [cfg_statefile_extension, '.cfg']
 
@@ -123,7 +127,12 @@ class XmnrBase(object):
         self.dev_test_dir = os.path.join(self.xmnr_directory, self.dev_name, 'test')
         self.drned_run_directory = os.path.join(self.dev_test_dir, 'drned-skeleton')
         self.using_builtin_drned = root.drned_xmnr.drned_directory == "builtin"
+        self.drned_backend = str(root.drned_xmnr.drned_backend)
+        self.worker_threads: int = root.drned_xmnr.worker_threads
         self.states_dir = os.path.join(self.dev_test_dir, 'states')
+        self.state_store = StateStore(self.states_dir,
+                                      str(root.drned_xmnr.state_storage) == 'compressed',
+                                      root.drned_xmnr.materialized_states)
         device_node = root.devices.device[self.dev_name]
         self.device_timeout = device_node.read_timeout
         if self.device_timeout is None:
@@ -134,6 +143,7 @@ class XmnrBase(object):
             os.makedirs(self.states_dir)
         except OSError:
             pass
+        self.state_store.import_sidecars()
 
     def format_state_filename(self, statename: str, format: str = 'xml',
                               suffix: Optional[str] = None) -> str:
@@ -151,7 +161,7 @@ class XmnrBase(object):
             suffixes += self.cfg_extensions
         for suffix in suffixes:
             path = self.format_state_filename(statename, suffix=suffix)
-            if os.path.exists(path):
+            if self.state_store.exists(path):
                 return path
         return None
 
@@ -185,18 +195,57 @@ class XmnrBase(object):
         return self.get_state_files_by_pattern('*')
 
     def get_disabled_state_files(self) -> List[str]:
+        disabled = self.state_store.disabled_names()
         return [filename for filename in self.get_state_files()
-                if os.path.exists(filename + self.flag_file_extension)]
+                if os.path.basename(filename) in disabled]
 
     def is_state_disabled(self, state: str) -> bool:
-        return os.path.exists(self.state_name_to_filename(state) + self.flag_file_extension)
+        return (os.path.basename(self.state_name_to_filename(state))
+                in self.state_store.disabled_names())
+
+    _states_snapshots: Dict[str, Tuple[int, List[Tuple[str, bool]]]] = {}
+    _states_snapshots_lock = threading.Lock()
+
+    def get_states_snapshot(self) -> List[Tuple[str, bool]]:
+        """Sorted list of (state name, disabled) pairs.
+
+        The list is built from a single directory listing and kept
+        until the modification time of the states directory changes,
+        so that repeated reads of the states list (e.g. paging through
+        it in the CLI) do not need to glob and stat all the files
+        again.
+        """
+        mtime = os.stat(self.states_dir).st_mtime_ns + self.state_store.manifest_mtime()
+        with XmnrBase._states_snapshots_lock:
+            cached = XmnrBase._states_snapshots.get(self.states_dir)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        manifest = self.state_store.read_manifest()
+        disabled = self.state_store.disabled_names(manifest)
+        names = set(name for name in os.listdir(self.states_dir) if not name.startswith('.'))
+        names.update(self.state_store.packed_names(manifest))
+        xmls = [name for name in names if name.endswith('.xml')]
+        cfgs = [name for name in names if name.endswith('.cfg') and name[:-3] + 'xml' not in names]
+        snapshot = sorted((self.state_filename_to_name(name), name in disabled)
+                          for name in xmls + cfgs)
+        with XmnrBase._states_snapshots_lock:
+            XmnrBase._states_snapshots[self.states_dir] = (mtime, snapshot)
+        return snapshot
+
+    def states_changed(self) -> None:
+        """Drop the states snapshot after a change done by XMNR itself."""
+        with XmnrBase._states_snapshots_lock:
+            XmnrBase._states_snapshots.pop(self.states_dir, None)
 
     def get_state_files_by_pattern(self, pattern: str) -> List[str]:
         files: Dict[str, Set[str]] = {}
+        packed = self.state_store.packed_names()
         for suff in ['.xml', '.cfg']:
             files[suff] = set()
             for part in ['.state', '']:
                 files[suff].update(glob.glob(os.path.join(self.states_dir, pattern + part + suff)))
+                files[suff].update(os.path.join(self.states_dir, name)
+                                   for name in fnmatch.filter(packed, pattern + part + suff))
         return list(files['.xml']) + [cfg for cfg in files['.cfg']
                                       if (cfg[:-3] + 'xml') not in files['.xml']]
 
@@ -207,20 +256,22 @@ class Progressor(object):
     Progress messages come in chunks and need to be re-chunked into
     lines.  This class is not directly related to The Noon Universe.
     """
-    def __init__(self, action: 'ActionBase') -> None:
+    def __init__(self, action: 'ActionBase',
+                 report: Optional[Callable[[str], None]] = None) -> None:
         self.buf = ""
-        self.action = action
+        self.report = action.progress_msg if report is None else report
 
     def progress(self, chunk: str) -> None:
         lines = chunk.split('\n')
         lines[0] = self.buf + lines[0]
         for line in lines[:-1]:
-            self.action.progress_msg(line)
+            self.report(line)
         self.buf = lines[-1]
 
 
 ParamType = TypeVar('ParamType', str, int, None)
 T = TypeVar('T')
+R = TypeVar('R')
 
 
 class ActionBase(XmnrBase):
@@ -233,7 +284,7 @@ class ActionBase(XmnrBase):
     def __init__(self, uinfo: _ncs.UserInfo, dev_name: str, params: Node, log_obj: Log) -> None:
         super(ActionBase, self).__init__(dev_name, log_obj)
         self.uinfo = uinfo
-        self.drned_process: Optional[subprocess.Popen[bytes]] = None
+        self.drned_processes: List[subprocess.Popen[bytes]] = []
         self.aborted: bool = False
         self.abort_lock = threading.Lock()
         self.log_file: Optional[TextIO] = None
@@ -286,49 +337,80 @@ class ActionBase(XmnrBase):
             mp = maapi.Maapi()
             return callback(mp.attach(self.uinfo.actx_thandle))
 
+    def run_parallel(self, callback: Callable[[T], R], items: Iterable[T]) -> List[R]:
+        '''Call `callback` for all items on a pool of worker threads.
+
+        Results are returned in the order of `items`; the first
+        exception raised by a callback is re-raised.
+        '''
+        with ThreadPoolExecutor(max_workers=self.worker_threads) as pool:
+            return list(pool.map(callback, items))
+
     def extend_timeout(self) -> None:
         '''Tell NSO to wait a bit longer.  See also `TIMEOUT_MARGIN`.
         '''
         extension = self.device_timeout + 2 * TIMEOUT_MARGIN
         dp.action_set_timeout(self.uinfo, extension)
 
-    def proc_run(self, outputfun: Callable[[str], None]) -> ProcessResult:
-        if self.drned_process is None:
-            raise ActionError("Missing DrNED process")
-        if self.drned_process.stdout is None:
-            raise ActionError("DrNED process missing stdout")
-        fd = self.drned_process.stdout.fileno()
-        fl = fcntl.fcntl(fd, fcntl.F_GETFL)
-        fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
-
-        stdoutdata = ""
-        timeout = self.device_timeout
-        while self.drned_process.poll() is None:
-            rlist, wlist, xlist = select.select([fd], [], [fd], timeout + TIMEOUT_MARGIN)
-            if rlist:
-                buf = self.drned_process.stdout.read()
-                if buf is not None and len(buf) != 0:
-                    data = buf.decode()
-                    self.log.debug("run_outputfun, output len=" + str(len(data)))
-                    outputfun(data)
-                    self.extend_timeout()
-                    stdoutdata += data
-            else:
-                self.progress_msg("Silence timeout, terminating process")
-                self.terminate_drned_process()
-
-        self.log.debug("run_finished, output len=" + str(len(stdoutdata)))
-        return self.drned_process.wait(), stdoutdata
+    def start_process(self, args: List[str], env: Dict[str, str]) -> 'subprocess.Popen[bytes]':
+        """Start a process in the DrNED running directory.
+
+        The process needs to be handed over to `proc_run`; until then,
+        it is terminated if the action is aborted.
+        """
+        with self.abort_lock:
+            if self.aborted:
+                raise ActionError("action aborted")
+            process = subprocess.Popen(args,
+                                       env=env,
+                                       cwd=self.drned_run_directory,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+            self.drned_processes.append(process)
+        return process
+
+    def proc_run(self, outputfun: Callable[[str], None],
+                 process: 'subprocess.Popen[bytes]') -> ProcessResult:
+        try:
+            if process.stdout is None:
+                raise ActionError("DrNED process missing stdout")
+            fd = process.stdout.fileno()
+            fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+
+            stdoutdata = ""
+            timeout = self.device_timeout
+            while process.poll() is None:
+                rlist, wlist, xlist = select.select([fd], [], [fd], timeout + TIMEOUT_MARGIN)
+                if rlist:
+                    buf = process.stdout.read()
+                    if buf is not None and len(buf) != 0:
+                        data = buf.decode()
+                        self.log.debug("run_outputfun, output len=" + str(len(data)))
+                        outputfun(data)
+                        self.extend_timeout()
+                        stdoutdata += data
+                else:
+                    self.progress_msg("Silence timeout, terminating process")
+                    self.terminate_process(process)
+
+            self.log.debug("run_finished, output len=" + str(len(stdoutdata)))
+            return process.wait(), stdoutdata
+        finally:
+            with self.abort_lock:
+                self.drned_processes.remove(process)
 
     def terminate_drned_process(self) -> None:
-        if self.drned_process is None:
-            return
+        for process in self.drned_processes:
+            self.terminate_process(process)
+
+    def terminate_process(self, process: 'subprocess.Popen[bytes]') -> None:
         try:
-            self.drned_process.send_signal(signal.SIGINT)
-            self.drned_process.wait(self.cleanup_timeout)
+            process.send_signal(signal.SIGINT)
+            process.wait(self.cleanup_timeout)
         except subprocess.TimeoutExpired:
             self.log.debug("process not responding to SIGINT - killing instead")
-            self.drned_process.kill()
+            process.kill()
 
     def cli_write(self, msg: str) -> int:
         if not self.aborted:
@@ -410,10 +492,10 @@ class ActionBase(XmnrBase):
         trans.maapi.install_crypto_keys()
         return username, _ncs.decrypt(upwd)
 
-    def get_devcli_params(self, trans: Transaction) \
+    def get_devcli_params(self, trans: Transaction, device: Optional[str] = None) \
             -> Tuple[str, Optional[str], Optional[str], str, int]:
         root = maagic.get_root(trans)
-        device_node = root.devices.device[self.dev_name]
+        device_node = root.devices.device[self.dev_name if device is None else device]
         ip = device_node.address
         port = device_node.drned_xmnr.cli_port
         if port is None:
@@ -431,11 +513,21 @@ class ActionBase(XmnrBase):
         user, passwd = self.get_authgroup_info(trans, root, locuser, authmap)
         return driver, user, passwd, ip, port
 
-    def devcli_run(self, script: str, script_args: List[str]) -> ProcessResult:
-        driver, username, passwd, ip, port = self.run_with_trans(self.get_devcli_params)
+    def devcli_run(self, script: str, script_args: List[str], device: Optional[str] = None,
+                   progress: Optional[Callable[[str], None]] = None) -> ProcessResult:
+        """Run a devcli script against the device (or another device
+        given as `device`).
+
+        :param progress: called for every line of the script output
+            instead of `progress_msg`
+        """
+        if device is None:
+            device = self.dev_name
+        driver, username, passwd, ip, port = \
+            self.run_with_trans(lambda trans: self.get_devcli_params(trans, device))
         runner = os.environ.get('PYTHON_RUNNER', 'python')
         runner_args = runner.split()
-        args = runner_args + [script, '--devname', self.dev_name,
+        args = runner_args + [script, '--devname', device,
                               '--driver', driver,
                               '--ip', ip, '--port', str(port),
                               '--workdir', 'drned-ncs', '--timeout', str(self.device_timeout)]
@@ -444,29 +536,22 @@ class ActionBase(XmnrBase):
             if passwd is not None:
                 args.extend(['--password', passwd])
         args.extend(script_args)
-        return self.run_in_drned_env(args)
+        return self.run_in_drned_env(args, progress=progress)
 
-    def run_in_drned_env(self, args: List[str], **envdict: str) -> ProcessResult:
+    def run_in_drned_env(self, args: List[str],
+                         progress: Optional[Callable[[str], None]] = None,
+                         **envdict: str) -> ProcessResult:
         env = self.run_with_trans(self.setup_drned_env)
         env.update(envdict)
         self.log.debug("using env {0}\n".format(env))
         self.log.debug("running", args)
         try:
-            with self.abort_lock:
-                if self.aborted:
-                    raise ActionError("action aborted")
-                self.drned_process = subprocess.Popen(args,
-                                                      env=env,
-                                                      cwd=self.drned_run_directory,
-                                                      stdout=subprocess.PIPE,
-                                                      stderr=subprocess.STDOUT)
+            process = self.start_process(args, env)
             self.log.debug("run_in_drned_env, going in")
-            return self.proc_run(Progressor(self).progress)
+            return self.proc_run(Progressor(self, progress).progress, process)
         except OSError:
             msg = 'PyTest not installed or DrNED running directory ({0}) not set up'
             raise ActionError(msg.format(self.drned_run_directory))
-        finally:
-            self.drned_process = None
 
     def save_config(self, trans: Transaction, config_type: int, path: str) -> Iterator[bytes]:
         save_id = trans.save_config(config_type, path)
@@ -478,12 +563,14 @@ class ActionBase(XmnrBase):
                 flags=0,
                 ip='127.0.0.1',
                 port=_ncs.PORT)
+            size = 0
             while True:
-                config_data = ssocket.recv(4096)
+                config_data = ssocket.recv(SAVE_CONFIG_BUFSIZE)
                 if not config_data:
+                    self.log.debug("save_config done, {} bytes".format(size))
                     return
+                size += len(config_data)
                 yield config_data
-                self.log.debug("Data: " + str(config_data))
         finally:
             ssocket.close()
 
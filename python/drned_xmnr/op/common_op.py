@@ -212,7 +212,7 @@ class Handler:
     def get_object(self, tctx: Tctx, kp: str, args: Dict[str, Any]) -> Dict[str, Any]:
         ...
 
-    # NOTE - method not implemented currently in drned-xmnr
+    # NOTE - implemented only by list handlers (see config_op.StatesListProvider)
     # @abstractmethod
     # def get_next(self, tctx: Tctx, kp: str, args: Dict[str, Any], next: NextType) -> Optional[NextType]:
     #     ...
@@ -1,18 +1,28 @@
 import os
 import re
+import bisect
+import fnmatch
 import glob
+import json
+import hashlib
 import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import ExitStack
 from lxml import etree
 
 import _ncs
 from drned_xmnr.namespaces.drned_xmnr_ns import ns
 
 from . import base_op
+from . import state_store
 from .ex import ActionError
 from .common_op import DevcliLogMatch, Handler
 
-from typing import Any, Dict, List, Optional, Set, Tuple
-from drned_xmnr.typing_xmnr import ActionResult, Tctx
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, cast
+from drned_xmnr.typing_xmnr import ActionField, ActionResult, Tctx
+from ncs import maagic
 from ncs.log import Log
 from ncs.maagic import Node
 from ncs.maapi import Transaction
@@ -24,19 +34,159 @@ state_metadata = """\
 mode = override
 """
 
+CONFD_NS = 'http://tail-f.com/ns/config/1.0'
+NCS_NS = 'http://tail-f.com/ns/ncs'
+NCS_CONFIG = '{{{}}}config'.format(NCS_NS)
+
+STREAMING_IMPORT_SIZE = 1 << 23
+"""XML files at least this large are imported with a streaming parser."""
+
+# schema node path and whether it is a list with multiple entries
+CoverageItem = Tuple[str, bool]
+
+IMPORT_XSLT = '''\
+<xsl:stylesheet xmlns:xsl="http://www.w3.org/1999/XSL/Transform" version="1.0">
+  <xsl:output method="xml" indent="yes" omit-xml-declaration="yes"/>
+  <xsl:strip-space elements="*"/>
+  <xsl:param name="device_name"/>
+  <xsl:template match="/">
+      <config xmlns="http://tail-f.com/ns/config/1.0">
+        <devices xmlns="http://tail-f.com/ns/ncs">
+          <device>
+            <name><xsl:value-of select="$device_name"/></name>
+            <config>
+              <xsl:apply-templates select="@*|node()"/>
+            </config>
+          </device>
+        </devices>
+      </config>
+  </xsl:template>
+  <xsl:template match="@*|node()">
+    <xsl:copy>
+      <xsl:apply-templates select="@*|node()"/>
+    </xsl:copy>
+  </xsl:template>
+  <!-- If in the XML file, omit the confd config tag from the results -->
+  <xsl:template match="*[local-name()='config' and
+                         namespace-uri()='http://tail-f.com/ns/config/1.0']">
+    <xsl:apply-templates select="@*|node()"/>
+  </xsl:template>
+</xsl:stylesheet>'''
+
+_import_xslt = threading.local()
+
+
+def import_xslt() -> etree.XSLT:
+    """The XSLT transform wrapping XML configuration into NSO device
+    configuration, compiled on first use in each thread.
+
+    An XSLT object must not be applied in several threads at once, so
+    every thread has its own.
+    """
+    transform: Optional[etree.XSLT] = getattr(_import_xslt, 'transform', None)
+    if transform is None:
+        transform = _import_xslt.transform = etree.XSLT(etree.XML(IMPORT_XSLT))
+    return transform
+
+
+def stream_device_config(source: str, target: str, device_name: str, wrap: bool) -> None:
+    """Copy XML configuration from `source` to `target` without keeping
+    more than a single branch of the document in memory.
+
+    If `wrap` is set, the configuration is wrapped into NSO device
+    configuration the same way the import XSLT does it (a ConfD
+    `config` root element is dropped); otherwise, the content is
+    expected to be NSO device configuration already, and the name of
+    the first device is replaced.
+    """
+    ncs_device = etree.QName(NCS_NS, 'device').text
+    ncs_name = etree.QName(NCS_NS, 'name').text
+    confd_config = etree.QName(CONFD_NS, 'config').text
+    renamed = False
+    dropped_root = None
+    # stack items: element, its open `xmlfile` element context (if any)
+    stack: List[Tuple[Any, Optional[Any]]] = []
+    with open(source, 'rb') as infile, open(target, 'wb') as outfile, \
+            etree.xmlfile(outfile, encoding='utf-8') as xf, ExitStack() as wrapper:
+        if wrap:
+            wrapper.enter_context(xf.element(confd_config, nsmap={None: CONFD_NS}))
+            wrapper.enter_context(xf.element(etree.QName(NCS_NS, 'devices').text,
+                                             nsmap={None: NCS_NS}))
+            wrapper.enter_context(xf.element(ncs_device))
+            with xf.element(ncs_name):
+                xf.write(device_name)
+            wrapper.enter_context(xf.element(etree.QName(NCS_NS, 'config').text))
+        for event, elem in etree.iterparse(infile, events=('start', 'end'),
+                                           remove_comments=True, remove_pis=True):
+            if event == 'start':
+                if not stack and wrap and elem.tag == confd_config:
+                    dropped_root = elem
+                elif stack and stack[-1][1] is None and stack[-1][0] is not dropped_root:
+                    # the parent has children, it needs to be opened now
+                    parent, _ = stack.pop()
+                    stack.append((parent, open_element(xf, parent, dropped_root)))
+                stack.append((elem, None))
+                continue
+            _, context = stack.pop()
+            if context is not None:
+                context.__exit__(None, None, None)
+            elif elem is not dropped_root:
+                if (not wrap and not renamed and elem.tag == ncs_name
+                        and stack and stack[-1][0].tag == ncs_device):
+                    elem.text = device_name
+                    renamed = True
+                open_element(xf, elem, dropped_root).__exit__(None, None, None)
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+
+def open_element(xf: Any, elem: Any, dropped_root: Any) -> Any:
+    """Start writing `elem` (without its children) to an `xmlfile`.
+
+    Only namespace declarations not inherited from an already written
+    parent are repeated.
+    """
+    parent = elem.getparent()
+    inherited = {} if parent is None or parent is dropped_root else parent.nsmap
+    nsmap = {prefix: uri for prefix, uri in elem.nsmap.items()
+             if inherited.get(prefix) != uri}
+    context = xf.element(elem.tag, attrib=dict(elem.attrib), nsmap=nsmap)
+    context.__enter__()
+    if elem.text is not None and elem.text.strip():
+        xf.write(elem.text)
+    return context
+
 
 class ConfigOp(base_op.ActionBase):
-    def write_metadata(self, state_filename: str) -> None:
-        with open(state_filename + self.metadata_extension, 'w') as meta:
-            meta.write(state_metadata)
+    def store_state(self, state_filename: str, digest: Optional[str] = None) -> None:
+        """Hand a newly written state file over to the state store."""
+        self.state_store.add(state_filename, load=state_metadata, digest=digest)
+        self.states_changed()
 
     def remove_state_file(self, state_filename: str) -> None:
-        os.remove(state_filename)
-        for suffix in (self.metadata_extension, self.flag_file_extension):
+        self.state_store.remove(state_filename)
+        for suffix in (state_store.LOAD_EXTENSION, state_store.DISABLED_EXTENSION):
             try:
                 os.remove(state_filename + suffix)
             except OSError:
                 pass
+        self.states_changed()
+
+    def ned_version(self, trans: Transaction) -> str:
+        """Identify the device NED by its ned-id and package version."""
+        root = maagic.get_root(trans)
+        devtype = root.devices.device[self.dev_name].device_type
+        ned_id = str(getattr(getattr(devtype, str(devtype.ne_type), None), 'ned_id', None))
+        for package in root.packages.package:
+            try:
+                for component in package.component:
+                    for ned_type in ('cli', 'generic', 'netconf', 'snmp'):
+                        if str(getattr(getattr(component.ned, ned_type), 'ned_id', None)) == ned_id:
+                            return '{}/{}'.format(ned_id, package.package_version)
+            except AttributeError:
+                continue
+        return ned_id
 
 
 class StateParamOp(ConfigOp):
@@ -77,13 +227,12 @@ class DisableStateOp(StateParamOp):
     def perform(self) -> ActionResult:
         self.log.debug('disable state with device {}'.format(self.dev_name))
         state_filenames = self.get_state_filenames()
-        for state_filename in state_filenames:
-            flag_filename = state_filename + self.flag_file_extension
-            try:
-                with open(flag_filename, 'w'):
-                    pass
-            except OSError:
-                return {'failure': 'Failed to mark {} as disabled'.format(state_filename)}
+        try:
+            self.state_store.set_disabled(state_filenames, True)
+        except OSError:
+            return {'failure': 'Failed to mark {} as disabled'.format(', '.join(state_filenames))}
+        finally:
+            self.states_changed()
         return {'success': 'Disabled: ' + ', '.join(self.state_filename_to_name(filename)
                                                     for filename in state_filenames)}
 
@@ -94,13 +243,12 @@ class EnableStateOp(StateParamOp):
     def perform(self) -> ActionResult:
         self.log.debug('enable state with device {}'.format(self.dev_name))
         state_filenames = self.get_state_filenames()
-        for state_filename in state_filenames:
-            flag_filename = state_filename + self.flag_file_extension
-            try:
-                if os.path.exists(flag_filename):
-                    os.unlink(flag_filename)
-            except OSError:
-                return {'failure': 'Failed to mark {} as enabled'.format(state_filename)}
+        try:
+            self.state_store.set_disabled(state_filenames, False)
+        except OSError:
+            return {'failure': 'Failed to mark {} as enabled'.format(', '.join(state_filenames))}
+        finally:
+            self.states_changed()
         return {'success': 'Enabled: ' + ', '.join(self.state_filename_to_name(filename)
                                                    for filename in state_filenames)}
 
@@ -109,18 +257,29 @@ class ListStatesOp(ConfigOp):
     action_name = 'list states'
 
     def _init_params(self, params: Node) -> None:
-        pass
+        self.state_name_pattern = self.param_default(params, 'state_name_pattern', None)
+        self.offset = int(self.param_default(params, 'offset', 0))
+        self.limit: Optional[int] = self.param_default(params, 'limit', None)
 
     def perform(self) -> ActionResult:
         self.log.debug("config_list_states() with device {0}".format(self.dev_name))
-        state_files = self.get_state_files()
-        disabled_files = self.get_disabled_state_files()
-        if disabled_files:
-            disabled_states = [self.state_filename_to_name(st) for st in disabled_files]
+        snapshot = self.get_states_snapshot()
+        if self.state_name_pattern is not None:
+            snapshot = [(state, disabled) for (state, disabled) in snapshot
+                        if fnmatch.fnmatchcase(state, self.state_name_pattern)]
+        end = None if self.limit is None else self.offset + int(self.limit)
+        page = snapshot[self.offset:end]
+        disabled_states = [state for (state, disabled) in page if disabled]
+        if disabled_states:
             disabled_msg = ' disabled states: ' + str(disabled_states)
         else:
             disabled_msg = ''
-        states = [self.state_filename_to_name(st) for st in state_files]
+        if page == [] and snapshot != []:
+            disabled_msg += ' (no states at offset {} of {})'.format(self.offset, len(snapshot))
+        elif len(page) < len(snapshot):
+            disabled_msg += ' (states {}-{} of {})'.format(
+                self.offset + 1, self.offset + len(page), len(snapshot))
+        states = [state for (state, _) in page]
         return {'success': "Saved device states: {}{}".format(states, disabled_msg)}
 
 
@@ -138,8 +297,8 @@ class ViewStateOp(ConfigOp):
         if state_filename is None:
             return failed_result
         try:
-            with open(state_filename, 'r') as f:
-                state_str = f.read()
+            with self.state_store.open(state_filename) as f:
+                state_str = f.read().decode()
                 return {'success': state_str}
         except OSError:
             return failed_result
@@ -153,61 +312,105 @@ class RecordStateOp(ConfigOp):
         self.include_rollbacks = self.param_default(params, "including_rollbacks", 0)
         self.style_format = self.param_default(params, "format", "c-style")
         self.overwrite = params.overwrite
+        self.skip_identical = self.param_default(params, "skip_identical", False)
 
     def perform(self) -> ActionResult:
-        return self.run_with_trans(self._perform, write=True)
-
-    def _perform(self, trans: Transaction) -> ActionResult:
         self.log.debug("config_record_state() with device {0}".format(self.dev_name))
-        state_name = self.state_name
         self.log.debug("incl_rollbacks=" + str(self.include_rollbacks))
         self.log.debug("style_format=" + str(self.style_format))
+        rollbacks = self.run_with_trans(self.list_rollbacks)
+        self.log.debug("rollbacks=" + str([r.fixed_nr for r in rollbacks]))
+        format = 'xml' if 'nso-xml' == str(self.style_format) else 'cfg'
+        targets = []
+        for index, rb in enumerate([None] + rollbacks):
+            state_name_index = self.state_name
+            if index > 0:
+                state_name_index = self.state_name + "-" + str(index)
+            if self.state_name_to_existing_filename(state_name_index) is not None \
+                    and not self.overwrite:
+                raise ActionError("state {} already exists".format(state_name_index))
+            targets.append((self.format_state_filename(state_name_index, format=format), rb))
+        # every rollback is loaded to its own transaction, so they can
+        # be recorded in parallel; the configurations are first saved
+        # to temporary files
+        jobs = []
+        try:
+            for filename, rb in targets:
+                fd, tmpname = tempfile.mkstemp(dir=self.states_dir,
+                                               prefix='.' + os.path.basename(filename))
+                os.close(fd)
+                jobs.append((filename, tmpname, rb))
+            digests = self.run_parallel(lambda job: self.run_with_trans(
+                lambda trans: self.record_state(trans, *job), write=True), jobs)
+            identical = self.state_digests(format) if self.skip_identical else {}
+            recorded = []
+            skipped = []
+            for (filename, tmpname, _), digest in zip(jobs, digests):
+                state = self.state_filename_to_name(filename)
+                if digest in identical:
+                    skipped.append((state, identical[digest]))
+                    continue
+                existing_filename = self.state_name_to_existing_filename(state)
+                if existing_filename is not None:
+                    self.remove_state_file(existing_filename)
+                os.replace(tmpname, filename)
+                self.store_state(filename, digest)
+                recorded.append(state)
+                if self.skip_identical:
+                    identical.setdefault(digest, state)
+        finally:
+            for _, tmpname, _ in jobs:
+                if os.path.exists(tmpname):
+                    os.remove(tmpname)
+        msg = "Recorded states " + str(recorded)
+        if skipped:
+            msg += "; identical to existing states: " + ", ".join(
+                "{} = {}".format(state, existing) for state, existing in skipped)
+        main_state = skipped[0][1] if skipped and skipped[0][0] == self.state_name \
+            else self.state_name
+        return {'success': msg, 'state-name': main_state}
+
+    def state_digests(self, format: str) -> Dict[str, str]:
+        """Map content hashes of states of the given format to state names."""
+        extension = self.xml_statefile_extension if format == 'xml' \
+            else self.cfg_statefile_extension
+        filenames = sorted(filename for filename in self.get_state_files()
+                           if filename.endswith(extension))
+        digests: Dict[str, str] = {}
+        for filename, digest in self.state_store.digests(filenames).items():
+            digests.setdefault(digest, self.state_filename_to_name(filename))
+        return digests
+
+    def list_rollbacks(self, trans: Transaction) -> List[Any]:
         try:
             # list_rollbacks() returns one less rollback than the second argument,
             # i.e. send 2 to get 1 rollback. Therefore the +1
-            rollbacks = _ncs.maapi.list_rollbacks(trans.maapi.msock, int(self.include_rollbacks) + 1)
             # rollbacks are returned 'most recent first', i.e. reverse chronological order
+            return list(_ncs.maapi.list_rollbacks(trans.maapi.msock, int(self.include_rollbacks) + 1))
         except _ncs.error.Error:
-            rollbacks = []
-        self.log.debug("rollbacks=" + str([r.fixed_nr for r in rollbacks]))
-        index = 0
-        state_filenames = []
-        for rb in [None] + rollbacks:
-            if rb is None:
-                self.log.debug("Recording current transaction state")
-            else:
-                self.log.debug("Recording rollback" + str(rb.fixed_nr))
-                self.log.debug("Recording rollback" + str(rb.nr))
-                trans.load_rollback(rb.nr)
-
-            state_name_index = state_name
-            if index > 0:
-                state_name_index = state_name + "-" + str(index)
-            format = 'xml' if 'nso-xml' == str(self.style_format) else 'cfg'
-            existing_filename = self.state_name_to_existing_filename(state_name_index)
-            if existing_filename is not None:
-                if not self.overwrite:
-                    raise ActionError("state {} already exists".format(state_name_index))
-                self.remove_state_file(existing_filename)
-            state_filename = self.format_state_filename(state_name_index, format=format)
-            device_path = "/ncs:devices/device{" + self.dev_name + "}/config"
-            config_type = _ncs.maapi.CONFIG_C
-            if format == 'xml':
-                config_type = _ncs.maapi.CONFIG_XML
-            with open(state_filename, "wb") as state_file:
-                save_data = self.save_config(trans, config_type, device_path)
-                if format == 'xml':
-                    # just pretty_print it
-                    tree = etree.fromstringlist(save_data)
-                    state_file.write(etree.tostring(tree, pretty_print=True))
-                else:
-                    for data in save_data:
-                        state_file.write(data)
-            self.write_metadata(state_filename)
-            state_filenames += [state_name_index]
-            index += 1
-            trans.revert()
-        return {'success': "Recorded states " + str(state_filenames)}
+            return []
+
+    def record_state(self, trans: Transaction, state_filename: str, tmpname: str,
+                     rb: Any) -> str:
+        """Save the configuration for `state_filename` to the temporary
+        file; return the hash of the content.
+        """
+        if rb is None:
+            self.log.debug("Recording current transaction state")
+        else:
+            self.log.debug("Recording rollback" + str(rb.fixed_nr))
+            self.log.debug("Recording rollback" + str(rb.nr))
+            trans.load_rollback(rb.nr)
+        device_path = "/ncs:devices/device{" + self.dev_name + "}/config"
+        config_type = _ncs.maapi.CONFIG_C
+        if state_filename.endswith(self.xml_statefile_extension):
+            config_type = _ncs.maapi.CONFIG_XML_PRETTY
+        sha = hashlib.sha256()
+        with open(tmpname, "wb") as state_file:
+            for data in self.save_config(trans, config_type, device_path):
+                sha.update(data)
+                state_file.write(data)
+        return sha.hexdigest()
 
 
 class ImportOp(ConfigOp):
@@ -250,92 +453,98 @@ class ImportStateFiles(ImportOp):
 
     def perform(self) -> ActionResult:
         filenames, states, conflicts = self.verify_filenames()
-        for (source, target) in zip(filenames, states):
-            if target in conflicts and self.overwrite:
-                # TODO: the conflicts should be removed only after
-                # everything else have been done; but that's
-                # difficult...
-                cf_filename = self.state_name_to_existing_filename(target)
-                self.remove_state_file(cf_filename)
-            try:
-                self.import_file(source, target)
-            except etree.XMLSyntaxError:
-                msg = ('the file {} does not appear to be valid XML, '
-                       'perhaps you wanted c-style format instead?').format(source)
-                raise ActionError(msg)
-            except _ncs.error.Error as err:
-                msg = ('the file {} could not be loaded; '
-                       'try a different import format (error: {})')
-                raise ActionError(msg.format(source, str(err).replace("\n", " ")))
-
-        return {"success": "Imported states: " + ", ".join(states)}
+        jobs = [(source, target) for (source, target) in zip(filenames, states)
+                if self.overwrite or target not in conflicts]
+        if not jobs:
+            return {'success': 'No new states to import'}
+        self.conflicts = conflicts
+        self.progress_lock = threading.Lock()
+        self.done = 0
+        self.total = len(jobs)
+        results = self.run_parallel(self.import_job, jobs)
+        imported = [target for (_, target), error in zip(jobs, results) if error is None]
+        failures = [error for error in results if error is not None]
+        if failures:
+            result: Dict[ActionField, str] = {'failure': 'failed to import: ' + '\n'.join(failures)}
+            if imported:
+                result['success'] = "Imported states: " + ", ".join(imported)
+            return result
+        return {"success": "Imported states: " + ", ".join(imported)}
+
+    def import_job(self, job: Tuple[str, str]) -> Optional[str]:
+        """Import one file; return an error message on failure."""
+        source, target = job
+        error = None
+        try:
+            self.import_file(source, target)
+        except etree.XMLSyntaxError:
+            error = ('the file {} does not appear to be valid XML, '
+                     'perhaps you wanted c-style format instead?').format(source)
+        except _ncs.error.Error as err:
+            msg = ('the file {} could not be loaded; '
+                   'try a different import format (error: {})')
+            error = msg.format(source, str(err).replace("\n", " "))
+        with self.progress_lock:
+            self.done += 1
+            status = 'imported' if error is None else 'failed to import'
+            self.progress_msg('{} {} ({}/{})'.format(status, target, self.done, self.total))
+        return error
 
     def import_file(self, source_file: str, state: str) -> None:
-        tmpfile1 = "/tmp/" + os.path.basename(source_file) + ".tmp1"
-        tmpfile2 = "/tmp/" + os.path.basename(source_file) + ".tmp2"
-        if self.file_format == "c-style":
-            with open(tmpfile1, "w+") as outfile:
-                outfile.write("devices device " + self.dev_name + " config\n")
-                with open(source_file, "r") as infile:
-                    for line in infile:
-                        outfile.write(line)
-        elif self.file_format == "xml":
-            self.run_xslt(tmpfile1, source_file)
-        elif self.file_format == "nso-xml":
-            config = etree.parse(source_file)
-            devname = config.xpath('//ns:device/ns:name',
-                                   namespaces={'ns': 'http://tail-f.com/ns/ncs'})
-            devname[0].text = self.dev_name
-            config.write(tmpfile1)
-        else:
-            devrx = re.compile('devices device \\S+')
-            fixline = 'devices device {}'.format(self.dev_name)
-            with open(tmpfile1, 'w+') as output:
-                with open(source_file) as source:
-                    for line in source:
-                        output.write(devrx.sub(fixline, line))
-        self.run_with_trans(lambda trans: self.run_create_state(trans, tmpfile1, tmpfile2),
-                            write=True)
-        os.remove(tmpfile1)
-        format = 'cfg' if self.state_format == 'c-style' else 'xml'
-        filename = self.format_state_filename(state, format=format)
-        shutil.move(tmpfile2, filename)
-        self.write_metadata(filename)
+        # every file is converted in its own scratch directory, so
+        # that the files can be processed in parallel
+        with tempfile.TemporaryDirectory(prefix='xmnr-import-') as scratch:
+            tmpfile1 = os.path.join(scratch, os.path.basename(source_file) + ".tmp1")
+            tmpfile2 = os.path.join(scratch, os.path.basename(source_file) + ".tmp2")
+            if self.file_format == "c-style":
+                with open(tmpfile1, "w+") as outfile:
+                    outfile.write("devices device " + self.dev_name + " config\n")
+                    with open(source_file, "r") as infile:
+                        for line in infile:
+                            outfile.write(line)
+            elif self.file_format == "xml":
+                self.run_xslt(tmpfile1, source_file)
+            elif self.file_format == "nso-xml":
+                self.rename_device(tmpfile1, source_file)
+            else:
+                devrx = re.compile('devices device \\S+')
+                fixline = 'devices device {}'.format(self.dev_name)
+                with open(tmpfile1, 'w+') as output:
+                    with open(source_file) as source:
+                        for line in source:
+                            output.write(devrx.sub(fixline, line))
+            self.run_with_trans(lambda trans: self.run_create_state(trans, tmpfile1, tmpfile2),
+                                write=True)
+            if state in self.conflicts:
+                # only now, when the new state is ready
+                cf_filename = self.state_name_to_existing_filename(state)
+                if cf_filename is not None:
+                    self.remove_state_file(cf_filename)
+            format = 'cfg' if self.state_format == 'c-style' else 'xml'
+            filename = self.format_state_filename(state, format=format)
+            shutil.move(tmpfile2, filename)
+        self.store_state(filename)
 
     def run_xslt(self, nso_xml_file: str, xml_file: str) -> None:
-        xslt_root = etree.XML('''\
-        <xsl:stylesheet xmlns:xsl="http://www.w3.org/1999/XSL/Transform" version="1.0">
-          <xsl:output method="xml" indent="yes" omit-xml-declaration="yes"/>
-          <xsl:strip-space elements="*"/>
-          <xsl:param name="device_name"/>
-          <xsl:template match="/">
-              <config xmlns="http://tail-f.com/ns/config/1.0">
-                <devices xmlns="http://tail-f.com/ns/ncs">
-                  <device>
-                    <name><xsl:value-of select="$device_name"/></name>
-                    <config>
-                      <xsl:apply-templates select="@*|node()"/>
-                    </config>
-                  </device>
-                </devices>
-              </config>
-          </xsl:template>
-          <xsl:template match="@*|node()">
-            <xsl:copy>
-              <xsl:apply-templates select="@*|node()"/>
-            </xsl:copy>
-          </xsl:template>
-          <!-- If in the XML file, omit the confd config tag from the results -->
-          <xsl:template match="*[local-name()='config' and
-                                 namespace-uri()='http://tail-f.com/ns/config/1.0']">
-            <xsl:apply-templates select="@*|node()"/>
-          </xsl:template>
-        </xsl:stylesheet>''')
-        tree = etree.parse(xml_file)
-        transform = etree.XSLT(xslt_root)
-        nso_xml = transform(tree, device_name=etree.XSLT.strparam(self.dev_name))
-        with open(nso_xml_file, "w+") as outfile:
-            nso_xml.write(outfile.name)
+        if os.path.getsize(xml_file) >= STREAMING_IMPORT_SIZE:
+            stream_device_config(xml_file, nso_xml_file, self.dev_name, wrap=True)
+            return
+        with open(xml_file, 'rb') as infile:
+            tree = etree.parse(infile)
+        nso_xml = import_xslt()(tree, device_name=etree.XSLT.strparam(self.dev_name))
+        with open(nso_xml_file, 'wb') as outfile:
+            nso_xml.write(outfile)
+
+    def rename_device(self, nso_xml_file: str, xml_file: str) -> None:
+        if os.path.getsize(xml_file) >= STREAMING_IMPORT_SIZE:
+            stream_device_config(xml_file, nso_xml_file, self.dev_name, wrap=False)
+            return
+        with open(xml_file, 'rb') as infile:
+            config = etree.parse(infile)
+        devname = config.xpath('//ns:device/ns:name', namespaces={'ns': NCS_NS})
+        devname[0].text = self.dev_name
+        with open(nso_xml_file, 'wb') as outfile:
+            config.write(outfile)
 
     def run_create_state(self, trans: Transaction, source_file: str, state_file: str) -> None:
         dev_config = "/ncs:devices/device{{{}}}/config".format(self.dev_name)
@@ -361,11 +570,14 @@ class ConvertMatch(DevcliLogMatch):
         r')$')
     matchrx = re.compile(matchexpr)
 
-    def __init__(self, converter: 'ImportConvertCliFiles') -> None:
+    def __init__(self, converter: 'ImportConvertCliFiles', device: str) -> None:
         super(ConvertMatch, self).__init__()
         self.failures: List[str] = []
         self.waitstate = None
         self.converter = converter
+        self.device = device
+        # exit code of the conversion process
+        self.result = 0
 
     def match(self, msg: str) -> Optional[str]:
         report = super(ConvertMatch, self).match(msg)
@@ -378,7 +590,7 @@ class ConvertMatch(DevcliLogMatch):
         if match.lastgroup == 'convert':
             return 'importing state ' + gd['cnvstate']
         elif match.lastgroup == 'converted':
-            self.converter.complete_import(gd['target'], gd['donestate'])
+            self.converter.complete_import(gd['target'], gd['donestate'], self.device)
             return None
         elif match.lastgroup == 'failure':
             group = gd['group']
@@ -397,13 +609,29 @@ class ConvertMatch(DevcliLogMatch):
 
 
 class ImportConvertCliFiles(ImportOp):
+    """Convert CLI configuration files using the device and import them.
+
+    The files are converted in groups (files `name:index.ext` with the
+    same `name`); a group is converted as a whole on one device.  If
+    other device instances are given, the groups are distributed among
+    the instances and converted on all of them in parallel.
+    """
     action_name = 'convert and import CLI states'
 
     NC_WORKDIR = 'drned-ncs'
+    grouprx = re.compile(r'[^:.]*')
 
     def __init__(self, *args: Any) -> None:
         super(ImportConvertCliFiles, self).__init__(*args)
-        self.filter: ConvertMatch = ConvertMatch(self)
+        self.filter: ConvertMatch = ConvertMatch(self, self.dev_name)
+        self.filter_lock = threading.Lock()
+
+    def _init_params(self, params: Node) -> None:
+        super(ImportConvertCliFiles, self)._init_params(params)
+        instances = self.param_default(params, 'device_instances', None)
+        self.devices = [self.dev_name]
+        if instances is not None:
+            self.devices += [str(device) for device in instances if device != self.dev_name]
 
     def cli_filter(self, msg: str) -> None:
         report = self.filter.match(msg)
@@ -419,29 +647,62 @@ class ImportConvertCliFiles(ImportOp):
             states = [state for state in states if state not in conflicts]
 
         files = [os.path.realpath(filename) for filename in filenames]
-        result, _ = self.devcli_run('cli2netconf.py', files)
-        if self.filter.devcli_error is not None:
-            raise ActionError('Problems with the device driver: ' + self.filter.devcli_error)
-        if result != 0 and not self.filter.failures:
-            if self.filter.waitstate is not None:
-                err = 'Conversion failed, ' \
-                    'the device driver hung in state "{}"'.format(self.filter.waitstate)
-            else:
-                err = 'Conversion failed; the device driver is not working correctly'
-            raise ActionError(err)
-        if self.filter.failures:
+        jobs = self.partition(files)
+        filters = self.run_parallel(self.convert_job, jobs)
+        for conv_filter in filters:
+            if conv_filter.devcli_error is not None:
+                raise ActionError('Problems with the device driver: ' + conv_filter.devcli_error)
+        failures = [failure for conv_filter in filters for failure in conv_filter.failures]
+        for conv_filter in filters:
+            if conv_filter.result != 0 and not failures:
+                if conv_filter.waitstate is not None:
+                    err = 'Conversion failed, ' \
+                        'the device driver hung in state "{}"'.format(conv_filter.waitstate)
+                else:
+                    err = 'Conversion failed; the device driver is not working correctly'
+                raise ActionError(err)
+        if failures:
             raise ActionError(
-                'failed to convert configuration(s): ' + ', '.join(
-                    self.filter.failures))
+                'failed to convert configuration(s): ' + ', '.join(failures))
         return {"success": "Imported states: " + ", ".join(sorted(states))}
 
-    def complete_import(self, filename: str, state: str) -> None:
+    def partition(self, files: List[str]) -> List[Tuple[str, List[str]]]:
+        """Distribute file groups among the devices, largest groups first."""
+        groups: Dict[str, List[str]] = {}
+        for filename in files:
+            match = self.grouprx.match(os.path.basename(filename))
+            groups.setdefault('' if match is None else match.group(), []).append(filename)
+        jobs: List[Tuple[str, List[str]]] = [(device, []) for device in self.devices]
+        for group in sorted(groups.values(), key=len, reverse=True):
+            min(jobs, key=lambda job: len(job[1]))[1].extend(group)
+        return [job for job in jobs if job[1]]
+
+    def convert_job(self, job: Tuple[str, List[str]]) -> ConvertMatch:
+        device, files = job
+        conv_filter = ConvertMatch(self, device)
+        conv_filter.result, _ = self.devcli_run('cli2netconf.py', files, device=device,
+                                                progress=lambda msg: self.convert_progress(
+                                                    conv_filter, msg))
+        return conv_filter
+
+    def convert_progress(self, conv_filter: ConvertMatch, msg: str) -> None:
+        """Process an output line of one of the conversion processes."""
+        with self.filter_lock:
+            self.filter = conv_filter
+            self.progress_msg(msg)
+
+    def complete_import(self, filename: str, state: str, device: str) -> None:
         xml = os.path.splitext(os.path.basename(filename))[0] + '.xml'
         source = os.path.join(self.drned_run_directory, self.NC_WORKDIR, xml)
         if os.path.exists(source):
             target = self.format_state_filename(state)
-            shutil.move(source, target)
-            self.write_metadata(target)
+            if device == self.dev_name:
+                shutil.move(source, target)
+            else:
+                # converted on another device instance
+                stream_device_config(source, target, self.dev_name, wrap=False)
+                os.remove(source)
+            self.store_state(target)
         elif not self.filter.failures:
             # this should not be the case - if the source does not
             # exist, it means that the conversion has not
@@ -451,7 +712,15 @@ class ImportConvertCliFiles(ImportOp):
 
 
 class CheckStates(ConfigOp):
+    """Check all states by loading them to a transaction.
+
+    The states are checked in parallel.  Results are cached, the cache
+    key is the content hash of the state, the NED (its ned-id and
+    package version) and the `validate` flag; so only new or changed
+    states need to be loaded when the action is repeated.
+    """
     action_name = 'check states'
+    cache_name = 'check-states-cache.json'
 
     def _init_params(self, params: Node) -> None:
         self.validate: bool = params.validate
@@ -459,20 +728,44 @@ class CheckStates(ConfigOp):
     def perform(self) -> ActionResult:
         states = self.get_states()
         self.log.debug('checking states: {}'.format(states))
-        failures = []
-        for filename in [self.state_name_to_filename(state) for state in states]:
-            try:
-                self.run_with_trans(lambda trans: self.test_filename_load(trans, filename),
-                                    write=True)
-            except _ncs.error.Error as err:
-                failures.append("\n{}: {}".format(self.state_filename_to_name(filename),
-                                                  str(err).replace("\n", " ")))
+        filenames = [self.state_name_to_filename(state) for state in states]
+        manifest = self.state_store.read_manifest()
+        ned = self.run_with_trans(self.ned_version)
+        keys = ['{} {} {}'.format(self.state_store.digest(filename, manifest), ned, self.validate)
+                for filename in filenames]
+        digests = {key.split()[0] for key in keys}
+        # drop results for states that are gone or changed
+        results = {key: error for key, error in self.read_cache().items()
+                   if key.split()[0] in digests}
+        jobs = [(filename, key) for filename, key in zip(filenames, keys) if key not in results]
+        self.log.debug('{} states checked before, {} to check'.format(
+            len(filenames) - len(jobs), len(jobs)))
+        # the materialized files of a batch have to stay around while
+        # the batch is checked
+        batch_size = max(self.worker_threads, self.state_store.cache_size)
+        for start in range(0, len(jobs), batch_size):
+            batch = jobs[start:start + batch_size]
+            self.state_store.materialize(filename for filename, _ in batch)
+            errors = self.run_parallel(self.check_job, [filename for filename, _ in batch])
+            results.update((key, error) for (_, key), error in zip(batch, errors))
+            self.write_cache(results)
+        failures = ["\n{}: {}".format(self.state_filename_to_name(filename), results[key])
+                    for filename, key in zip(filenames, keys) if results[key] is not None]
         if failures == []:
             return {'success': 'all states are consistent'}
         else:
             msg = 'states not consistent with the device model: {}'
             return {'failure': msg.format(''.join(failures))}
 
+    def check_job(self, filename: str) -> Optional[str]:
+        """Check one state file; return the error message if it fails."""
+        try:
+            self.run_with_trans(lambda trans: self.test_filename_load(trans, filename),
+                                write=True)
+        except _ncs.error.Error as err:
+            return str(err).replace("\n", " ")
+        return None
+
     def test_filename_load(self, trans: Transaction, filename: str) -> None:
         flag = (_ncs.maapi.CONFIG_C if filename.endswith(self.cfg_statefile_extension)
                 else _ncs.maapi.CONFIG_XML)
@@ -480,6 +773,248 @@ class CheckStates(ConfigOp):
         if self.validate:
             trans.validate(True)
 
+    def read_cache(self) -> Dict[str, Optional[str]]:
+        try:
+            with open(os.path.join(self.dev_test_dir, self.cache_name)) as cache:
+                return cast(Dict[str, Optional[str]], json.load(cache))
+        except (OSError, ValueError):
+            return {}
+
+    def write_cache(self, results: Dict[str, Optional[str]]) -> None:
+        fd, tmpname = tempfile.mkstemp(dir=self.dev_test_dir, prefix=self.cache_name)
+        with os.fdopen(fd, 'w') as tmp:
+            json.dump(results, tmp)
+        os.replace(tmpname, os.path.join(self.dev_test_dir, self.cache_name))
+
+
+class StateIndexOp(ConfigOp):
+    """Common superclass for actions using the state index.
+
+    The index records the coverage of every state - the schema nodes it
+    sets and the lists it sets with multiple entries (see
+    `config_coverage`) - and the states setting each node.  It is
+    stored in the device test directory; entries are keyed by the
+    content hash of the state, and for states other than XML also by
+    the NED, so only new or changed states are read again when the
+    index is updated; state files are hashed again only if their
+    modification time or size changed.  XML states are read directly,
+    other states are loaded to a transaction and saved as XML.
+    """
+    index_name = 'state-index.json'
+
+    def update_index(self, filenames: List[str]) -> Dict[str, Any]:
+        """Update the index entries of the states, drop entries of states
+        that do not exist any more."""
+        manifest = self.state_store.read_manifest()
+        index = self.read_index()
+        existing = {os.path.basename(filename) for filename in self.get_state_files()}
+        entries = {name: entry for name, entry in index['states'].items() if name in existing}
+        changed = len(entries) != len(index['states'])
+        ned: Optional[str] = None
+        jobs = []
+        stamps = {}
+        for filename in filenames:
+            entry = entries.get(os.path.basename(filename), {})
+            stamps[filename] = self.state_store.stamp(filename) if os.path.exists(filename) else None
+            # files not modified since they were indexed are not hashed again
+            if stamps[filename] is not None and entry.get('stamp') == stamps[filename]:
+                key = entry['key'].split()[0]
+            else:
+                key = self.state_store.digest(filename, manifest)
+            if not filename.endswith(self.xml_statefile_extension):
+                if ned is None:
+                    ned = self.run_with_trans(self.ned_version)
+                key += ' ' + ned
+            if entry.get('key') != key:
+                jobs.append((filename, key))
+            elif entry.get('stamp') != stamps[filename]:
+                entry['stamp'] = stamps[filename]
+                changed = True
+        self.log.debug('{} states indexed before, {} to index'.format(
+            len(filenames) - len(jobs), len(jobs)))
+        # the materialized files of a batch have to stay around while
+        # the batch is read
+        batch_size = max(self.worker_threads, self.state_store.cache_size)
+        for start in range(0, len(jobs), batch_size):
+            batch = jobs[start:start + batch_size]
+            self.state_store.materialize(filename for filename, _ in batch)
+            coverages = self.run_parallel(self.state_coverage, [filename for filename, _ in batch])
+            for (filename, key), coverage in zip(batch, coverages):
+                entries[os.path.basename(filename)] = {
+                    'state': self.state_filename_to_name(filename),
+                    'key': key,
+                    'stamp': stamps[filename],
+                    'nodes': sorted(path for path, multiple in coverage if not multiple),
+                    'multiple': sorted(path for path, multiple in coverage if multiple)}
+            changed = True
+        if changed:
+            nodes: Dict[str, List[str]] = {}
+            for _, entry in sorted(entries.items()):
+                for path in entry['nodes']:
+                    nodes.setdefault(path, []).append(entry['state'])
+            index = {'states': entries, 'nodes': nodes}
+            self.write_index(index)
+        return index
+
+    def read_index(self) -> Dict[str, Any]:
+        try:
+            with open(os.path.join(self.dev_test_dir, self.index_name)) as index:
+                return cast(Dict[str, Any], json.load(index))
+        except (OSError, ValueError):
+            return {'states': {}, 'nodes': {}}
+
+    def write_index(self, index: Dict[str, Any]) -> None:
+        fd, tmpname = tempfile.mkstemp(dir=self.dev_test_dir, prefix=self.index_name)
+        with os.fdopen(fd, 'w') as tmp:
+            json.dump(index, tmp)
+        os.replace(tmpname, os.path.join(self.dev_test_dir, self.index_name))
+
+    def state_coverage(self, filename: str) -> Set[CoverageItem]:
+        if filename.endswith(self.xml_statefile_extension):
+            with self.state_store.open(filename) as data:
+                return config_coverage(iter(lambda: data.read(state_store.BLOCK_SIZE), b''))
+        return self.run_with_trans(lambda trans: self.load_coverage(trans, filename),
+                                   write=True)
+
+    def load_coverage(self, trans: Transaction, filename: str) -> Set[CoverageItem]:
+        dev_config = "/ncs:devices/device{{{}}}/config".format(self.dev_name)
+        trans.delete(dev_config)
+        trans.load_config(_ncs.maapi.CONFIG_MERGE | _ncs.maapi.CONFIG_C, filename)
+        return config_coverage(self.save_config(trans, _ncs.maapi.CONFIG_XML, dev_config))
+
+
+class SelectStatesOp(StateIndexOp):
+    """Select a minimal set of states with the coverage of all states.
+
+    The coverage of the states is taken from the state index;
+    transitions between the states also delete what they set.  The
+    states are selected greedily, always the one that covers most of
+    what is not covered yet.
+    """
+    action_name = 'select states'
+
+    def _init_params(self, params: Node) -> None:
+        self.disable_others = self.param_default(params, 'disable_others', False)
+
+    def perform(self) -> ActionResult:
+        disabled = set(self.get_disabled_state_files())
+        filenames = sorted(filename for filename in self.get_state_files()
+                           if filename not in disabled)
+        if filenames == []:
+            raise ActionError('no enabled states')
+        entries = self.update_index(filenames)['states']
+        coverage: Dict[str, Set[CoverageItem]] = {}
+        for filename in filenames:
+            entry = entries[os.path.basename(filename)]
+            coverage[filename] = ({(path, False) for path in entry['nodes']}
+                                  | {(path, True) for path in entry['multiple']})
+        selected = select_states(coverage)
+        others = [filename for filename in filenames if filename not in selected]
+        msg = 'Selected states: {}'.format([self.state_filename_to_name(filename)
+                                            for filename in selected])
+        if others == []:
+            return {'success': msg}
+        other_states = [self.state_filename_to_name(filename) for filename in others]
+        if not self.disable_others:
+            return {'success': '{}; not needed: {}'.format(msg, other_states)}
+        try:
+            self.state_store.set_disabled(others, True)
+        except OSError:
+            return {'failure': 'Failed to mark {} as disabled'.format(', '.join(others))}
+        finally:
+            self.states_changed()
+        return {'success': '{}; disabled: {}'.format(msg, other_states)}
+
+
+class IndexStatesOp(StateIndexOp):
+    """Update the state index and query it.
+
+    Node paths given in a query match the node and all nodes under it;
+    namespaces in the paths are optional.
+    """
+    action_name = 'index states'
+
+    def _init_params(self, params: Node) -> None:
+        self.nodes: List[str] = list(params.node)
+        self.state_name: Optional[str] = params.state_name
+
+    def perform(self) -> ActionResult:
+        index = self.update_index(self.get_state_files())
+        if self.state_name is not None:
+            filename = self.state_name_to_filename(self.state_name)
+            entry = index['states'].get(os.path.basename(filename))
+            if entry is None:
+                raise ActionError('No such state: ' + self.state_name)
+            nodes = entry['nodes']
+            return {'success': 'Nodes set by {}:\n{}'.format(
+                self.state_name, '\n'.join(strip_namespaces(path) for path in nodes))}
+        if self.nodes != []:
+            states: Set[str] = set()
+            for path, node_states in index['nodes'].items():
+                if any(node_in_subtree(path, node) for node in self.nodes):
+                    states.update(node_states)
+            return {'success': 'States setting the nodes: {}'.format(sorted(states))}
+        return {'success': 'Indexed {} states'.format(len(index['states']))}
+
+
+def strip_namespaces(path: str) -> str:
+    return re.sub('{[^}]*}', '', path)
+
+
+def node_in_subtree(path: str, node: str) -> bool:
+    """Test if the schema node path is the node or under it; without
+    namespaces in the node, they are ignored in the path too."""
+    if '{' not in node:
+        path = strip_namespaces(path)
+    node = node.rstrip('/')
+    return path == node or path.startswith(node + '/')
+
+
+def config_coverage(data: Iterable[bytes]) -> Set[CoverageItem]:
+    """Collect the coverage of a device configuration in NSO XML.
+
+    Schema nodes are identified by element paths (relative to the
+    device configuration, without list keys), lists and leaf-lists with
+    multiple entries are present also with the second item set.
+    """
+    parser = etree.XMLPullParser(events=('start', 'end'))
+    coverage: Set[CoverageItem] = set()
+    # paths of open elements with numbers of their children by tag
+    stack: List[Tuple[str, Dict[str, int]]] = []
+    for chunk in data:
+        parser.feed(chunk)
+        for event, elem in parser.read_events():
+            if not stack:
+                if event == 'start' and elem.tag == NCS_CONFIG:
+                    stack.append(('', {}))
+                continue
+            if event == 'start':
+                path, counts = stack[-1]
+                counts[elem.tag] = counts.get(elem.tag, 0) + 1
+                stack.append((path + '/' + elem.tag, {}))
+                continue
+            path, counts = stack.pop()
+            coverage.update((path + '/' + tag, True) for tag, count in counts.items() if count > 1)
+            if stack:
+                coverage.add((path, False))
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+    parser.close()
+    return coverage
+
+
+def select_states(coverage: Dict[str, Set[CoverageItem]]) -> List[str]:
+    """Greedily select states with the same coverage as all of them."""
+    remaining = set().union(*coverage.values())
+    candidates = dict(coverage)
+    selected = []
+    while remaining:
+        best = max(sorted(candidates), key=lambda state: len(candidates[state] & remaining))
+        selected.append(best)
+        remaining -= candidates.pop(best)
+    return selected
+
 
 class StatesProvider(Handler):
     def __init__(self, log: Log) -> None:
@@ -489,15 +1024,61 @@ class StatesProvider(Handler):
         return StatesData.get_data(tctx, device, self.log, StatesData.states)
 
     def get_object(self, tctx: Tctx, kp: str, args: Dict[str, str]) -> Dict[str, Any]:
-        states = sorted(self.get_states_data(tctx, args['device']))
+        states = self.get_states_data(tctx, args['device'])
+        return {'states': [state_entry(state, disabled) for state, disabled in states]}
+
+
+class StatesListProvider(StatesProvider):
+    """Provider for the states list, one entry at a time.
+
+    The first `get_next` call for a device in a transaction takes a
+    snapshot of the states (see `XmnrBase.get_states_snapshot`); the
+    following calls in the same transaction only index into it.
+    """
+    max_snapshots = 16
+
+    def __init__(self, log: Log) -> None:
+        super(StatesListProvider, self).__init__(log)
+        self.snapshots: 'OrderedDict[Tuple[int, str], List[Tuple[str, bool]]]' = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_snapshot(self, tctx: Tctx, device: str, refresh: bool) -> List[Tuple[str, bool]]:
+        key = (tctx.th, device)
+        with self.lock:
+            snapshot = self.snapshots.get(key)
+        if snapshot is None or refresh:
+            snapshot = self.get_states_data(tctx, device)
+            with self.lock:
+                self.snapshots[key] = snapshot
+                self.snapshots.move_to_end(key)
+                while len(self.snapshots) > self.max_snapshots:
+                    self.snapshots.popitem(last=False)
+        return snapshot
+
+    def get_next(self, tctx: Tctx, kp: str, args: Dict[str, str], next: int) -> Optional[str]:
+        """Return the key of the entry following the position `next`
+        (-1 for the first entry), or None at the end of the list."""
+        snapshot = self.get_snapshot(tctx, args['device'], next == -1)
+        if next + 1 < len(snapshot):
+            return snapshot[next + 1][0]
+        return None
+
+    def get_object(self, tctx: Tctx, kp: str, args: Dict[str, str]) -> Dict[str, Any]:
+        snapshot = self.get_snapshot(tctx, args['device'], False)
+        index = bisect.bisect_left(snapshot, (args['states'], False))
+        for state, disabled in snapshot[index:index + 2]:
+            if state == args['states']:
+                return state_entry(state, disabled)
+        return {}
+
+
+def state_entry(state: str, disabled: bool) -> Dict[str, Any]:
+    if disabled:
         disabled_tag = _ncs.Value((ns.hash, ns.drned_xmnr_disabled), _ncs.C_XMLTAG)
-        return {'states': [{'state': state, 'disabled': disabled_tag} if disabled
-                           else {'state': state}
-                           for state, disabled in states]}
+        return {'state': state, 'disabled': disabled_tag}
+    return {'state': state}
 
 
 class StatesData(base_op.XmnrDeviceData):
     def states(self) -> List[Tuple[str, bool]]:
-        return [(self.state_filename_to_name(filename),
-                 os.path.exists(filename + self.flag_file_extension))
-                for filename in self.get_state_files()]
+        return self.get_states_snapshot()
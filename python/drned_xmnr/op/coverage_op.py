@@ -1,20 +1,25 @@
 import re
 import os
 import glob
+import json
+import bisect
 import operator
+import tempfile
 import functools
 import itertools
-from collections import defaultdict
-import pickle
+import select
+import threading
 import traceback
+import subprocess
 
 from . import base_op
+from . import coverage_worker
 from .ex import ActionError
 
 
 from .common_op import Handler
 
-from typing import Any, Dict, List, Sequence
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple, cast
 from drned_xmnr.typing_xmnr import ActionResult, Tctx
 from ncs import maagic
 from ncs.maagic import Node
@@ -22,6 +27,73 @@ from ncs.maapi import Transaction
 from ncs.log import Log
 
 
+CoverageData = Dict[str, Any]
+
+COVERAGE_DATA = 'coverage.json'
+DRNED_RESULT = os.path.join('drned-work', 'coverage', 'coverage.json')
+
+
+class CoverageWorker(object):
+    """A `coverage_worker` process, shared by all `collect` actions
+    using the same DrNED environment.
+
+    The worker process is started when needed, and started again if it
+    has terminated; requests to one worker are serialized with `lock`.
+    """
+    _workers: Dict[Tuple[str, str], 'CoverageWorker'] = {}
+    _workers_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, env: Dict[str, str]) -> 'CoverageWorker':
+        key = (env['DRNED'], env['PYTHONPATH'])
+        with cls._workers_lock:
+            worker = cls._workers.get(key)
+            if worker is None:
+                worker = cls._workers[key] = cls(env)
+            return worker
+
+    def __init__(self, env: Dict[str, str]) -> None:
+        self.env = env
+        self.lock = threading.Lock()
+        self.process: Optional['subprocess.Popen[bytes]'] = None
+
+    def start(self) -> 'subprocess.Popen[bytes]':
+        if self.process is None or self.process.poll() is not None:
+            runner = os.environ.get('PYTHON_RUNNER', 'python').split()
+            self.process = subprocess.Popen(runner + [os.path.abspath(coverage_worker.__file__)],
+                                            env=self.env,
+                                            stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE)
+        return self.process
+
+    def request(self, request: Dict[str, Any],
+                waiting: Callable[[], None]) -> Optional[Dict[str, Any]]:
+        """Send the request to the worker and wait for the response.
+
+        :param waiting: called every `TIMEOUT_MARGIN` seconds until the
+            worker responds
+        :return: the response, or None if the worker is not available
+        """
+        process = self.start()
+        if process.stdin is None or process.stdout is None:
+            return None
+        try:
+            process.stdin.write(json.dumps(request).encode() + b'\n')
+            process.stdin.flush()
+            fd = process.stdout.fileno()
+            while not select.select([fd], [], [], base_op.TIMEOUT_MARGIN)[0]:
+                if process.poll() is not None:
+                    break
+                waiting()
+            response = process.stdout.readline()
+        except OSError:
+            response = b''
+        if not response:
+            self.process = None
+            return None
+        return cast(Dict[str, Any], json.loads(response))
+
+
 class ResetCoverageOp(base_op.ActionBase):
     action_name = 'reset coverage'
 
@@ -37,6 +109,7 @@ class CoverageOp(base_op.ActionBase):
 
     def _init_params(self, params: Node) -> None:
         self.patterns: List[str] = list(params.yang_patterns)
+        self.live = self.param_default(params, 'live', False)
 
     def cli_filter(self, msg: str) -> None:
         # no output from DrNED should be passed to CLI
@@ -49,17 +122,77 @@ class CoverageOp(base_op.ActionBase):
         reduced: Sequence[str] = functools.reduce(operator.concat, globs, [])
         yangfiles = set(reduced)
         yangpath = set(os.path.dirname(yf) for yf in yangfiles)
+        message = "Completed successfully"
+        covdata = self.run_worker(list(yangfiles), ':'.join(yangpath))
+        if covdata is None:
+            covdata = self.run_pytest(yangfiles, yangpath)
+            if self.live:
+                message += "; live coverage not supported by DrNED"
+        self.store_data(covdata)
+        return {'success': message}
+
+    def run_worker(self, yangfiles: List[str], yangpath: str) -> Optional[CoverageData]:
+        """Calculate the coverage in a coverage worker process.
+
+        :return: the coverage data, or None if the worker cannot be used
+            (such as with DrNED versions that support only pytest)
+        """
+        worker = CoverageWorker.get(self.run_with_trans(self.setup_drned_env))
+        request = {'directory': self.drned_run_directory,
+                   'yang': yangfiles,
+                   'yangpath': yangpath,
+                   'argv': [],
+                   'device': self.dev_name,
+                   'live': self.live,
+                   'target': os.path.join(self.dev_test_dir, COVERAGE_DATA)}
+        with worker.lock:
+            with self.abort_lock:
+                if self.aborted:
+                    raise ActionError("action aborted")
+                process = worker.start()
+                self.drned_processes.append(process)
+            try:
+                self.extend_timeout()
+                # the analysis gives no output, keep the action alive
+                response = worker.request(request, self.extend_timeout)
+            finally:
+                with self.abort_lock:
+                    self.drned_processes.remove(process)
+        if response is None or 'unsupported' in response:
+            self.log.debug('coverage worker not available: ', response)
+            return None
+        self.progress_msg(response['output'])
+        if 'error' in response:
+            raise ActionError('coverage failed: ' + response['error'])
+        return cast(CoverageData, response['result'])
+
+    def run_pytest(self, yangfiles: Iterable[str], yangpath: Iterable[str]) -> CoverageData:
         fnames = ['--fname=' + yang for yang in yangfiles]
         args = [self.pytest_executable(),
                 '-s',
                 '--device=' + self.dev_name,
                 '-k', 'test_coverage',
                 '--yangpath=' + ':'.join(yangpath)]
+        drned_result = os.path.join(self.drned_run_directory, DRNED_RESULT)
+        try:
+            os.remove(drned_result)
+        except OSError:
+            pass
         result, output = self.run_in_drned_env(args + fnames)
         if result != 0:
             raise ActionError("drned failed; 'coverage reset' might be needed")
-        self.parse_output(output)
-        return {'success': "Completed successfully"}
+        try:
+            with open(drned_result) as data:
+                return cast(CoverageData, json.load(data))
+        except (OSError, ValueError):
+            # DrNED versions without the structured result
+            return self.parse_output(output)
+
+    def store_data(self, covdata: CoverageData) -> None:
+        fd, tmpname = tempfile.mkstemp(dir=self.dev_test_dir, prefix=COVERAGE_DATA)
+        with os.fdopen(fd, 'w') as tmp:
+            json.dump(covdata, tmp)
+        os.replace(tmpname, os.path.join(self.dev_test_dir, COVERAGE_DATA))
 
     def device_package_name(self, trans: Transaction) -> str:
         root = maagic.get_root(trans)
@@ -84,7 +217,7 @@ class CoverageOp(base_op.ActionBase):
             return os.path.join(os.getcwd(), 'packages', pkg_name, 'src', 'yang', '*.yang')
         return ''
 
-    def parse_output(self, output: str) -> None:
+    def parse_output(self, output: str) -> CoverageData:
         lines = iter(output.split('\n'))
         expr = (r'Found a total of (?P<nodes>[0-9]*) nodes \([0-9]* of type empty\)'
                 + ' and (?P<lists>[0-9]*) lists')
@@ -94,8 +227,10 @@ class CoverageOp(base_op.ActionBase):
         match = rx.match(next(lines))
         if match is None:
             raise ActionError("Invalid input coverage data")
-        self.covdata: Dict[str, Any] = dict(total={k: int(v) for (k, v) in match.groupdict().items()},
-                                            percents=defaultdict(dict))
+        totals = match.groupdict()
+        covdata: CoverageData = {'nodes-total': int(totals['nodes']),
+                                 'lists-total': int(totals['lists']),
+                                 'percents': {}}
         for (cname, value) in [('nodes', 'read-or-set'),
                                ('lists', 'read-or-set'),
                                ('lists', 'deleted'),
@@ -112,10 +247,9 @@ class CoverageOp(base_op.ActionBase):
             mx = valrx.match(next(lines))
             if mx is None:
                 raise ActionError("Invalid input coverage data")
-            self.covdata['percents'][cname][value] = {k: int(v)
-                                                      for (k, v) in mx.groupdict().items()}
-        with open(os.path.join(self.dev_test_dir, 'coverage.data'), 'wb') as data:
-            pickle.dump(self.covdata, data, protocol=2)
+            covdata['percents'].setdefault(cname, {})[value] = {k: int(v)
+                                                                for (k, v) in mx.groupdict().items()}
+        return covdata
 
 
 class DataHandler(Handler):
@@ -127,17 +261,87 @@ class DataHandler(Handler):
         return {'drned-xmnr': {'coverage': {'data': dd}}}
 
 
+class UncoveredProvider(Handler):
+    """Provider for the uncovered categories, one entry at a time."""
+    def __init__(self, log: Log) -> None:
+        self.log = log
+
+    def get_uncovered(self, tctx: Tctx, device: str) -> Dict[str, List[str]]:
+        return DeviceData.get_data(tctx, device, self.log, DeviceData.get_uncovered)
+
+    def get_next(self, tctx: Tctx, kp: str, args: Dict[str, Any], next: int) -> Optional[str]:
+        categories = list(self.get_uncovered(tctx, args['device']))
+        if next + 1 < len(categories):
+            return categories[next + 1]
+        return None
+
+    def get_object(self, tctx: Tctx, kp: str, args: Dict[str, Any]) -> Dict[str, Any]:
+        paths = self.get_uncovered(tctx, args['device']).get(args['uncovered'])
+        if paths is None:
+            return {}
+        return {'category': args['uncovered'], 'count': len(paths)}
+
+
+class UncoveredNodesProvider(UncoveredProvider):
+    """Provider for the uncovered nodes of a category.
+
+    The nodes are paged through by their position in the sorted list of
+    the coverage data, which is kept in memory until it changes.
+    """
+    def get_next(self, tctx: Tctx, kp: str, args: Dict[str, Any], next: int) -> Optional[str]:
+        paths = self.get_uncovered(tctx, args['device']).get(args['uncovered'], [])
+        if next + 1 < len(paths):
+            return paths[next + 1]
+        return None
+
+    def get_object(self, tctx: Tctx, kp: str, args: Dict[str, Any]) -> Dict[str, Any]:
+        paths = self.get_uncovered(tctx, args['device']).get(args['uncovered'], [])
+        index = bisect.bisect_left(paths, args['node'])
+        if index < len(paths) and paths[index] == args['node']:
+            return {'path': paths[index]}
+        return {}
+
+
 class DeviceData(base_op.XmnrDeviceData):
+    _coverage_data: Dict[str, Tuple[int, CoverageData]] = {}
+    _coverage_data_lock = threading.Lock()
+
+    def read_coverage_data(self) -> CoverageData:
+        """Read the data stored by the last `collect`.
+
+        The data are kept until the data file changes, so that the
+        operational data (and paging through the uncovered nodes) do
+        not need to read and parse the file again.
+        """
+        path = os.path.join(self.dev_test_dir, COVERAGE_DATA)
+        mtime = os.stat(path).st_mtime_ns
+        with DeviceData._coverage_data_lock:
+            cached = DeviceData._coverage_data.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with open(path) as datafile:
+            data = cast(CoverageData, json.load(datafile))
+        for paths in data.get('uncovered', {}).values():
+            paths.sort()
+        with DeviceData._coverage_data_lock:
+            DeviceData._coverage_data[path] = (mtime, data)
+        return data
+
     def get_coverage_data(self) -> Dict[str, Any]:
         try:
-            with open(os.path.join(self.dev_test_dir, 'coverage.data'), 'rb') as datafile:
-                # pickle.load() causes problems on some platforms
-                data = pickle.loads(datafile.read())
-                self.log.debug('unpickled data: ', data)
+            data = self.read_coverage_data()
         except Exception as exc:
             self.log.error('Could not load coverage data, "collect" may not have been run', exc)
             self.log.debug(traceback.format_exc())
             return {}
-        return {'nodes-total': data['total']['nodes'],
-                'lists-total': data['total']['lists'],
+        return {'nodes-total': data['nodes-total'],
+                'lists-total': data['lists-total'],
                 'percents': data['percents']}
+
+    def get_uncovered(self) -> Dict[str, List[str]]:
+        try:
+            data = self.read_coverage_data()
+        except Exception as exc:
+            self.log.error('Could not load coverage data, "collect" may not have been run', exc)
+            return {}
+        return cast(Dict[str, List[str]], data.get('uncovered', {}))
@@ -0,0 +1,157 @@
+"""Coverage analysis worker.
+
+The script is started by the `collect` coverage action in the DrNED
+environment and keeps running; it reads requests from its standard
+input and writes responses to its standard output, one JSON object per
+line.  DrNED, pyang and the device schema are thus loaded only once,
+not for every `collect`.
+
+A request contains the DrNED running directory, the YANG files and
+their search path, the include/exclude paths and the device name.  The
+response contains either the coverage `result` (as stored by DrNED in
+`coverage.json`) and the report `output`, or an `error`, or
+`unsupported` if the DrNED version cannot calculate the coverage
+without pytest.
+
+A request with `live` set is also kept as a watch: the worker then
+checks the DrNED coverage directory every `POLL_INTERVAL` seconds and
+whenever snapshots have been added, it calculates the coverage again
+(DrNED reads only the new snapshots) and writes the result to the
+request `target` file.  Requests for a watched coverage are answered
+with the last result if no snapshots have been added since.  A request
+without `live` removes the watch.
+
+This module must not depend on `drned_xmnr`, it does not run in NSO.
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import importlib
+import threading
+import traceback
+
+from types import ModuleType
+from typing import Any, Dict, List, Optional, TextIO
+
+
+POLL_INTERVAL = 2.0
+
+
+class Unsupported(Exception):
+    pass
+
+
+class Watch(object):
+    def __init__(self, request: Dict[str, Any]) -> None:
+        self.request = request
+        self.stamp: Optional[List[Any]] = None
+        self.response: Dict[str, Any] = {}
+
+
+lock = threading.Lock()
+watches: Dict[str, Watch] = {}
+watcher: Optional[threading.Thread] = None
+
+
+def drned_coverage(*functions: str) -> ModuleType:
+    try:
+        test_coverage = importlib.import_module('common.test_coverage')
+    except ImportError as exc:
+        raise Unsupported('cannot import DrNED coverage: {}'.format(exc))
+    for function in functions:
+        if not hasattr(test_coverage, function):
+            raise Unsupported('DrNED coverage does not support ' + function)
+    return test_coverage
+
+
+def calculate(request: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        coverage_data = drned_coverage('coverage_data').coverage_data
+        os.chdir(request['directory'])
+        result, output = coverage_data(request['yang'], request['argv'],
+                                       request['device'], request['yangpath'])
+    except Unsupported as exc:
+        return {'unsupported': str(exc)}
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except BaseException as exc:
+        # pytest.fail() raises exceptions not derived from Exception
+        return {'error': str(exc), 'output': traceback.format_exc()}
+    return {'result': result, 'output': output}
+
+
+def update(watch: Watch) -> None:
+    """Calculate the coverage of the watch again if snapshots have been
+    added or the YANG files have changed."""
+    request = watch.request
+    os.chdir(request['directory'])
+    stamp = [drned_coverage('coverage_stamp').coverage_stamp(),
+             [os.stat(yang).st_mtime_ns for yang in request['yang']]]
+    if stamp == watch.stamp and 'result' in watch.response:
+        return
+    watch.response = calculate(request)
+    watch.stamp = stamp
+    if 'result' in watch.response:
+        target = request['target']
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(target),
+                                       prefix=os.path.basename(target))
+        with os.fdopen(fd, 'w') as tmp:
+            json.dump(watch.response['result'], tmp)
+        os.replace(tmpname, target)
+
+
+def watch_all() -> None:
+    while True:
+        time.sleep(POLL_INTERVAL)
+        with lock:
+            for watch in list(watches.values()):
+                try:
+                    update(watch)
+                except Exception:
+                    traceback.print_exc()
+
+
+def handle(request: Dict[str, Any]) -> Dict[str, Any]:
+    global watcher
+    key = json.dumps([request[name] for name in ('directory', 'yang', 'yangpath',
+                                                 'argv', 'device')])
+    with lock:
+        if not request.get('live'):
+            watches.pop(key, None)
+            return calculate(request)
+        watch = watches.get(key)
+        if watch is None:
+            watch = Watch(request)
+        try:
+            update(watch)
+        except Unsupported as exc:
+            return {'unsupported': str(exc)}
+        except OSError as exc:
+            return {'error': str(exc), 'output': traceback.format_exc()}
+        watches[key] = watch
+        if watcher is None:
+            watcher = threading.Thread(target=watch_all, daemon=True)
+            watcher.start()
+        return watch.response
+
+
+def serve(requests: TextIO, responses: TextIO) -> None:
+    for line in requests:
+        response = handle(json.loads(line))
+        responses.write(json.dumps(response) + '\n')
+        responses.flush()
+
+
+def main() -> None:
+    # anything DrNED prints outside of the report must not get mixed
+    # with the responses
+    responses = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    serve(sys.stdin, responses)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,6 @@ import os
 import re
 import shutil
 import errno
-import subprocess
 from lxml import etree
 
 import _ncs
@@ -148,12 +147,8 @@ class SetupOp(base_op.ActionBase):
 
     def setup_drned(self) -> None:
         env = self.run_with_trans(self.setup_drned_env)
-        self.drned_process = subprocess.Popen(['make', 'env.sh'],
-                                              env=env,
-                                              cwd=self.drned_run_directory,
-                                              stdout=subprocess.PIPE,
-                                              stderr=subprocess.STDOUT)
-        result, _ = self.proc_run(lambda *ignore: None)
+        process = self.start_process(['make', 'env.sh'], env)
+        result, _ = self.proc_run(lambda *ignore: None, process)
         if result != 0:
             raise ActionError("Failed to set up env.sh for DrNED")
         self.cfg_file = os.path.join(self.drned_run_directory, self.dev_name + '.cfg')
@@ -0,0 +1,390 @@
+"""Storage of device state files.
+
+All per-state metadata - whether the state is disabled, and the
+parameters DrNED should use to load it - is kept in a JSON manifest in
+the `.store` subdirectory of the states directory, together with the
+SHA-256 hash of the state content; the manifest is always replaced
+atomically.  The DrNED `.load` files are generated only for the
+duration of a test run that needs them.
+
+With the `plain` storage (the default), a state is just a file in the
+device states directory.  With the `compressed` storage, the content
+of each state is kept as a gzip-compressed object named by its SHA-256
+hash, so states with the same content share one object; plain state
+files are materialized only when DrNED or NSO need to read them, and
+at most `cache_size` of them are kept around (least recently used ones
+are removed first).
+"""
+
+import os
+import gzip
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from typing import Any, BinaryIO, Dict, IO, Iterable, Iterator, List, Optional, Set, Tuple, cast
+
+
+Manifest = Dict[str, Dict[str, Any]]
+
+BLOCK_SIZE = 1 << 16
+
+LOAD_EXTENSION = '.load'
+DISABLED_EXTENSION = '.disabled'
+
+
+def file_digest(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as data:
+        for block in iter(lambda: data.read(BLOCK_SIZE), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class StateStore(object):
+    store_dir_name = '.store'
+    manifest_name = 'manifest.json'
+    lock_name = 'lock'
+    objects_dir_name = 'objects'
+    object_extension = '.gz'
+
+    _lock = threading.Lock()
+    # states directory -> its mtime when it was found to have no sidecars
+    _scanned: Dict[str, int] = {}
+    # manifest path -> number of updates done by this process
+    _generations: Dict[str, int] = {}
+    # manifest path -> ((generation, manifest mtime), names of packed states)
+    _packed: Dict[str, Tuple[Tuple[int, int], Set[str]]] = {}
+    _packed_lock = threading.Lock()
+    # generated `.load` file -> number of runs using it
+    _load_users: Dict[str, int] = {}
+
+    def __init__(self, states_dir: str, compressed: bool = False, cache_size: int = 0) -> None:
+        self.states_dir = states_dir
+        self.compressed = compressed
+        self.cache_size = cache_size
+        self.store_dir = os.path.join(states_dir, self.store_dir_name)
+        self.objects_dir = os.path.join(self.store_dir, self.objects_dir_name)
+        self.manifest_path = os.path.join(self.store_dir, self.manifest_name)
+
+    def read_manifest(self) -> Manifest:
+        try:
+            with open(self.manifest_path) as manifest:
+                return cast(Manifest, json.load(manifest))
+        except (OSError, ValueError):
+            return {'states': {}, 'materialized': {}}
+
+    def manifest_mtime(self) -> int:
+        try:
+            return os.stat(self.manifest_path).st_mtime_ns
+        except OSError:
+            return 0
+
+    @contextmanager
+    def update_manifest(self) -> Iterator[Manifest]:
+        """Read the manifest, let the caller modify it and write it back.
+
+        The update is serialized both among threads and processes.
+        """
+        os.makedirs(self.objects_dir, exist_ok=True)
+        with StateStore._lock, open(os.path.join(self.store_dir, self.lock_name), 'w') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            manifest = self.read_manifest()
+            yield manifest
+            fd, tmpname = tempfile.mkstemp(dir=self.store_dir, prefix=self.manifest_name)
+            with os.fdopen(fd, 'w') as tmp:
+                json.dump(manifest, tmp)
+            os.replace(tmpname, self.manifest_path)
+            # the mtime may not change if the update is fast enough
+            with StateStore._packed_lock:
+                StateStore._generations[self.manifest_path] = \
+                    StateStore._generations.get(self.manifest_path, 0) + 1
+
+    def import_sidecars(self) -> None:
+        """Move metadata from `.load` and `.disabled` files to the manifest.
+
+        This is done only once, before the manifest is created.  The
+        states directory is not listed again as long as it has not
+        changed since it was found to have no sidecar files.
+        """
+        if os.path.exists(self.manifest_path):
+            return
+        try:
+            mtime = os.stat(self.states_dir).st_mtime_ns
+        except OSError:
+            return
+        if StateStore._scanned.get(self.states_dir) == mtime:
+            return
+        sidecars = self.sidecar_names()
+        if not sidecars:
+            StateStore._scanned[self.states_dir] = mtime
+            return
+        with self.update_manifest() as manifest:
+            # another thread or process may have done it in the meantime
+            if os.path.exists(self.manifest_path):
+                return
+            sidecars = self.sidecar_names()
+            for sidecar in sidecars:
+                path = os.path.join(self.states_dir, sidecar)
+                name, extension = os.path.splitext(sidecar)
+                metadata: Dict[str, Any] = {'disabled': True}
+                if extension == LOAD_EXTENSION:
+                    try:
+                        with open(path) as load:
+                            metadata = {'load': load.read()}
+                    except FileNotFoundError:
+                        continue
+                manifest['states'].setdefault(name, {}).update(metadata)
+        for sidecar in sidecars:
+            try:
+                os.remove(os.path.join(self.states_dir, sidecar))
+            except FileNotFoundError:
+                pass
+
+    def sidecar_names(self) -> List[str]:
+        return [name for name in os.listdir(self.states_dir)
+                if name.endswith(LOAD_EXTENSION) or name.endswith(DISABLED_EXTENSION)]
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self.objects_dir, digest + self.object_extension)
+
+    def packed_names(self, manifest: Optional[Manifest] = None) -> Set[str]:
+        """Names (basenames) of all states stored as objects.
+
+        Without a manifest, the names are kept until the manifest
+        changes, so that looking up many states does not read it for
+        each of them; the result must not be modified then.
+        """
+        if manifest is not None:
+            return {name for name, entry in manifest['states'].items() if 'sha256' in entry}
+        with StateStore._packed_lock:
+            stamp = (StateStore._generations.get(self.manifest_path, 0), self.manifest_mtime())
+            cached = StateStore._packed.get(self.manifest_path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        names = self.packed_names(self.read_manifest())
+        with StateStore._packed_lock:
+            StateStore._packed[self.manifest_path] = (stamp, names)
+        return names
+
+    def disabled_names(self, manifest: Optional[Manifest] = None) -> Set[str]:
+        if manifest is None:
+            manifest = self.read_manifest()
+        return {name for name, entry in manifest['states'].items() if entry.get('disabled')}
+
+    def exists(self, filename: str) -> bool:
+        return (os.path.exists(filename)
+                or os.path.basename(filename) in self.packed_names())
+
+    def digest(self, filename: str, manifest: Optional[Manifest] = None) -> str:
+        """SHA-256 hash of the state content, materialized or not.
+
+        For plain states, the hash recorded when the state was added is
+        used unless the file has been modified since.
+        """
+        if manifest is None:
+            manifest = self.read_manifest()
+        entry = manifest['states'].get(os.path.basename(filename), {})
+        if 'sha256' in entry:
+            return cast(str, entry['sha256'])
+        recorded = entry.get('digest')
+        if recorded is not None and recorded['stamp'] == self.stamp(filename):
+            return cast(str, recorded['sha256'])
+        return file_digest(filename)
+
+    def digests(self, filenames: Iterable[str]) -> Dict[str, str]:
+        """SHA-256 hashes of the states, like `digest`.
+
+        Hashes that had to be calculated for plain states are recorded
+        in the manifest, so that the files are not read again until
+        they are modified.
+        """
+        manifest = self.read_manifest()
+        digests: Dict[str, str] = {}
+        calculated: Dict[str, Dict[str, Any]] = {}
+        for filename in filenames:
+            name = os.path.basename(filename)
+            entry = manifest['states'].get(name, {})
+            if 'sha256' in entry:
+                digests[filename] = entry['sha256']
+                continue
+            stamp = self.stamp(filename)
+            recorded = entry.get('digest')
+            if recorded is None or recorded['stamp'] != stamp:
+                recorded = calculated[name] = {'sha256': file_digest(filename), 'stamp': stamp}
+            digests[filename] = recorded['sha256']
+        if calculated:
+            with self.update_manifest() as manifest:
+                for name, recorded in calculated.items():
+                    entry = manifest['states'].setdefault(name, {})
+                    if 'sha256' not in entry:
+                        entry['digest'] = recorded
+        return digests
+
+    def stamp(self, filename: str) -> List[int]:
+        stat = os.stat(filename)
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def add(self, filename: str, load: Optional[str] = None,
+            digest: Optional[str] = None) -> None:
+        """Register a newly written state file.
+
+        With the compressed storage, the file content is moved to an
+        object.  Any metadata of a previous state with the same name
+        are replaced.
+
+        :param load: content of the DrNED `.load` file for the state
+        :param digest: SHA-256 hash of the file content, if known
+        """
+        name = os.path.basename(filename)
+        entry: Dict[str, Any] = {}
+        if load is not None:
+            entry['load'] = load
+        if self.compressed:
+            entry['sha256'] = self.pack(filename, digest)
+        else:
+            entry['digest'] = {'sha256': file_digest(filename) if digest is None else digest,
+                               'stamp': self.stamp(filename)}
+        with self.update_manifest() as manifest:
+            self.drop_entry(manifest, name, entry.get('sha256'))
+            manifest['states'][name] = entry
+        if self.compressed:
+            os.remove(filename)
+
+    def pack(self, filename: str, digest: Optional[str] = None) -> str:
+        if digest is None:
+            digest = file_digest(filename)
+        objpath = self.object_path(digest)
+        os.makedirs(self.objects_dir, exist_ok=True)
+        if not os.path.exists(objpath):
+            fd, tmpname = tempfile.mkstemp(dir=self.objects_dir)
+            with open(filename, 'rb') as source, os.fdopen(fd, 'wb') as raw, \
+                    gzip.GzipFile(fileobj=raw, mode='wb') as target:
+                shutil.copyfileobj(source, cast(IO[bytes], target), BLOCK_SIZE)
+            os.replace(tmpname, objpath)
+        return digest
+
+    def remove(self, filename: str) -> None:
+        """Remove the state file and its metadata.
+
+        :raises OSError: if there is no such state
+        """
+        name = os.path.basename(filename)
+        packed = name in self.packed_names()
+        with self.update_manifest() as manifest:
+            self.drop_entry(manifest, name)
+        try:
+            os.remove(filename)
+        except OSError:
+            if not packed:
+                raise
+
+    def drop_entry(self, manifest: Manifest, name: str, keep: Optional[str] = None) -> None:
+        entry = manifest['states'].pop(name, None)
+        manifest['materialized'].pop(name, None)
+        if entry is not None and entry.get('sha256') not in (None, keep):
+            self.collect_object(manifest, entry['sha256'])
+
+    def collect_object(self, manifest: Manifest, digest: str) -> None:
+        if all(entry.get('sha256') != digest for entry in manifest['states'].values()):
+            try:
+                os.remove(self.object_path(digest))
+            except OSError:
+                pass
+
+    def set_disabled(self, filenames: Iterable[str], disabled: bool) -> None:
+        with self.update_manifest() as manifest:
+            for filename in filenames:
+                entry = manifest['states'].setdefault(os.path.basename(filename), {})
+                if disabled:
+                    entry['disabled'] = True
+                else:
+                    entry.pop('disabled', None)
+
+    @contextmanager
+    def open(self, filename: str) -> Iterator[BinaryIO]:
+        """Open the state for reading, materialized or not."""
+        if os.path.exists(filename):
+            with open(filename, 'rb') as data:
+                yield data
+            return
+        entry = self.read_manifest()['states'].get(os.path.basename(filename), {})
+        if 'sha256' not in entry:
+            raise FileNotFoundError(filename)
+        with gzip.open(self.object_path(entry['sha256']), 'rb') as packed:
+            yield cast(BinaryIO, packed)
+
+    def materialize(self, filenames: Iterable[str]) -> None:
+        """Make sure plain files exist for all given states.
+
+        Materialized files beyond the cache size are removed, least
+        recently used first; files requested by this call are kept.
+        """
+        names = {os.path.basename(filename): filename for filename in filenames}
+        if not self.packed_names().intersection(names):
+            return
+        with self.update_manifest() as manifest:
+            now = time.time()
+            for name, filename in names.items():
+                entry = manifest['states'].get(name, {})
+                if 'sha256' not in entry:
+                    continue
+                if not os.path.exists(filename):
+                    fd, tmpname = tempfile.mkstemp(dir=self.states_dir, prefix='.' + name)
+                    with os.fdopen(fd, 'wb') as target, \
+                            gzip.open(self.object_path(entry['sha256']), 'rb') as source:
+                        shutil.copyfileobj(source, target, BLOCK_SIZE)
+                    os.replace(tmpname, filename)
+                manifest['materialized'][name] = now
+            materialized = manifest['materialized']
+            lru = sorted((used, name) for name, used in materialized.items() if name not in names)
+            for _, name in lru[:max(0, len(materialized) - max(self.cache_size, len(names)))]:
+                del materialized[name]
+                try:
+                    os.remove(os.path.join(self.states_dir, name))
+                except OSError:
+                    pass
+
+    @contextmanager
+    def prepared(self, filenames: Iterable[str]) -> Iterator[None]:
+        """Materialize the states and generate their `.load` files for
+        the duration of a DrNED run.
+
+        Runs on the same device may need the same `.load` files, so
+        the files are counted and removed after the last run using
+        them.
+        """
+        filenames = list(filenames)
+        self.materialize(filenames)
+        states = self.read_manifest()['states']
+        generated: List[str] = []
+        try:
+            for filename in filenames:
+                load = states.get(os.path.basename(filename), {}).get('load')
+                if load is None:
+                    continue
+                load_filename = filename + LOAD_EXTENSION
+                with StateStore._lock:
+                    users = StateStore._load_users.get(load_filename, 0)
+                    if users == 0:
+                        with open(load_filename, 'w') as load_file:
+                            load_file.write(load)
+                    StateStore._load_users[load_filename] = users + 1
+                generated.append(load_filename)
+            yield
+        finally:
+            with StateStore._lock:
+                for load_filename in generated:
+                    StateStore._load_users[load_filename] -= 1
+                    if StateStore._load_users[load_filename] > 0:
+                        continue
+                    del StateStore._load_users[load_filename]
+                    try:
+                        os.remove(load_filename)
+                    except OSError:
+                        pass
@@ -12,6 +12,7 @@ from ncs import maagic
 
 from . import base_op
 from . import filtering
+from .ex import ActionError
 
 from typing import Iterator, List, Optional, Union, Dict
 from drned_xmnr.typing_xmnr import ActionResult, ActionField, LogLevel
@@ -39,6 +40,9 @@ class TransitionsOp(base_op.ActionBase):
         with transition events that are stored in operational CDB.
 
         '''
+        if self.drned_backend == 'maapi' and not self.using_builtin_drned:
+            raise ActionError('The maapi DrNED backend needs the builtin DrNED,'
+                              ' set drned-directory to builtin')
         detail = self.run_with_trans(self.get_log_detail)
         self.filter_cr: Optional[IsStrConsumer] = None
         self.event_context = filtering.TransitionEventContext()
@@ -84,6 +88,8 @@ class TransitionsOp(base_op.ActionBase):
         args = ["-s", "--tb=short", "--device=" + self.dev_name] + drned_args
         if not self.using_builtin_drned:
             args.append("--unreserved")
+        if self.drned_backend == 'maapi':
+            args.append("--use=use_maapi=True")
         args.insert(0, self.pytest_executable())
         self.log.debug("drned: {0}".format(args))
         return self.run_in_drned_env(args)
@@ -95,7 +101,8 @@ class TransitionsOp(base_op.ActionBase):
         self.log.debug("Using file {0}\n".format(filepath))
         test = "test_template_single" if rollback else "test_template_raw"
         args = ["-k {0}[{1}]".format(test, os.path.basename(filepath))]
-        result, _ = self.drned_run(args)
+        with self.state_store.prepared([filename]):
+            result, _ = self.drned_run(args)
         self.log.debug("Test case completed\n")
         if result != 0:
             return "drned failed"
@@ -163,9 +170,8 @@ class StatesTransitionsOp(TransitionsOp):
     def get_transition_filenames(self, params: Node) -> None:
         states = list(params.states)
         if states == []:
-            states = [state for state in self.get_states()
-                      if state not in params.ignore_states
-                      and not self.is_state_disabled(state)]
+            states = [state for (state, disabled) in self.get_states_snapshot()
+                      if state not in params.ignore_states and not disabled]
             states = self.filter_states(states)
             random.shuffle(states)
         else:
@@ -291,8 +297,9 @@ class WalkTransitionsOp(StatesTransitionsOp):
         # if rollback is not desired, we need to set it to an empty list
         fname_args = ["--fname=" + filename for filename in self.state_filenames]
         end_op = [] if self.rollback else ["--end-op", ""]
-        result, _ = self.drned_run(
-            fname_args + end_op + ["--ordered=false", "-k", "test_template_set"])
+        with self.state_store.prepared(self.state_filenames):
+            result, _ = self.drned_run(
+                fname_args + end_op + ["--ordered=false", "-k", "test_template_set"])
         self.log.debug("DrNED completed: {0}".format(result))
         ops = [tr.to for tr in self.event_context.test_events if tr.failure is not None]
         if result != 0 or ops:
@@ -12,7 +12,7 @@ Tctx = Union[TransCtxRef]
 if sys.version_info > (3, 8):
     from typing import Literal
     LogLevel = Literal['none', 'overview', 'drned-overview', 'all']
-    ActionField = Literal['failure', 'success', 'error']
+    ActionField = Literal['failure', 'success', 'error', 'state-name']
 else:
     LogLevel = str
     ActionField = str
@@ -10,7 +10,7 @@ class Value:
 
 
 class TransCtxRef:
-    ...
+    th: int
 
 
 class UserInfo:
@@ -111,10 +111,14 @@ def ncs_mock():
                     packages=Mock(package={'drned-xmnr': Mock(directory=XMNR_INSTALL)}),
                     drned_xmnr=Mock(xmnr_directory=XMNR_DIRECTORY,
                                     drned_directory=DRNED_DIRECTORY,
+                                    drned_backend='cli',
                                     log_detail=Mock(cli='all'),
                                     last_test_results=MagicMock(),
                                     cli_log_file=None,
-                                    xmnr_log_file=None),
+                                    xmnr_log_file=None,
+                                    state_storage='plain',
+                                    materialized_states=32,
+                                    worker_threads=1),
                     ncs_state=mock_path(['internal', 'callpoints', 'actionpoint'], apmock))
     ncs_items = ['_ncs.stream_connect', '_ncs.dp.action_set_timeout', '_ncs.maapi.cli_write',
                  '_ncs.decrypt']
@@ -221,7 +225,7 @@ class SystemMock(XtestMock):
     def complete_popen_mock(self):
         popen = self.patches['subprocess']['Popen']
         wait_mock = Mock(return_value=0)
-        stdout_mock = Mock(read=self.proc_stream.read)
+        stdout_mock = Mock(read=self.proc_stream.read, readline=Mock(return_value=b''))
         popen.return_value = Mock(wait=wait_mock,
                                   poll=self.proc_stream.poll,
                                   test=self.proc_stream.finished,
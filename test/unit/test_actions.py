@@ -3,14 +3,16 @@ from .mocklib import xtest_patch
 from unittest import mock
 import pytest
 from drned_xmnr import action
-from drned_xmnr.op import config_op, base_op, coverage_op, ex
+from drned_xmnr.op import config_op, base_op, coverage_op, coverage_worker, ex, state_store
 import os
+import json
 import sys
 import re
 from random import randint
 import functools
-import itertools
+import threading
 import _ncs
+from lxml import etree
 
 
 device_data = '''\
@@ -301,8 +303,15 @@ class TestBase(object):
             system.ff_patcher.fs.create_file(os.path.join(spath, stname),
                                              contents='{} test data'.format(state))
             if state_path is None:
-                system.ff_patcher.fs.create_file(os.path.join(spath, stname + '.load'),
-                                                 contents=config_op.state_metadata)
+                state_store.StateStore(spath).add(os.path.join(spath, stname),
+                                                  load=config_op.state_metadata)
+
+    def check_state_metadata(self, filename):
+        store = state_store.StateStore(os.path.dirname(filename))
+        with store.prepared([filename]):
+            with open(filename + '.load') as metadata:
+                assert metadata.read() == config_op.state_metadata
+        assert not os.path.exists(filename + '.load')
 
 
 class TestStartup(TestBase):
@@ -412,6 +421,31 @@ class LoadSaveConfig(object):
         return 1
 
 
+class ThreadLoadSaveConfig(LoadSaveConfig):
+    """Like `LoadSaveConfig`, but every thread has its own transaction
+    data and socket stream.  Files with names containing `fail` fail to
+    load."""
+    def __init__(self, system, ncs):
+        super(ThreadLoadSaveConfig, self).__init__(system, ncs)
+        self.local = threading.local()
+        system.patches['socket']['socket'].side_effect = self.socket
+
+    def load_config(self, _flags, filename):
+        if 'fail' in os.path.basename(filename):
+            raise mocklib.MockNcsError('cannot load')
+        with open(filename) as data:
+            self.local.data = ''.join(data)
+
+    def save_config(self, _type, _path):
+        self.local.stream = mocklib.StreamData(b'')
+        self.local.stream.set_data(self.local.data.encode(), 10)
+        return 1
+
+    def socket(self, *args):
+        stream = self.local.stream
+        return mock.Mock(recv=lambda *args: next(stream, b''))
+
+
 class TestStates(TestBase):
     """Test recording, importing, deleting and listing of device states.
 
@@ -419,14 +453,12 @@ class TestStates(TestBase):
     in `TestBase.setup_states_data`.
 
     """
-    def state_files(self, states, disabled):
-        return sorted(itertools.chain((st + '.state.cfg.disabled' for st in disabled),
-                                      *((st + '.state.cfg', st + '.state.cfg.load')
-                                        for st in states)))
-
     def check_states(self, states, disabled=[]):
-        statesfiles = os.listdir(os.path.join(self.test_run_dir, 'states'))
-        assert (sorted(statesfiles) == self.state_files(states, disabled))
+        states_dir = os.path.join(self.test_run_dir, 'states')
+        statesfiles = [name for name in os.listdir(states_dir) if name != '.store']
+        assert sorted(statesfiles) == sorted(st + '.state.cfg' for st in states)
+        assert (state_store.StateStore(states_dir).disabled_names()
+                == {st + '.state.cfg' for st in disabled})
 
     @xtest_patch
     def test_states_data(self, xpatch):
@@ -438,6 +470,36 @@ class TestStates(TestBase):
         obj = sp.get_object(tctx, None, {'device': mocklib.DEVICE_NAME})
         assert sorted(st['state'] for st in obj['states']) == sorted(self.states)
 
+    @xtest_patch
+    def test_states_list_data(self, xpatch):
+        log = mock.Mock()
+        sp = config_op.StatesListProvider(log)
+        self.setup_log(sp)
+        self.setup_states_data(xpatch.system)
+        tctx = mock.Mock(th=1)
+        args = {'device': mocklib.DEVICE_NAME}
+        keys = []
+        key = sp.get_next(tctx, None, args, -1)
+        while key is not None:
+            keys.append(key)
+            key = sp.get_next(tctx, None, args, len(keys) - 1)
+        assert keys == sorted(self.states)
+        args['states'] = 'state2'
+        assert sp.get_object(tctx, None, args) == {'state': 'state2'}
+
+    @xtest_patch
+    def test_states_data_disabled(self, xpatch):
+        log = mock.Mock()
+        sp = config_op.StatesProvider(log)
+        self.setup_log(sp)
+        self.setup_states_data(xpatch.system)
+        tctx = mock.Mock()
+        sp.get_object(tctx, None, {'device': mocklib.DEVICE_NAME})
+        self.check_output(self.invoke_action('disable-state', state_name='state1',
+                                             state_name_pattern=None))
+        obj = sp.get_object(tctx, None, {'device': mocklib.DEVICE_NAME})
+        assert [st['state'] for st in obj['states'] if 'disabled' in st] == ['state1']
+
     @xtest_patch
     def test_list_states(self, xpatch):
         self.setup_states_data(xpatch.system)
@@ -449,6 +511,18 @@ class TestStates(TestBase):
         rstates = eval(rest)
         assert sorted(rstates) == sorted(self.states)
 
+    @xtest_patch
+    def test_list_states_paged(self, xpatch):
+        self.setup_states_data(xpatch.system)
+        output = self.invoke_action('list-states', state_name_pattern='state*', offset=1, limit=5)
+        self.check_output(output, "Saved device states: ['state2'] (states 2-2 of 2)")
+        output = self.invoke_action('list-states', offset=0, limit=2)
+        self.check_output(output, "Saved device states: ['other.state1', 'state1'] (states 1-2 of 3)")
+        output = self.invoke_action('list-states', offset=3, limit=2)
+        self.check_output(output, "Saved device states: [] (no states at offset 3 of 3)")
+        output = self.invoke_action('list-states', offset=1, limit=0)
+        self.check_output(output, "Saved device states: [] (no states at offset 1 of 3)")
+
     @xtest_patch
     def test_record_state(self, xpatch):
         xpatch.system.socket_data(test_state_data.encode())
@@ -460,11 +534,62 @@ class TestStates(TestBase):
         self.check_output(output)
         state_path = 'states/test_state' + base_op.XmnrBase.cfg_statefile_extension
         assert os.path.exists(os.path.join(self.test_run_dir, state_path))
-        with open(os.path.join(self.test_run_dir, state_path + '.load')) as metadata:
-            assert metadata.read() == config_op.state_metadata
+        self.check_state_metadata(os.path.join(self.test_run_dir, state_path))
         with open(os.path.join(self.test_run_dir, state_path)) as state_data:
             assert state_data.read() == test_state_data
 
+    @xtest_patch
+    def test_record_state_skip_identical(self, xpatch):
+        self.setup_states_data(xpatch.system)
+        states_dir = os.path.join(self.test_run_dir, 'states')
+
+        def record(data):
+            xpatch.system.socket_data(data.encode())
+            return self.invoke_action('record-state',
+                                      state_name='new_state',
+                                      format="nso-c-style",
+                                      overwrite=True,
+                                      including_rollbacks=None,
+                                      skip_identical=True)
+        output = record('state2 test data')
+        self.check_output(output,
+                          "Recorded states []; identical to existing states: new_state = state2")
+        assert output.state_name == 'state2'
+        assert sorted(os.listdir(states_dir)) == \
+            sorted(['.store'] + [state + '.state.cfg' for state in self.states])
+        output = record('new test data')
+        self.check_output(output, "Recorded states ['new_state']")
+        assert output.state_name == 'new_state'
+        # recording the same configuration again leaves the state as it is
+        output = record('new test data')
+        self.check_output(output,
+                          "Recorded states []; identical to existing states: new_state = new_state")
+        with open(os.path.join(states_dir, 'new_state.state.cfg')) as state_data:
+            assert state_data.read() == 'new test data'
+
+    @xtest_patch
+    def test_record_state_legacy_digest(self, xpatch):
+        states_dir = os.path.abspath(os.path.join(self.test_run_dir, 'states'))
+        legacy = os.path.join(states_dir, 'legacy.state.cfg')
+        xpatch.system.ff_patcher.fs.create_file(legacy, contents='legacy test data')
+
+        def record(data):
+            xpatch.system.socket_data(data.encode())
+            return self.invoke_action('record-state',
+                                      state_name='new_state',
+                                      format="nso-c-style",
+                                      overwrite=True,
+                                      including_rollbacks=None,
+                                      skip_identical=True)
+        with mock.patch.object(state_store, 'file_digest',
+                               wraps=state_store.file_digest) as file_digest:
+            self.check_output(record('new test data'), "Recorded states ['new_state']")
+            self.check_output(record('other test data'), "Recorded states ['new_state']")
+        # the legacy state is hashed only once
+        assert [call[0][0] for call in file_digest.call_args_list].count(legacy) == 1
+        entry = state_store.StateStore(states_dir).read_manifest()['states']['legacy.state.cfg']
+        assert entry['digest']['sha256'] == state_store.file_digest(legacy)
+
     @xtest_patch
     def test_record_state_xml(self, xpatch):
         xpatch.system.socket_data(test_state_data_xml.encode())
@@ -474,13 +599,32 @@ class TestStates(TestBase):
                                     overwrite=False,
                                     including_rollbacks=None)
         self.check_output(output)
+        trans = xpatch.ncs.data['trans_mgr'].trans_obj
+        trans.save_config.assert_called_once_with(
+            _ncs.maapi.CONFIG_XML_PRETTY, "/ncs:devices/device{mock-device}/config")
         state_path = 'states/test_state_xml' + base_op.XmnrBase.xml_statefile_extension
         assert os.path.exists(os.path.join(self.test_run_dir, state_path))
-        with open(os.path.join(self.test_run_dir, state_path + '.load')) as metadata:
-            assert metadata.read() == config_op.state_metadata
+        self.check_state_metadata(os.path.join(self.test_run_dir, state_path))
         with open(os.path.join(self.test_run_dir, state_path)) as state_data:
             assert state_data.read() == test_state_data_xml
 
+    @xtest_patch
+    def test_record_state_rollbacks(self, xpatch):
+        xpatch.ncs.data['root'].drned_xmnr.worker_threads = 3
+        rollbacks = [mock.Mock(nr=nr, fixed_nr=10 - nr) for nr in (0, 1)]
+        with mock.patch('_ncs.maapi.list_rollbacks', return_value=rollbacks):
+            output = self.invoke_action('record-state',
+                                        state_name='test_state',
+                                        format="nso-c-style",
+                                        overwrite=False,
+                                        including_rollbacks=2)
+        self.check_output(output, "Recorded states ['test_state', 'test_state-1', 'test_state-2']")
+        trans = xpatch.ncs.data['trans_mgr'].trans_obj
+        assert sorted(trans.load_rollback.call_args_list) == [mock.call(0), mock.call(1)]
+        statesfiles = os.listdir(os.path.join(self.test_run_dir, 'states'))
+        assert sorted(name for name in statesfiles if name != '.store') == \
+            ['test_state-1.state.cfg', 'test_state-2.state.cfg', 'test_state.state.cfg']
+
     def invoke_import_state_files(self, path, expected_success=True, **extra_action_params):
         output = self.invoke_action('import-state-files',
                                     file_path_pattern=os.path.join(path, '*1.state.cfg'),
@@ -511,8 +655,64 @@ class TestStates(TestBase):
             filename = os.path.join(destdir, state + '.state.cfg')
             with open(filename) as state_file:
                 assert state_file.read() == test_data_p.format(state)
-            with open(filename + '.load') as metadata:
-                assert metadata.read() == config_op.state_metadata
+            self.check_state_metadata(filename)
+
+    @xtest_patch
+    def test_import_states_parallel(self, xpatch):
+        path = '/tmp/data'
+        xpatch.system.ff_patcher.fs.create_dir(path)
+        self.states = tuple('state{}1'.format(i) for i in range(20)) + ('fail1',)
+        self.setup_states_data(xpatch.system, state_path=path)
+        ThreadLoadSaveConfig(xpatch.system, xpatch.ncs)
+        xpatch.ncs.data['root'].drned_xmnr.worker_threads = 4
+        output = self.invoke_action('import-state-files',
+                                    file_path_pattern=os.path.join(path, '*1.state.cfg'),
+                                    format="c-style",
+                                    target_format="c-style",
+                                    merge=False)
+        assert output.failure.startswith('failed to import: the file /tmp/data/fail1.state.cfg')
+        part = 'Imported states: '
+        assert output.success.startswith(part)
+        assert sorted(output.success[len(part):].split(', ')) == sorted(self.states[:-1])
+        destdir = os.path.join(self.test_run_dir, 'states')
+        test_data_p = 'devices device {} config\n{{}} test data'.format(mocklib.DEVICE_NAME)
+        for state in self.states[:-1]:
+            with open(os.path.join(destdir, state + '.state.cfg')) as state_file:
+                assert state_file.read() == test_data_p.format(state)
+
+    @xtest_patch
+    def test_import_states_streamed(self, xpatch):
+        path = '/tmp/data'
+        config = ('<interface xmlns="urn:test" xmlns:t="urn:test-types">'
+                  '<name a="1">Gi<!-- comment -->0</name>\n  <type>t:eth</type>'
+                  '<shutdown/></interface><other xmlns="urn:other"><v>2</v></other>')
+        xml_data = '<config xmlns="{}">{}</config>'.format(config_op.CONFD_NS, config)
+        nso_xml_data = ('<config xmlns="{}"><devices xmlns="{}"><device><name>other</name>'
+                        '<config>{}</config></device></devices></config>').format(
+                            config_op.CONFD_NS, config_op.NCS_NS, config)
+        fs = xpatch.system.ff_patcher.fs
+        fs.create_file(os.path.join(path, 'xml', 'imp.xml'), contents=xml_data)
+        fs.create_file(os.path.join(path, 'nso-xml', 'imp.xml'), contents=nso_xml_data)
+        loader = LoadSaveConfig(xpatch.system, xpatch.ncs)
+        parser = etree.XMLParser(remove_blank_text=True, remove_comments=True)
+        for file_format in ('xml', 'nso-xml'):
+            results = []
+            # first with the XSLT / full parse, then streamed
+            for size in (1 << 20, 0):
+                with mock.patch('drned_xmnr.op.config_op.STREAMING_IMPORT_SIZE', size):
+                    output = self.invoke_action('import-state-files',
+                                                file_path_pattern=os.path.join(
+                                                    path, file_format, '*.xml'),
+                                                format=file_format,
+                                                target_format='xml',
+                                                merge=False,
+                                                overwrite=True)
+                self.check_output(output)
+                results.append(etree.tostring(etree.fromstring(loader.data, parser),
+                                              method='c14n'))
+            assert results[0] == results[1]
+            assert b'<name>mock-device</name>' in results[1]
+            assert b'<type>t:eth</type>' in results[1]
 
     @xtest_patch
     def test_import_states_skip(self, xpatch):
@@ -533,6 +733,30 @@ class TestStates(TestBase):
         states = self.invoke_import_state_files(path, overwrite=True)
         assert len(states) > 0
 
+    @xtest_patch
+    def test_check_states_cached(self, xpatch):
+        self.setup_states_data(xpatch.system)
+        xpatch.ncs.data['root'].drned_xmnr.worker_threads = 2
+
+        def load_config(_flags, filename):
+            if os.path.basename(filename).startswith('state2'):
+                raise mocklib.MockNcsError('bad\nstate')
+        trans = mocklib.CxMgrMock(load_config=mock.Mock(side_effect=load_config))
+        xpatch.ncs.data['trans_mgr'].trans_obj = trans
+
+        def check(expected_loads, validate=False):
+            trans.load_config.reset_mock()
+            output = self.invoke_action('check-states', validate=validate)
+            assert output.failure == 'states not consistent with the device model: \nstate2: bad state'
+            assert trans.load_config.call_count == expected_loads
+        check(3)
+        check(0)
+        check(3, validate=True)
+        with open(os.path.join(self.test_run_dir, 'states', 'state1.state.cfg'), 'a') as state:
+            state.write('changed\n')
+        check(1)
+        check(1, validate=True)
+
     @xtest_patch
     def test_delete_states_pattern(self, xpatch):
         self.setup_states_data(xpatch.system)
@@ -587,6 +811,56 @@ class TestStates(TestBase):
         self.check_states([state for state in self.states if state != 'other.state1'],
                           ['state1'])
 
+    @xtest_patch
+    def test_import_sidecars(self, xpatch):
+        states_dir = os.path.join(self.test_run_dir, 'states')
+        for state in self.states:
+            filename = os.path.join(states_dir, state + '.state.cfg')
+            xpatch.system.ff_patcher.fs.create_file(filename, contents='{} test data'.format(state))
+            xpatch.system.ff_patcher.fs.create_file(filename + '.load',
+                                                    contents=config_op.state_metadata)
+        xpatch.system.ff_patcher.fs.create_file(os.path.join(states_dir, 'state2.state.cfg.disabled'))
+        output = self.invoke_action('list-states')
+        self.check_output(output, "Saved device states: ['other.state1', 'state1', 'state2']"
+                          " disabled states: ['state2']")
+        self.check_states(self.states, ['state2'])
+        self.check_state_metadata(os.path.join(states_dir, 'state1.state.cfg'))
+
+    @xtest_patch
+    def test_import_sidecars_gone(self, xpatch):
+        # sidecars listed but removed by a concurrent migration
+        states_dir = os.path.join(self.test_run_dir, 'states')
+        filename = os.path.join(states_dir, 'state1.state.cfg')
+        xpatch.system.ff_patcher.fs.create_file(filename, contents='state1 test data')
+        xpatch.system.ff_patcher.fs.create_file(filename + '.load',
+                                                contents=config_op.state_metadata)
+        store = state_store.StateStore(states_dir)
+        with mock.patch.object(store, 'sidecar_names',
+                               return_value=['state1.state.cfg.load', 'state2.state.cfg.load']):
+            store.import_sidecars()
+        assert store.read_manifest()['states'] == {'state1.state.cfg':
+                                                   {'load': config_op.state_metadata}}
+        os.remove(store.manifest_path)
+        with mock.patch.object(store, 'sidecar_names', return_value=[]) as names:
+            store.import_sidecars()
+            store.import_sidecars()
+        names.assert_called_once()
+
+    @xtest_patch
+    def test_prepared_overlapping(self, xpatch):
+        # two runs using the same state, the first one ends first
+        self.setup_states_data(xpatch.system)
+        states_dir = os.path.join(self.test_run_dir, 'states')
+        filename = os.path.join(states_dir, 'state1.state.cfg')
+        store = state_store.StateStore(states_dir)
+        first = store.prepared([filename])
+        first.__enter__()
+        with store.prepared([filename]):
+            first.__exit__(None, None, None)
+            with open(filename + '.load') as metadata:
+                assert metadata.read() == config_op.state_metadata
+        assert not os.path.exists(filename + '.load')
+
     @xtest_patch
     def test_check_states(self, xpatch):
         self.setup_states_data(xpatch.system)
@@ -608,6 +882,143 @@ class TestStates(TestBase):
         assert ['{}: {}'.format(state, load_calls.exc_message.format(state))
                 for state in sorted(failures)] == sorted(rest_msgs)
 
+    select_state_data = {
+        'both': ('xml', '<iface><name>a</name><mtu>1</mtu></iface>'
+                        '<iface><name>b</name><mtu>2</mtu></iface>'),
+        'one': ('xml', '<iface><name>a</name><mtu>3</mtu></iface>'),
+        'host': ('xml', '<hostname>h</hostname>'),
+        'host-descr': ('cfg', '<hostname>h</hostname>'
+                              '<iface><name>c</name><description>d</description></iface>'),
+        'descr': ('xml', '<iface><name>c</name><description>d</description></iface>')}
+
+    def setup_select_states(self, xpatch):
+        states_dir = os.path.join(self.test_run_dir, 'states')
+        for state, (format, config) in self.select_state_data.items():
+            data = test_state_data_xml.replace(
+                '<aaa', '<test xmlns="urn:test">{}</test><aaa'.format(config))
+            filename = os.path.join(states_dir, '{}.state.{}'.format(state, format))
+            xpatch.system.ff_patcher.fs.create_file(filename, contents=data)
+        xpatch.ncs.data['root'].drned_xmnr.worker_threads = 2
+        ThreadLoadSaveConfig(xpatch.system, xpatch.ncs)
+
+    @xtest_patch
+    def test_select_states(self, xpatch):
+        self.setup_select_states(xpatch)
+        output = self.invoke_action('select-states', disable_others=False)
+        self.check_output(output, "Selected states: ['both', 'host-descr'];"
+                          " not needed: ['descr', 'host', 'one']")
+        states_dir = os.path.join(self.test_run_dir, 'states')
+        assert state_store.StateStore(states_dir).disabled_names() == set()
+
+    @xtest_patch
+    def test_select_states_disable(self, xpatch):
+        self.setup_select_states(xpatch)
+        output = self.invoke_action('select-states', disable_others=True)
+        self.check_output(output, "Selected states: ['both', 'host-descr'];"
+                          " disabled: ['descr', 'host', 'one']")
+        states_dir = os.path.join(self.test_run_dir, 'states')
+        assert (state_store.StateStore(states_dir).disabled_names()
+                == {'descr.state.xml', 'host.state.xml', 'one.state.xml'})
+        output = self.invoke_action('select-states', disable_others=True)
+        self.check_output(output, "Selected states: ['both', 'host-descr']")
+
+    @xtest_patch
+    def test_index_states(self, xpatch):
+        self.setup_select_states(xpatch)
+        with mock.patch.object(config_op, 'config_coverage',
+                               wraps=config_op.config_coverage) as coverage:
+            output = self.invoke_action('index-states', node=[], state_name=None)
+            self.check_output(output, 'Indexed 5 states')
+            assert coverage.call_count == 5
+            output = self.invoke_action('index-states', node=['/test/iface/mtu'], state_name=None)
+            self.check_output(output, "States setting the nodes: ['both', 'one']")
+            output = self.invoke_action('index-states', node=['/{urn:test}test/{urn:test}hostname',
+                                                              '/test/iface/description'],
+                                        state_name=None)
+            self.check_output(output, "States setting the nodes: ['descr', 'host', 'host-descr']")
+            output = self.invoke_action('index-states', node=[], state_name='one')
+            self.check_output(output)
+            lines = output.success.split('\n')
+            assert lines[0] == 'Nodes set by one:'
+            assert [line for line in lines if line.startswith('/test')] == \
+                ['/test', '/test/iface', '/test/iface/mtu', '/test/iface/name']
+            # only the changed state is read again
+            filename = os.path.join(self.test_run_dir, 'states', 'one.state.xml')
+            os.remove(filename)
+            xpatch.system.ff_patcher.fs.create_file(filename, contents=test_state_data_xml.replace(
+                '<aaa', '<test xmlns="urn:test"><hostname>o</hostname></test><aaa'))
+            output = self.invoke_action('index-states', node=['/test/iface/mtu'], state_name=None)
+            self.check_output(output, "States setting the nodes: ['both']")
+            assert coverage.call_count == 6
+            output = self.invoke_action('index-states', node=[], state_name='none')
+            assert output.failure == 'No such state: none'
+
+
+class TestCompressedStates(TestBase):
+    """Tests of states stored with the compressed state storage."""
+
+    def record_states(self, xpatch, *names):
+        xpatch.ncs.data['root'].drned_xmnr.state_storage = 'compressed'
+        for name in names:
+            xpatch.system.socket_data(test_state_data.encode())
+            output = self.invoke_action('record-state',
+                                        state_name=name,
+                                        format="nso-c-style",
+                                        overwrite=False,
+                                        including_rollbacks=None)
+            self.check_output(output)
+
+    @xtest_patch
+    def test_record_compressed(self, xpatch):
+        self.record_states(xpatch, 'state1', 'state2')
+        states_dir = os.path.join(self.test_run_dir, 'states')
+        assert os.listdir(states_dir) == ['.store']
+        objects = os.listdir(os.path.join(states_dir, '.store', 'objects'))
+        assert len(objects) == 1
+        output = self.invoke_action('list-states')
+        self.check_output(output, "Saved device states: ['state1', 'state2']")
+        output = self.invoke_action('view-state', state_name='state2')
+        self.check_output(output, test_state_data)
+
+    @xtest_patch
+    def test_materialize_compressed(self, xpatch):
+        self.record_states(xpatch, 'state1', 'state2')
+        xpatch.ncs.data['root'].drned_xmnr.materialized_states = 1
+        state_file = os.path.join(self.test_run_dir, 'states', '{}.state.cfg')
+        for state in ('state1', 'state2'):
+            output = self.invoke_action('transition-to-state', state_name=state, rollback=False)
+            self.check_output(output)
+            with open(state_file.format(state)) as data:
+                assert data.read() == test_state_data
+        assert not os.path.exists(state_file.format('state1'))
+
+    @xtest_patch
+    def test_delete_compressed(self, xpatch):
+        self.record_states(xpatch, 'state1', 'state2')
+        objects_dir = os.path.join(self.test_run_dir, 'states', '.store', 'objects')
+        self.check_output(self.invoke_action('delete-state', state_name='state1',
+                                             state_name_pattern=None))
+        assert len(os.listdir(objects_dir)) == 1
+        self.check_output(self.invoke_action('delete-state', state_name='state2',
+                                             state_name_pattern=None))
+        assert os.listdir(objects_dir) == []
+        output = self.invoke_action('list-states')
+        self.check_output(output, "Saved device states: []")
+
+    @xtest_patch
+    def test_exists_compressed(self, xpatch):
+        self.record_states(xpatch, 'state1', 'state2')
+        states_dir = os.path.join(self.test_run_dir, 'states')
+        store = state_store.StateStore(states_dir, compressed=True)
+        filenames = [os.path.join(states_dir, name + '.state.cfg')
+                     for name in ('state1', 'state2', 'state3')]
+        with mock.patch.object(store, 'read_manifest', wraps=store.read_manifest) as read:
+            assert [store.exists(filename) for filename in filenames * 10] == [True, True, False] * 10
+            # the manifest is read again only when it changes
+            assert read.call_count == 1
+            store.remove(filenames[0])
+            assert [store.exists(filename) for filename in filenames] == [False, True, False]
+
 
 class TestConvertMessage(TestBase):
     """Test the `import-convert` action.
@@ -695,6 +1106,43 @@ class TestConvertMessage(TestBase):
         calls = iter(xpatch.ncs.data['ncs']['cli_write'].call_args_list)
         assert ''.join(self.expected_writes()) == ''.join(call[0][2] for call in calls)
 
+    def instance_popen_effect(self, args, **kwargs):
+        devname = args[args.index('--devname') + 1]
+        files = [arg for arg in args if isinstance(arg, str) and arg.startswith(self.config_path)]
+        data = []
+        for filename in files:
+            state = os.path.splitext(os.path.basename(filename))[0]
+            path = os.path.join(kwargs['cwd'], 'drned-ncs', state + '.xml')
+            content = ('<config xmlns="{}"><devices xmlns="{}"><device><name>{}</name>'
+                       '<config><data>{}</data></config></device></devices></config>').format(
+                           config_op.CONFD_NS, config_op.NCS_NS, devname, state)
+            self.system.ff_patcher.fs.create_file(path, contents=content)
+            data.append('converting {} to {}'.format(filename, path))
+            data.append('converted {} to {}'.format(filename, path))
+        self.system.proc_data(b''.join((line + '\n').encode() for line in data))
+        self.devnames.append(devname)
+        return mock.DEFAULT
+
+    @xtest_patch
+    def test_convert_instances(self, xpatch):
+        self.setup_config_files(xpatch.system)
+        xpatch.ncs.data['root'].devices.device['instance'] = xpatch.ncs.data['device']
+        self.devnames = []
+        xpatch.system.patches['subprocess']['Popen'].side_effect = self.instance_popen_effect
+        output = self.invoke_action('import-convert-cli-files',
+                                    file_path_pattern=self.config_pattern,
+                                    overwrite=True,
+                                    device_instances=['instance', mocklib.DEVICE_NAME])
+        self.check_output(output, 'Imported states: ' + ', '.join(sorted(self.config_states)))
+        assert sorted(self.devnames) == ['instance', mocklib.DEVICE_NAME]
+        for state in self.config_states:
+            filename = os.path.join(self.test_run_dir, 'states', state + '.state.xml')
+            with open(filename, 'rb') as state_data:
+                config = etree.parse(state_data)
+            assert config.xpath('//ns:device/ns:name/text()',
+                                namespaces={'ns': config_op.NCS_NS}) == [mocklib.DEVICE_NAME]
+            assert config.xpath('//ns:data/text()', namespaces={'ns': config_op.NCS_NS}) == [state]
+
 
 class StopTestTimer(object):
     def __init__(self, **args):
@@ -741,7 +1189,8 @@ class TestTransitions(TransitionsTestBase):
         self.check_drned_call(call, state, rollback)
         return state
 
-    def check_drned_call(self, call, state=None, rollback=False, fnames=None, builtin_drned=False):
+    def check_drned_call(self, call, state=None, rollback=False, fnames=None, builtin_drned=False,
+                         maapi=False):
         if fnames is None:
             test = 'test_template_single' if rollback else 'test_template_raw'
             test_args = ['-k {}[{}.state.cfg]'.format(test, state)]
@@ -756,6 +1205,8 @@ class TestTransitions(TransitionsTestBase):
         args = ['py.test', '-s', '--tb=short', '--device=' + mocklib.DEVICE_NAME]
         if not builtin_drned:
             args.append('--unreserved')
+        if maapi:
+            args.append('--use=use_maapi=True')
         args += test_args
         assert sorted(call[0][0]) == sorted(args)
 
@@ -804,6 +1255,33 @@ class TestTransitions(TransitionsTestBase):
         popen_mock = xpatch.system.patches['subprocess']['Popen']
         self.check_drned_call(popen_mock.call_args, 'state1', rollback=False, builtin_drned=True)
 
+    @xtest_patch
+    def test_transition_maapi_backend(self, xpatch):
+        self.setup_states_data(xpatch.system)
+        root = xpatch.ncs.data['root']
+        root.drned_xmnr.drned_directory = 'builtin'
+        root.drned_xmnr.drned_backend = 'maapi'
+        output = self.invoke_action('transition-to-state',
+                                    state_name='state1',
+                                    rollback=False)
+        self.check_output(output)
+        popen_mock = xpatch.system.patches['subprocess']['Popen']
+        self.check_drned_call(popen_mock.call_args, 'state1', rollback=False, builtin_drned=True,
+                              maapi=True)
+
+    @xtest_patch
+    def test_transition_maapi_backend_external(self, xpatch):
+        self.setup_states_data(xpatch.system)
+        root = xpatch.ncs.data['root']
+        root.drned_xmnr.drned_backend = 'maapi'
+        output = self.invoke_action('transition-to-state',
+                                    state_name='state1',
+                                    rollback=False)
+        popen_mock = xpatch.system.patches['subprocess']['Popen']
+        popen_mock.assert_not_called()
+        assert output.failure is not None
+        assert output.failure.startswith('The maapi DrNED backend needs the builtin DrNED')
+
     @xtest_patch
     def test_explore_states(self, xpatch):
         self.setup_states_data(xpatch.system)
@@ -1274,6 +1752,76 @@ class TestCoverage(TestBase):
         for group in self.collect_groups:
             assert data['percents'][group] == collect_dict[group]
 
+    coverage_result = {'nodes-total': 3, 'lists-total': 1,
+                       'percents': {'nodes': {'set': {'total': 0, 'percent': 0}}},
+                       'uncovered': {'nodes-set': ['/c/x', '/a/b', '/c/y'], 'lists-deleted': []}}
+
+    @xtest_patch
+    def test_coverage_collect_worker(self, xpatch):
+        response = {'result': self.coverage_result, 'output': 'report'}
+        popen_mock = xpatch.system.patches['subprocess']['Popen']
+        worker = popen_mock.return_value
+        worker.poll = mock.Mock(return_value=None)
+        worker.stdout.readline.return_value = json.dumps(response).encode() + b'\n'
+        # the worker responds after two silent waits
+        select_mock = xpatch.system.patches['select']['select']
+        select_mock.side_effect = [([], [], [])] * 2 + [([1], [], [])] * 2
+        timeout_mock = xpatch.ncs.data['ncs']['action_set_timeout']
+        with mock.patch.dict(coverage_op.CoverageWorker._workers, clear=True):
+            output = self.invoke_action('collect', yang_patterns=['pat1'])
+            self.check_output(output)
+            assert timeout_mock.call_count == 3
+            output = self.invoke_action('collect', yang_patterns=['pat1'], live=True)
+            self.check_output(output)
+        # the worker is started once and serves both requests
+        popen_mock.assert_called_once()
+        assert popen_mock.call_args[0][0][-1] == os.path.abspath(coverage_worker.__file__)
+        request = json.loads(worker.stdin.write.call_args[0][0])
+        assert request['device'] == mocklib.DEVICE_NAME
+        assert request['directory'].endswith('drned-skeleton')
+        assert request['live']
+        assert request['target'] == os.path.abspath(os.path.join(self.test_run_dir,
+                                                                 coverage_op.COVERAGE_DATA))
+        log = mock.Mock()
+        obj = coverage_op.DataHandler(log).get_object(mock.Mock(), None,
+                                                      {'device': mocklib.DEVICE_NAME})
+        assert obj['drned-xmnr']['coverage']['data']['nodes-total'] == 3
+
+    @xtest_patch
+    def test_coverage_collect_result(self, xpatch):
+        def write_result(*args, **kwargs):
+            if 'cwd' in kwargs:
+                path = os.path.join(kwargs['cwd'], coverage_op.DRNED_RESULT)
+                xpatch.system.ff_patcher.fs.create_file(path,
+                                                        contents=json.dumps(self.coverage_result))
+            return mock.DEFAULT
+
+        xpatch.system.patches['subprocess']['Popen'].side_effect = write_result
+        with mock.patch.dict(coverage_op.CoverageWorker._workers, clear=True):
+            output = self.invoke_action('collect', yang_patterns=['pat1'], live=True)
+        self.check_output(output, 'Completed successfully; live coverage not supported by DrNED')
+        result = self.coverage_result
+        log = mock.Mock()
+        tctx = mock.Mock()
+        obj = coverage_op.DataHandler(log).get_object(tctx, None, {'device': mocklib.DEVICE_NAME})
+        data = obj['drned-xmnr']['coverage']['data']
+        assert data == {'nodes-total': 3, 'lists-total': 1, 'percents': result['percents']}
+        args = {'device': mocklib.DEVICE_NAME}
+        categories = coverage_op.UncoveredProvider(log)
+        keys = []
+        key = categories.get_next(tctx, None, args, -1)
+        while key is not None:
+            keys.append(key)
+            key = categories.get_next(tctx, None, args, len(keys) - 1)
+        assert sorted(keys) == ['lists-deleted', 'nodes-set']
+        args['uncovered'] = 'nodes-set'
+        assert categories.get_object(tctx, None, args) == {'category': 'nodes-set', 'count': 3}
+        nodes = coverage_op.UncoveredNodesProvider(log)
+        paths = [nodes.get_next(tctx, None, args, i) for i in range(-1, 3)]
+        assert paths == ['/a/b', '/c/x', '/c/y', None]
+        assert nodes.get_object(tctx, None, dict(args, node='/c/x')) == {'path': '/c/x'}
+        assert nodes.get_object(tctx, None, dict(args, node='/c/z')) == {}
+
     @xtest_patch
     def test_coverage_collect_defaults(self, xpatch):
         collect_dict = {'nodes-total': randint(0, 1000), 'lists-total': randint(0, 1000)}
@@ -0,0 +1,424 @@
+import io
+import os
+import shutil
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'drned'))
+
+# mocklib replaces the drned package, the coverage module needs the real one
+drned_mock = sys.modules.pop('drned')
+try:
+    from common import test_coverage  # noqa: E402
+    from drned import device, schema  # noqa: E402
+finally:
+    sys.modules['drned'] = drned_mock
+
+
+test_yang = '''\
+module test {
+  namespace "urn:test";
+  prefix t;
+  container router {
+    list bgp {
+      key as-no;
+      leaf as-no {
+        type uint32;
+      }
+      list neighbor {
+        key id;
+        leaf id {
+          type string;
+        }
+        leaf remote-as {
+          type uint32;
+        }
+      }
+    }
+  }
+  container system {
+    leaf hostname {
+      type string;
+    }
+  }
+}
+'''
+
+snapshot = '''\
+<config xmlns="http://tail-f.com/ns/config/1.0">
+  <devices xmlns="http://tail-f.com/ns/ncs">
+    <device>
+      <name>dev</name>
+      <config>
+        <router xmlns="urn:test">
+          <bgp>
+            <as-no>1</as-no>
+            <neighbor>
+              <id>a</id>
+              <remote-as>10</remote-as>
+            </neighbor>
+          </bgp>
+          <bgp>
+            <as-no>2</as-no>
+            <neighbor>
+              <id>a</id>
+              <remote-as>20</remote-as>
+            </neighbor>
+          </bgp>
+        </router>
+        <system xmlns="urn:test">
+          <hostname>dev</hostname>
+        </system>
+      </config>
+    </device>
+  </devices>
+</config>
+'''
+
+
+class TestCoverage:
+    def read_snapshot(self, tmp_path, monkeypatch, include, exclude):
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setenv('NCS_DIR', str(tmp_path))
+        (tmp_path / 'test.yang').write_text(test_yang)
+        monkeypatch.setattr(test_coverage._Coverage, 'schema', schema.Schema(['test.yang']))
+        for attr in ('paths', 'node_ids', 'index', 'index_key'):
+            monkeypatch.setattr(test_coverage._Coverage, attr, getattr(test_coverage._Coverage, attr))
+        coverage = {}
+        list_keys = {}
+        prefixes = test_coverage._Prefixes(include, exclude)
+        test_coverage._index_schema(prefixes)
+        assert test_coverage._read_snapshot(io.BytesIO(snapshot.encode()), 'dev', False,
+                                            coverage, list_keys, prefixes)
+        return coverage, list_keys
+
+    def test_include_below_list(self, tmp_path, monkeypatch):
+        coverage, list_keys = self.read_snapshot(tmp_path, monkeypatch,
+                                                 ['/router/bgp/neighbor'], [])
+        ns = '{urn:test}'
+        bgp = '/{0}router/{0}bgp'.format(ns)
+        assert list_keys[bgp] == {'1', '2'}
+        for as_no, remote_as in (('1', '10'), ('2', '20')):
+            path = '{}[{}]/{}neighbor[a]/{}remote-as'.format(bgp, as_no, ns, ns)
+            assert coverage[path].value == remote_as
+        # the rest of the model is not expanded
+        assert test_coverage._Coverage.schema.path_index is None
+        assert not [path for path in test_coverage._Coverage.index if 'system' in path]
+        assert not [path for path in coverage if 'system' in path]
+
+    def test_exclude_list_key(self, tmp_path, monkeypatch):
+        coverage, list_keys = self.read_snapshot(tmp_path, monkeypatch,
+                                                 [], ['/router/bgp/as-no'])
+        bgp = '/{0}router/{0}bgp'.format('{urn:test}')
+        assert list_keys[bgp] == {'1', '2'}
+        assert len([path for path in coverage if path.endswith('remote-as')]) == 2
+
+
+# A model in two modules, and sessions with snapshots of its
+# configuration; old reports of the sessions are in testdata
+a_yang = """\
+module a {
+  namespace "urn:a";
+  prefix a;
+  grouping g {
+    leaf gl {
+      type string;
+    }
+    leaf gm {
+      type empty;
+    }
+  }
+  container top {
+    leaf x {
+      type int32;
+    }
+    choice c {
+      case c1 {
+        leaf y {
+          type string;
+        }
+      }
+      case c2 {
+        container z {
+          uses g;
+        }
+      }
+    }
+    list l {
+      key name;
+      leaf name {
+        type string;
+      }
+      leaf-list ll {
+        type string;
+      }
+      uses g;
+    }
+    list m {
+      key "k1 k2";
+      leaf k1 {
+        type string;
+      }
+      leaf k2 {
+        type string;
+      }
+      leaf v {
+        type string;
+      }
+      list n {
+        key id;
+        leaf id {
+          type string;
+        }
+        leaf w {
+          type string;
+        }
+      }
+    }
+  }
+}
+"""
+
+b_yang = """\
+module b {
+  namespace "urn:b";
+  prefix b;
+  import a {
+    prefix a;
+  }
+  augment /a:top {
+    leaf bl {
+      type string;
+    }
+    container bc {
+      leaf bcl {
+        type int8;
+      }
+    }
+  }
+  container btop {
+    leaf q {
+      type string;
+    }
+    container p {
+      presence true;
+      leaf r {
+        type string;
+      }
+    }
+  }
+}
+"""
+
+device_snapshot = ('<config xmlns="http://tail-f.com/ns/config/1.0">'
+                   '<devices xmlns="http://tail-f.com/ns/ncs"><device>'
+                   '<name>{}</name><config>{}</config>'
+                   '</device></devices></config>\n')
+
+# Snapshots of the device configuration by session; the control
+# character is not allowed in XML, that snapshot is read again without
+# it
+sessions = {
+    '1000': ('real-dev', [
+        '<top xmlns="urn:a"><x>1</x>'
+        '<l><name>a</name><ll>p</ll><ll>q</ll><gl>1</gl></l>'
+        '<m><k1>1</k1><k2>x</k2><v>1</v><n><id>i</id><w>0</w></n></m></top>'
+        '<btop xmlns="urn:b"><q>1</q></btop>',
+        '<top xmlns="urn:a"><x>2</x><y>1</y>'
+        '<l><name>a</name><ll>p</ll></l><l><name>b</name></l>'
+        '<m><k1>1</k1><k2>x</k2><v>2</v></m><m><k1>1</k1><k2>y</k2></m>'
+        '<bl xmlns="urn:b">1</bl></top>'
+        '<btop xmlns="urn:b"><p/></btop>',
+        '<top xmlns="urn:a"><z><gl>1</gl><gm/></z>'
+        '<l><name>b</name><gl>2</gl></l>'
+        '<m><k1>2</k1><k2>x</k2><n><id>j</id></n></m>'
+        '<bc xmlns="urn:b"><bcl>1</bcl></bc></top>'
+        '<unknown xmlns="urn:a"><u>1</u></unknown>',
+        '']),
+    '1001': ('netsim-0', [
+        '<top xmlns="urn:a"><x>0</x><l><name>c</name><gl>0</gl></l></top>'
+        '<btop xmlns="urn:b"><q>2</q></btop>',
+        '<top xmlns="urn:a"><l><name>c</name></l><l><name>d</name></l>'
+        '<m><k1>1</k1><k2>y</k2><v>0</v><n><id>i</id></n>'
+        '<n><id>j</id><w>1</w></n></m></top>',
+        '<top xmlns="urn:a"><l><name>c</name></l><l><name>d</name></l>'
+        '<m><k1>1</k1><k2>y</k2><v>0</v><n><id>i</id></n>'
+        '<n><id>j</id><w>1</w></n></m></top>',
+        '<top xmlns="urn:a"><x>3</x></top>']),
+    '1002': ('real-dev', [
+        '<top xmlns="urn:a"><z><gm/></z></top>',
+        '<top xmlns="urn:a"><y>2</y><l><name>a\x01</name><ll>r</ll></l></top>']),
+}
+
+
+def write_session(session):
+    (device, configs) = sessions[session]
+    covdir = os.path.join('drned-work', 'coverage', session)
+    os.makedirs(covdir)
+    snapshots = []
+    for (i, config) in enumerate(configs):
+        snapshots.append(os.path.join(covdir, '{}.xml'.format(100000 + i)))
+        with open(snapshots[-1], 'wb') as f:
+            f.write(device_snapshot.format(device, config).encode())
+    return snapshots
+
+
+def normalize(report):
+    """Split a coverage report into lines and sections of paths.
+
+    Paths are in no particular order within a section; messages about
+    snapshots (errors, skipped elements) are left out.
+    """
+    result = []
+    section = None
+    namespace = ''
+    for line in report.splitlines():
+        if not line or line.startswith(('Use YANG', 'NOTE: skipping', 'Error when')) \
+           or line.endswith('.yang'):
+            continue
+        if line.startswith(('### ', 'NOTE: the following')):
+            section = set()
+            namespace = ''
+            result.append((line, section))
+        elif section is not None and line.startswith('  namespace: '):
+            namespace = line[len('  namespace: '):]
+        elif section is not None and line.startswith(('  /', '/')):
+            section.add((namespace, line.strip()))
+        else:
+            section = None
+            result.append(line)
+    return result
+
+
+def old_report(name):
+    path = os.path.join(os.path.dirname(__file__), 'testdata', 'coverage-{}.txt'.format(name))
+    with open(path) as f:
+        return normalize(f.read())
+
+
+class TestCoverageReport:
+    @pytest.fixture
+    def covdir(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setenv('NCS_DIR', str(tmp_path))
+        (tmp_path / 'a.yang').write_text(a_yang)
+        (tmp_path / 'b.yang').write_text(b_yang)
+        for session in sorted(sessions):
+            write_session(session)
+        monkeypatch.setattr(test_coverage, '_readers', type(test_coverage._readers)())
+        for attr in ('schema', 'paths', 'node_ids', 'index', 'index_key'):
+            monkeypatch.setattr(test_coverage._Coverage, attr, getattr(test_coverage._Coverage, attr))
+        return tmp_path
+
+    def report(self, capsys, argv=[], devname=None, jobs=1, states=None):
+        test_coverage.test_coverage(['a.yang', 'b.yang'], argv, True, devname,
+                                    jobs=jobs, states=states)
+        return capsys.readouterr().out
+
+    @pytest.mark.parametrize('jobs', [1, 3])
+    def test_parallel_sessions(self, covdir, capsys, jobs):
+        assert normalize(self.report(capsys, jobs=jobs)) == old_report('all')
+        assert normalize(self.report(capsys, ['/top/l'], jobs=jobs)) == old_report('include')
+
+    @pytest.mark.parametrize('argv, devname, old', [
+        ([], None, 'all'),
+        (['/top/l'], None, 'include'),
+        (['^/top/m'], None, 'exclude'),
+        ([], 'real', 'real'),
+        ([], 'netsim', 'netsim')])
+    def test_read_snapshots(self, covdir, capsys, argv, devname, old):
+        report = self.report(capsys, argv, devname)
+        assert normalize(report) == old_report(old)
+        if devname != 'netsim':
+            assert 'Error when scanning drned-work/coverage/1002/100001.xml' in report
+
+    def test_read_pretty_snapshots(self, covdir, capsys):
+        for session in sessions:
+            for fn in os.listdir(os.path.join('drned-work', 'coverage', session)):
+                path = os.path.join('drned-work', 'coverage', session, fn)
+                with open(path) as f:
+                    xml = f.read()
+                with open(path, 'w') as f:
+                    f.write(xml.replace('><', '>\n  <'))
+        assert normalize(self.report(capsys)) == old_report('all')
+
+    def restart(self, monkeypatch):
+        # As in a new process, the cached coverage of the sessions is
+        # used; the schema nodes may be numbered in another order
+        monkeypatch.setattr(test_coverage, '_readers', type(test_coverage._readers)())
+        monkeypatch.setattr(test_coverage._Coverage, 'index_key', None)
+        monkeypatch.setattr(test_coverage, '_read_snapshot_file', None)
+
+    def test_cached_report(self, covdir, capsys, monkeypatch):
+        self.report(capsys)
+        self.restart(monkeypatch)
+        assert normalize(self.report(capsys, ['/top/l'])) == old_report('include')
+        assert normalize(self.report(capsys)) == old_report('all')
+        assert normalize(self.report(capsys, ['^/top/m'])) == old_report('exclude')
+
+    def test_restore_bits(self, monkeypatch):
+        monkeypatch.setattr(test_coverage._Coverage, 'paths', ['/c', '/a'])
+        monkeypatch.setattr(test_coverage._Coverage, 'node_ids', {'/c': 0, '/a': 1})
+        bits = test_coverage._CoverageBits.restore(['/a', '/b', '/c'],
+                                                   {'was_read': 0b111, 'was_set': 0b100})
+        assert test_coverage._Coverage.paths == ['/c', '/a', '/b']
+        assert bits.bits['was_read'] == 0b111
+        assert bits.bits['was_set'] == 0b001
+        assert test_coverage._bit_paths(bits.bits['was_read']) == ['/a', '/b', '/c']
+        # the same numbering is used as it is
+        bits = test_coverage._CoverageBits.restore(['/c', '/a'], {'was_read': 0b10})
+        assert bits.bits['was_read'] == 0b10
+
+    def test_prefixes_use_cache(self, covdir, capsys, monkeypatch):
+        shutil.rmtree(os.path.join('drned-work', 'coverage', '1002'))
+        self.report(capsys)
+        read = []
+        read_snapshot_file = test_coverage._read_snapshot_file
+        monkeypatch.setattr(test_coverage, '_read_snapshot_file',
+                            lambda path, *args: read.append(path) or read_snapshot_file(path, *args))
+        # only the session added since is read, with the prefixes
+        snapshots = write_session('1002')
+        assert normalize(self.report(capsys, ['/top/l'])) == old_report('include')
+        assert read == snapshots
+        assert normalize(self.report(capsys, ['^/top/m'])) == old_report('exclude')
+        assert read == snapshots * 2
+        assert normalize(self.report(capsys)) == old_report('all')
+        assert read == snapshots * 3
+
+    def test_states(self, covdir, capsys):
+        states = {'1000': ['(init)', 'st1', 'st2', 'st2'],
+                  '1001': ['(init)', 'st2', 'st2', 'st1'],
+                  '1002': ['(init)', 'st1']}
+        for (session, names) in states.items():
+            with open(os.path.join('drned-work', 'coverage', session, 'snapshots.txt'), 'w') as index:
+                for (i, state) in enumerate(names):
+                    index.write('{}.xml\t{}\n'.format(100000 + i, state))
+        report = self.report(capsys, states=['st*'])
+        (report, _, per_state) = report.partition('\nNodes and lists set or deleted per state:\n')
+        assert normalize(report) == old_report('all')
+        assert per_state.splitlines() == [
+            '     7 set,      8 deleted,      0 by this state only: st1',
+            '     7 set,      5 deleted,        from (init)',
+            '     1 set,      5 deleted,        from st2',
+            '     9 set,     13 deleted,      2 by this state only: st2',
+            '     5 set,      3 deleted,        from (init)',
+            '     6 set,      7 deleted,        from st1',
+            '     0 set,      7 deleted,        from st2',
+            '  /top/z/gl',
+            '  /top/{urn:b}bc/bcl']
+
+    @pytest.mark.parametrize('devname, old', [(None, 'all'), ('real', 'real')])
+    def test_snapshot_objects(self, covdir, capsys, devname, old):
+        # the empty snapshot is stored as nothing saved
+        os.remove(os.path.join('drned-work', 'coverage', '1000', '100003.xml'))
+        for session in sessions:
+            covdir = os.path.join('drned-work', 'coverage', session)
+            with open(os.path.join(covdir, device.COVERAGE_INDEX), 'w') as index:
+                for i in range(len(sessions[session][1])):
+                    digest = device._store_snapshot(os.path.join(covdir, '{}.xml'.format(100000 + i)))
+                    index.write('{}\t{}\n'.format(digest, '(other)' if i else '(init)'))
+            assert os.listdir(covdir) == [device.COVERAGE_INDEX]
+        # the same snapshot in session 1001 is stored once
+        assert len(os.listdir(device.COVERAGE_OBJECTS)) == 9
+        assert normalize(self.report(capsys, devname=devname)) == old_report(old)
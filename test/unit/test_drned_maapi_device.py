@@ -0,0 +1,181 @@
+import os
+import sys
+from unittest import mock
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'drned'))
+
+
+class NcsError(Exception):
+    pass
+
+
+maapi_flags = dict(CONFIG_MERGE=1 << 0, CONFIG_REPLACE=1 << 1, CONFIG_XML=1 << 2,
+                   CONFIG_C=1 << 3, CONFIG_CONTINUE_ON_ERROR=1 << 4,
+                   CONFIG_XML_PRETTY=1 << 5, CONFIG_JSON=1 << 6)
+ncs_mock = mock.Mock(maapi=mock.Mock(**maapi_flags), error=mock.Mock(Error=NcsError))
+
+# mocklib replaces the drned package, the device module needs the real
+# one, and flags that can be combined
+drned_mock = sys.modules.pop('drned')
+pyapi_mock = sys.modules['_ncs']
+sys.modules['_ncs'] = ncs_mock
+try:
+    from drned import maapi_device  # noqa: E402
+finally:
+    sys.modules['drned'] = drned_mock
+    sys.modules['_ncs'] = pyapi_mock
+
+
+class TestMaapiDevice(object):
+    @pytest.fixture
+    def device(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        (tmp_path / 'drned-work').mkdir()
+        # the device is set up through the CLI, skip that
+        device = maapi_device.MaapiDevice.__new__(maapi_device.MaapiDevice)
+        device.name = 'dev'
+        device.rload_path = 'devices device dev config'
+        device.keypaths = {}
+        device.maapi = mock.Mock()
+        device.trans = mock.Mock()
+        return device
+
+    def commit(self, device, rollbacks, args='', result=None, error=None):
+        trans = device.trans
+        trans.apply_params.return_value = result
+        trans.apply_params.side_effect = error
+        with mock.patch.object(device, '_get_latest_rollback', side_effect=rollbacks):
+            device._commit(args)
+        return trans
+
+    def test_commit(self, device):
+        trans = self.commit(device, ['1', '2'])
+        assert device.ncs_buf == 'commit\nCommit complete.'
+        trans.apply_params.assert_called_once_with(True, trans.get_params.return_value)
+        # the changes are committed, a new transaction is started
+        trans.finish.assert_called_once_with()
+        assert device.trans is device.maapi.start_write_trans.return_value
+        with open('drned-work/stdin.txt') as stdin:
+            assert stdin.read() == 'commit\n'
+
+    def test_commit_no_modifications(self, device):
+        self.commit(device, ['1', '1'])
+        assert device.ncs_buf == 'commit\n% No modifications to commit.'
+
+    def test_commit_queue(self, device):
+        trans = self.commit(device, ['1', '2'], args='commit-queue sync',
+                            result={'id': '1234', 'status': 'completed'})
+        trans.get_params.return_value.commit_queue_sync.assert_called_once_with()
+        assert device.ncs_buf.split('\n') == ['commit commit-queue sync',
+                                              'commit-queue {',
+                                              '    id 1234',
+                                              '    status completed',
+                                              '}',
+                                              'Commit complete.']
+
+    def test_commit_aborted(self, device):
+        trans = device.trans
+        with pytest.raises(pytest.fail.Exception):
+            self.commit(device, ['1'], args='no-overwrite', error=NcsError('out of sync'))
+        assert device.ncs_buf == 'commit no-overwrite\nAborted: out of sync'
+        trans.get_params.return_value.no_overwrite.assert_called_once_with()
+        # the transaction is kept like in the CLI
+        assert device.trans is trans
+        trans.finish.assert_not_called()
+        device.maapi.start_write_trans.assert_not_called()
+
+    def test_dry_run_lines(self):
+        result = {'device': {'dev1': 'a\nb\n', 'dev0': 'c\n'}}
+        assert maapi_device._dry_run_lines('native', result) == [
+            'native {',
+            '    device {',
+            '        name dev0',
+            '        data c',
+            '    }',
+            '    device {',
+            '        name dev1',
+            '        data a',
+            '             b',
+            '    }',
+            '}']
+        result = {'local-node': 'devices device dev\n config\n  x\n'}
+        assert maapi_device._dry_run_lines('cli', result) == [
+            'cli {',
+            '    local-node {',
+            '        data devices device dev',
+            '              config',
+            '               x',
+            '    }',
+            '}']
+        assert maapi_device._dry_run_lines('cli', {}) == []
+        assert maapi_device._dry_run_lines('native', {'device': {}}) == []
+
+    def test_dry_run_exclude(self, device):
+        device.trans.apply_params.return_value = {
+            'local-node': 'devices device dev\n config\n  x\n'}
+        device._dry_run('cli', 'dry-run.txt', exclude='device dev')
+        params = device.trans.get_params.return_value
+        params.dry_run_cli.assert_called_once_with()
+        assert device.ncs_buf == 'commit dry-run outformat cli'
+        with open('dry-run.txt') as dry_run:
+            assert dry_run.read() == ('cli {\n'
+                                      '    local-node {\n'
+                                      '              config\n'
+                                      '               x\n'
+                                      '    }\n'
+                                      '}\n')
+
+    def test_dry_run_no_modifications(self, device):
+        device.trans.apply_params.return_value = {}
+        device._dry_run(None, 'dry-run.txt')
+        assert device.ncs_buf == ('commit dry-run outformat cli\n'
+                                  '% No modifications to commit.')
+
+    def test_compare_config(self, device):
+        result = mock.Mock(info=None, diff=' config {\n-    x 1;\n+    x 2;\n }\n')
+        with mock.patch.object(device, '_device') as dev:
+            dev.return_value.compare_config.return_value = result
+            device._compare_config()
+        assert device.ncs_buf.split('\n') == ['devices device dev compare-config',
+                                              'diff ',
+                                              ' config {',
+                                              '-    x 1;',
+                                              '+    x 2;',
+                                              ' }']
+
+    def test_compare_config_same(self, device):
+        result = mock.Mock(info=None, diff=None)
+        with mock.patch.object(device, '_device') as dev:
+            dev.return_value.compare_config.return_value = result
+            device._compare_config()
+        assert device.ncs_buf == 'devices device dev compare-config'
+
+    def test_load_flags(self, device):
+        flags = maapi_flags
+        device._load('merge', 'state.xml')
+        device.trans.load_config.assert_called_with(flags['CONFIG_MERGE'] | flags['CONFIG_XML'],
+                                                    os.path.abspath('state.xml'))
+        assert device.ncs_buf == 'load merge state.xml'
+        device._load('override', 'state.cfg')
+        device.trans.load_config.assert_called_with(
+            flags['CONFIG_REPLACE'] | flags['CONFIG_C'] | flags['CONFIG_CONTINUE_ON_ERROR'],
+            os.path.abspath('state.cfg'))
+        assert device.ncs_buf == 'load override state.cfg | best-effort'
+
+    def test_rload_flags(self, device):
+        with open('state.cfg', 'w') as state:
+            state.write('x 1\n')
+        device.keypaths['devices device dev config'] = '/devices/device{dev}/config'
+        device._rload('merge', 'state.cfg', None)
+        device.trans.load_config_cmds.assert_called_once_with(
+            maapi_flags['CONFIG_MERGE'] | maapi_flags['CONFIG_C']
+            | maapi_flags['CONFIG_CONTINUE_ON_ERROR'],
+            'x 1\n', '/devices/device{dev}/config')
+        assert device.ncs_buf == 'rload merge state.cfg | best-effort'
+
+    def test_load_unsupported_mode(self, device):
+        with pytest.raises(pytest.fail.Exception):
+            device._load('replace', 'state.cfg')
+        device.trans.load_config.assert_not_called()